@@ -0,0 +1,10 @@
+"""
+Benchmarks and correctness checks of the pipeline on small CPU inputs.
+
+Each module runs its checks when executed from the repository root, e.g.
+`python -m benchmarks.batching`.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hunyuan3d_2'))
@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from hy3dgen.shapegen.batching import BatchScheduler
+from profiler import Trace
+
+from .fixtures import tiny_pipeline
+
+def check_batching(num_inference_steps=4, atol=1e-5):
+    """
+    Decode requests through the scheduler and one at a time with a tiny random
+    pipeline on CPU.
+
+    The initial noise of every request must be identical. The latents can only
+    match up to float rounding, since BLAS picks different kernels for
+    different batch sizes. The diffusion span of the batch must be attached to
+    the trace of every request.
+    """
+    pipeline, images = tiny_pipeline()
+    seeds = [3, 1, 4, 1, 5]
+    noise = pipeline.prepare_latents(len(seeds), torch.float32, 'cpu',
+                                     [torch.Generator().manual_seed(seed) for seed in seeds])
+    single_noise = torch.cat([pipeline.prepare_latents(1, torch.float32, 'cpu', torch.Generator().manual_seed(seed))
+                              for seed in seeds])
+    reference = [
+        pipeline(image=image, generator=torch.Generator().manual_seed(seed), num_inference_steps=num_inference_steps,
+                 output_type='latent', enable_pbar=False)
+        for image, seed in zip(images, seeds)
+    ]
+    scheduler = BatchScheduler(pipeline, max_batch_size=4, max_wait=0.5)
+
+    def request(image, seed):
+        # like a predictor thread, the request waits inside its trace
+        with Trace('request', sync_device=False) as trace:
+            latents = scheduler(image, generator=torch.Generator().manual_seed(seed),
+                                num_inference_steps=num_inference_steps, octree_resolution=64, output_type='latent')
+        return latents, trace
+
+    with ThreadPoolExecutor(len(seeds)) as executor:
+        batched, traces = zip(*executor.map(request, images, seeds))
+    scheduler.close()
+    difference = max((a - b).abs().max().item() for a, b in zip(reference, batched))
+    traced = all(
+        any(child['name'] == 'Batched diffusion' and child['children'] for child in trace.to_dict()['children'])
+        for trace in traces
+    )
+    print(f'{scheduler.stats()}, identical noise: {torch.equal(noise, single_noise)}, '
+          f'max latent difference: {difference:.2e}, diffusion traced per request: {traced}')
+    return torch.equal(noise, single_noise) and difference <= atol and traced
+
+def check_single_flight(max_wait=1.0, num_inference_steps=2):
+    """
+    Check that a scheduler serving one request at a time, as under Cog
+    without concurrency, runs each request without waiting `max_wait` for a
+    batch that cannot form.
+    """
+    pipeline, images = tiny_pipeline(num_images=1)
+    scheduler = BatchScheduler(pipeline, max_batch_size=4, max_wait=max_wait, max_concurrency=1)
+    kwargs = dict(num_inference_steps=num_inference_steps, octree_resolution=64, output_type='latent')
+    # the first call pays the warm-up of the tiny pipeline
+    scheduler(images[0], generator=torch.Generator().manual_seed(0), **kwargs)
+    start = time.perf_counter()
+    scheduler(images[0], generator=torch.Generator().manual_seed(1), **kwargs)
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+    print(f'single request with max_wait {max_wait}s: {elapsed:.3f}s')
+    return elapsed < max_wait
+
+if __name__ == '__main__':
+    check_batching()
+    check_single_flight()
@@ -0,0 +1,34 @@
+import torch
+from PIL import Image
+
+from hy3dgen.shapegen.models.autoencoders import ShapeVAE
+from hy3dgen.shapegen.models.conditioner import SingleImageEncoder
+from hy3dgen.shapegen.models.denoisers import Hunyuan3DDiT
+from hy3dgen.shapegen.pipelines import Hunyuan3DDiTFlowMatchingPipeline
+from hy3dgen.shapegen.preprocessors import ImageProcessorV2
+from hy3dgen.shapegen.schedulers import FlowMatchEulerDiscreteScheduler
+
+def tiny_pipeline(num_images=5, hidden_size=32, depth=1, depth_single_blocks=1):
+    """
+    Return a randomly initialized flow matching pipeline small enough for CPU
+    checks, and RGBA test images.
+    """
+    torch.manual_seed(0)
+    dino = dict(hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=64,
+                image_size=28, patch_size=14)
+    pipeline = Hunyuan3DDiTFlowMatchingPipeline(
+        vae=ShapeVAE(num_latents=64, embed_dim=8, width=32, heads=2, num_decoder_layers=1),
+        model=Hunyuan3DDiT(in_channels=8, context_in_dim=32, hidden_size=hidden_size, num_heads=2, depth=depth,
+                           depth_single_blocks=depth_single_blocks, axes_dim=[hidden_size // 2]),
+        scheduler=FlowMatchEulerDiscreteScheduler(num_train_timesteps=1000),
+        conditioner=SingleImageEncoder(dict(type='DinoImageEncoder', kwargs=dict(config=dino, image_size=28))),
+        image_processor=ImageProcessorV2(size=56),
+        device='cpu',
+        dtype=torch.float32,
+    )
+    images = []
+    for i in range(num_images):
+        image = Image.new('RGBA', (64, 64))
+        image.paste((40 * i, 255 - 40 * i, 120, 255), (8 + i, 8, 48, 56 - 2 * i))
+        images.append(image)
+    return pipeline, images
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import trimesh
+from PIL import Image
+
+from vox2gltf import build_gltf, greedy_mesh, write_glb
+from voxelizer import prepare_mesh, voxelize_prepared
+from voxels import DenseVoxels
+
+def textured_sphere(subdivisions=5, texture_size=64, seed=0):
+    """
+    An icosphere, 20480 faces at 5 subdivisions, with longitude/latitude UVs
+    and a texture of random colour blocks.
+    """
+    rng = np.random.default_rng(seed)
+    mesh = trimesh.creation.icosphere(subdivisions=subdivisions)
+    x, y, z = mesh.vertices.T
+    uv = np.stack([np.arctan2(y, x) / (2 * np.pi) + 0.5, np.arccos(np.clip(z, -1, 1)) / np.pi], axis=1)
+    blocks = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    texture = Image.fromarray(blocks).resize((texture_size, texture_size), Image.NEAREST)
+    mesh.visual = trimesh.visual.TextureVisuals(uv=uv, image=texture)
+    return mesh
+
+def exposed_faces(colors):
+    """Number of voxel faces with an empty neighbour, each two triangles without greedy meshing."""
+    padded = np.pad(colors != 0, 1)
+    inner = padded[1:-1, 1:-1, 1:-1]
+    return sum(
+        int((inner & ~np.roll(padded, shift, axis)[1:-1, 1:-1, 1:-1]).sum())
+        for axis in range(3) for shift in (1, -1)
+    )
+
+def benchmark_gltf_export(resolutions=(64, 96)):
+    """
+    Voxelize a textured sphere and report the triangles of the greedy-meshed
+    model against two triangles per exposed face, the time of build_gltf and
+    write_glb, and check that the surface is closed and faces outward.
+    """
+    prepared = prepare_mesh(textured_sphere())
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for resolution in resolutions:
+            voxels = DenseVoxels.from_poly2vox(*voxelize_prepared(prepared, resolution))
+            start = time.perf_counter()
+            gltf, buffer = build_gltf(voxels)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            write_glb(gltf, buffer, os.path.join(temp_dir, f'sphere{resolution}.glb'))
+            write = time.perf_counter() - start
+
+            positions, _, _, indices = greedy_mesh(voxels.colors)
+            mesh = trimesh.Trimesh(positions, indices.reshape(-1, 3), process=False)
+            # the quads meet at T-junctions, so closed is checked on the area vectors rather than on shared edges:
+            # they cancel out on a closed surface, which has the voxel count as its volume when it faces outward
+            area_vectors = (mesh.face_normals * mesh.area_faces[:, None]).sum(axis=0)
+            closed = np.allclose(area_vectors, 0)
+            outward = np.isclose(mesh.volume, np.count_nonzero(voxels.colors))
+            print(f'{resolution}^3: {len(indices) // 3} triangles vs {2 * exposed_faces(voxels.colors)} per face, '
+                  f'build_gltf {build * 1000:.0f} ms, write_glb {write * 1000:.0f} ms, '
+                  f'closed: {closed}, outward: {outward}')
+
+if __name__ == '__main__':
+    benchmark_gltf_export()
@@ -0,0 +1,112 @@
+import time
+
+import numpy as np
+
+from hy3dgen.texgen.differentiable_renderer.mesh_processor import meshVerticeInpaint_smooth
+
+def meshVerticeInpaint_smooth_loop(texture, mask, vtx_pos, vtx_uv, pos_idx, uv_idx):
+    """
+    Per-vertex Python reference of meshVerticeInpaint_smooth, the original
+    implementation.
+    """
+    texture_height, texture_width, texture_channel = texture.shape
+    vtx_num = vtx_pos.shape[0]
+
+    vtx_mask = np.zeros(vtx_num, dtype=np.float32)
+    vtx_color = [np.zeros(texture_channel, dtype=np.float32) for _ in range(vtx_num)]
+    uncolored_vtxs = []
+    G = [[] for _ in range(vtx_num)]
+
+    for i in range(uv_idx.shape[0]):
+        for k in range(3):
+            vtx_uv_idx = uv_idx[i, k]
+            vtx_idx = pos_idx[i, k]
+            uv_v = int(round(vtx_uv[vtx_uv_idx, 0] * (texture_width - 1)))
+            uv_u = int(round((1.0 - vtx_uv[vtx_uv_idx, 1]) * (texture_height - 1)))
+            if mask[uv_u, uv_v] > 0:
+                vtx_mask[vtx_idx] = 1.0
+                vtx_color[vtx_idx] = texture[uv_u, uv_v]
+            else:
+                uncolored_vtxs.append(vtx_idx)
+            G[pos_idx[i, k]].append(pos_idx[i, (k + 1) % 3])
+
+    smooth_count = 2
+    last_uncolored_vtx_count = 0
+    while smooth_count > 0:
+        uncolored_vtx_count = 0
+        for vtx_idx in uncolored_vtxs:
+            sum_color = np.zeros(texture_channel, dtype=np.float32)
+            total_weight = 0.0
+            vtx_0 = vtx_pos[vtx_idx]
+            for connected_idx in G[vtx_idx]:
+                if vtx_mask[connected_idx] > 0:
+                    vtx1 = vtx_pos[connected_idx]
+                    dist = np.sqrt(np.sum((vtx_0 - vtx1) ** 2))
+                    dist_weight = 1.0 / max(dist, 1e-4)
+                    dist_weight *= dist_weight
+                    sum_color += vtx_color[connected_idx] * dist_weight
+                    total_weight += dist_weight
+            if total_weight > 0:
+                vtx_color[vtx_idx] = sum_color / total_weight
+                vtx_mask[vtx_idx] = 1.0
+            else:
+                uncolored_vtx_count += 1
+
+        if last_uncolored_vtx_count == uncolored_vtx_count:
+            smooth_count -= 1
+        else:
+            smooth_count += 1
+        last_uncolored_vtx_count = uncolored_vtx_count
+
+    new_texture = texture.copy()
+    new_mask = mask.copy()
+    for face_idx in range(uv_idx.shape[0]):
+        for k in range(3):
+            vtx_uv_idx = uv_idx[face_idx, k]
+            vtx_idx = pos_idx[face_idx, k]
+            if vtx_mask[vtx_idx] == 1.0:
+                uv_v = int(round(vtx_uv[vtx_uv_idx, 0] * (texture_width - 1)))
+                uv_u = int(round((1.0 - vtx_uv[vtx_uv_idx, 1]) * (texture_height - 1)))
+                new_texture[uv_u, uv_v] = vtx_color[vtx_idx]
+                new_mask[uv_u, uv_v] = 255
+    return new_texture, new_mask
+
+def synthetic_inpaint_case(face_num, texture_size=1024, seed=0):
+    """Build a height field grid mesh with about `face_num` faces, a random texture and a mask with holes."""
+    rng = np.random.default_rng(seed)
+    n = max(int(np.sqrt(face_num / 2)), 1)
+    y, x = np.meshgrid(np.linspace(0, 1, n + 1), np.linspace(0, 1, n + 1), indexing='ij')
+    vtx_pos = np.stack([x, y, 0.05 * np.sin(8 * x) * np.cos(8 * y)], axis=-1).reshape(-1, 3).astype(np.float32)
+    vtx_uv = vtx_pos[:, :2].copy()
+    corner = (np.arange(n)[:, None] * (n + 1) + np.arange(n)[None, :]).reshape(-1)
+    pos_idx = np.concatenate([
+        np.stack([corner, corner + 1, corner + n + 2], axis=1),
+        np.stack([corner, corner + n + 2, corner + n + 1], axis=1),
+    ]).astype(np.int32)
+    texture = rng.random((texture_size, texture_size, 3)).astype(np.float32)
+    mask = np.full((texture_size, texture_size), 255, dtype=np.uint8)
+    # Unseen discs of texels, the largest ones need several smoothing passes
+    rows, cols = np.mgrid[:texture_size, :texture_size] / texture_size
+    for cy, cx, r in rng.random((8, 3)) * [1, 1, 0.15]:
+        mask[(rows - cy) ** 2 + (cols - cx) ** 2 < r ** 2] = 0
+    return texture, mask, vtx_pos, vtx_uv, pos_idx, pos_idx.copy()
+
+def benchmark_inpaint(face_nums=(10000, 50000, 100000, 250000, 500000), reference_max_faces=100000):
+    """Time meshVerticeInpaint_smooth against the loop reference and report the largest difference."""
+    for face_num in face_nums:
+        case = synthetic_inpaint_case(face_num)
+        start = time.perf_counter()
+        texture, mask = meshVerticeInpaint_smooth(*case)
+        vectorized = time.perf_counter() - start
+        line = f'{len(case[4])} faces: vectorized {vectorized:.3f}s'
+        if len(case[4]) <= reference_max_faces:
+            start = time.perf_counter()
+            reference_texture, reference_mask = meshVerticeInpaint_smooth_loop(*case)
+            reference = time.perf_counter() - start
+            line += (f', loop {reference:.2f}s ({reference / vectorized:.0f}x),'
+                     f' max difference {np.abs(texture - reference_texture).max():.2e},'
+                     f' mask mismatches {(mask != reference_mask).sum()}')
+        print(line)
+
+if __name__ == '__main__':
+    benchmark_inpaint()
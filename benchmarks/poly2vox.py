@@ -0,0 +1,137 @@
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from polyvox2mgvox import convert_poly2vox_to_magicavoxel, read_int
+
+def convert_poly2vox_to_magicavoxel_loop(poly2vox_file, magicavoxel_file):
+    """
+    Per-voxel Python reference of convert_poly2vox_to_magicavoxel, the
+    original implementation.
+
+    Args:
+        poly2vox_file (str): Path to input poly2vox .vox file
+        magicavoxel_file (str): Path to output MagicaVoxel .vox file
+    """
+    # Read poly2vox file
+    with open(poly2vox_file, 'rb') as f:
+        xsiz = read_int(f)
+        ysiz = read_int(f)
+        zsiz = read_int(f)
+        voxel_data = f.read(xsiz * ysiz * zsiz)
+        palette = f.read(256 * 3)  # Assuming 256 RGB colors (768 bytes)
+
+    # Define directions for checking neighboring voxels
+    directions = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
+
+    # Process voxel data: collect only visible voxels
+    voxels = []
+    for z in range(zsiz):
+        for y in range(ysiz):
+            for x in range(xsiz):
+                idx = z + y * zsiz + x * zsiz * ysiz
+                v = voxel_data[idx]
+                if v != 255:
+                    # Check if voxel is visible (has at least one empty neighbor or is on boundary)
+                    is_visible = any(
+                        (nx < 0 or nx >= xsiz or ny < 0 or ny >= ysiz or nz < 0 or nz >= zsiz or
+                         voxel_data[nz + ny * zsiz + nx * zsiz * ysiz] == 255)
+                        for nx, ny, nz in [(x + dx, y + dy, z + dz) for dx, dy, dz in directions]
+                    )
+                    if is_visible:
+                        if v == 0:
+                            color_index = 255  # Default color for internal (but visible) voxels
+                        else:
+                            color_index = v  # Surface voxels use v directly (1-254)
+                        voxels.append((x, y + 1, z + 1, color_index))
+
+    # Prepare MagicaVoxel palette: 256 RGBA colors
+    mv_palette = []  # Index 0: unused, set to transparent black
+    for i in range(1, 255):
+        r = palette[i * 3]
+        g = palette[i * 3 + 1]
+        b = palette[i * 3 + 2]
+        mv_palette.append((r, g, b, 255))  # Indices 1-255: poly2vox[0-254] with A=255
+
+    mv_palette.append((0, 0, 0, 0))  # Indices 1-255: poly2vox[0-254] with A=255
+
+    # Build MagicaVoxel chunks
+    # SIZE chunk: dimensions
+    size_content = struct.pack('<iii', xsiz, ysiz, zsiz)
+    size_chunk = b'SIZE' + struct.pack('<ii', len(size_content), 0) + size_content
+
+    # XYZI chunk: voxel list
+    num_voxels = len(voxels)
+    xyzi_content = struct.pack('<i', num_voxels)
+    for x, y, z, c in voxels:
+        xyzi_content += struct.pack('<BBBB', x, ysiz - y, zsiz - z, c)
+    xyzi_chunk = b'XYZI' + struct.pack('<ii', len(xyzi_content), 0) + xyzi_content
+
+    # RGBA chunk: palette
+    rgba_content = b''
+    for r, g, b, a in mv_palette:
+        rgba_content += struct.pack('<BBBB', r * 4, g * 4, b * 4, a)
+    rgba_chunk = b'RGBA' + struct.pack('<ii', len(rgba_content), 0) + rgba_content
+
+    # MAIN chunk: contains SIZE, XYZI, RGBA
+    children = size_chunk + xyzi_chunk + rgba_chunk
+    main_chunk = b'MAIN' + struct.pack('<ii', 0, len(children)) + children
+
+    # Assemble full file
+    vox_file = b'VOX ' + struct.pack('<i', 150) + main_chunk
+
+    # Write to output file
+    with open(magicavoxel_file, 'wb') as f:
+        f.write(vox_file)
+
+
+def write_sphere_shell(poly2vox_file, size, hole_fraction=0.01, seed=0):
+    """
+    Write a poly2vox file of a solid sphere with a textured surface and
+    random holes in it, so that some interior voxels are exposed.
+    """
+    rng = np.random.default_rng(seed)
+    center = (size - 1) / 2
+    x, y, z = np.indices((size, size, size)) - center
+    radius = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    grid = np.full((size, size, size), 255, dtype=np.uint8)
+    grid[radius <= size / 2 - 1] = 0
+    shell = (radius <= size / 2 - 1) & (radius > size / 2 - 2)
+    grid[shell] = rng.integers(1, 255, shell.sum(), dtype=np.uint8)
+    grid[shell & (rng.random(grid.shape) < hole_fraction)] = 255
+    palette = rng.integers(0, 64, (256, 3), dtype=np.uint8)
+    with open(poly2vox_file, 'wb') as f:
+        f.write(struct.pack('<iii', size, size, size))
+        f.write(grid.tobytes())
+        f.write(palette.tobytes())
+
+def benchmark_poly2vox(sizes=(32, 64, 96, 256), reference_max_size=96):
+    """
+    Time convert_poly2vox_to_magicavoxel against the loop reference and check
+    that both write the same bytes.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            poly2vox_file = os.path.join(temp_dir, f'sphere{size}.vox')
+            write_sphere_shell(poly2vox_file, size)
+            output = os.path.join(temp_dir, f'sphere{size}.mv.vox')
+            start = time.perf_counter()
+            convert_poly2vox_to_magicavoxel(poly2vox_file, output)
+            vectorized = time.perf_counter() - start
+            line = f'{size}^3: vectorized {vectorized:.4f}s'
+            if size <= reference_max_size:
+                reference_output = os.path.join(temp_dir, f'sphere{size}.loop.vox')
+                start = time.perf_counter()
+                convert_poly2vox_to_magicavoxel_loop(poly2vox_file, reference_output)
+                reference = time.perf_counter() - start
+                with open(output, 'rb') as f, open(reference_output, 'rb') as g:
+                    identical = f.read() == g.read()
+                assert identical, f'{size}^3 output differs from the loop reference'
+                line += f', loop {reference:.3f}s ({reference / vectorized:.0f}x), byte-identical: {identical}'
+            print(line)
+
+if __name__ == '__main__':
+    benchmark_poly2vox()
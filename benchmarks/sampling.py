@@ -0,0 +1,121 @@
+import time
+
+import torch
+import torch.nn.functional as F
+
+from hy3dgen.shapegen.models.denoisers import BlockCachePolicy
+
+from .fixtures import tiny_pipeline
+
+GUIDANCE_SCHEDULES = {
+    'full': dict(),
+    'cfg 0-40%': dict(guidance_interval=(0.0, 0.4)),
+    'cfg 0-40%, reuse uncond': dict(guidance_interval=(0.0, 0.4), reuse_uncond=True),
+    'cfg 10-50%': dict(guidance_interval=(0.1, 0.5)),
+    'cfg 0-20%, reuse uncond': dict(guidance_interval=(0.0, 0.2), reuse_uncond=True),
+}
+
+BLOCK_CACHE_POLICIES = {
+    'no cache': dict(),
+    'single blocks, threshold 0.1': dict(block_cache=BlockCachePolicy()),
+    'single blocks, threshold 0.2, reuse 3': dict(block_cache=BlockCachePolicy(threshold=0.2, max_reuse=3)),
+    'all blocks, threshold 0.2, reuse 3': dict(
+        block_cache=BlockCachePolicy(double_blocks=((0, None),), threshold=0.2, max_reuse=3)),
+}
+
+def compare_sampling(pipeline, image, variants, num_inference_steps=50, guidance_scale=5.0, seed=0):
+    """
+    Diffuse one image with each variant of the pipeline arguments and compare
+    its latents with those of the first variant.
+
+    The latent cache is disabled while measuring and the pipeline is warmed up
+    first. Every result holds the latents, the wall time, the number of model
+    calls, the number of samples the model evaluated, and the relative error
+    and cosine similarity of the latents against the first variant.
+
+    Args:
+        pipeline: a Hunyuan3DDiTFlowMatchingPipeline
+        image: the conditioning image
+        variants (dict): pipeline keyword arguments by variant name, which may
+            override num_inference_steps
+    """
+    batch_sizes = []
+    hook = pipeline.model.register_forward_hook(lambda module, args, output: batch_sizes.append(args[0].shape[0]))
+    latent_cache, pipeline.latent_cache = pipeline.latent_cache, None
+    try:
+        pipeline(image=image, num_inference_steps=2, output_type='latent', enable_pbar=False)
+        results = {}
+        for name, kwargs in variants.items():
+            kwargs = dict(dict(num_inference_steps=num_inference_steps, guidance_scale=guidance_scale), **kwargs)
+            batch_sizes.clear()
+            start = time.perf_counter()
+            latents = pipeline(image=image, generator=torch.Generator().manual_seed(seed), output_type='latent',
+                               enable_pbar=False, **kwargs).float()
+            seconds = time.perf_counter() - start
+            baseline = results[next(iter(results))]['latents'] if results else latents
+            results[name] = dict(
+                latents=latents,
+                seconds=seconds,
+                calls=len(batch_sizes),
+                evaluations=sum(batch_sizes),
+                error=((latents - baseline).norm() / baseline.norm()).item(),
+                cosine=F.cosine_similarity(latents.flatten(), baseline.flatten(), dim=0).item(),
+            )
+    finally:
+        pipeline.latent_cache = latent_cache
+        hook.remove()
+    return results
+
+def print_results(results):
+    full = next(iter(results.values()))['evaluations']
+    for name, result in results.items():
+        print(f"{name}: {result['seconds']:.2f}s, {result['calls']} model calls, "
+              f"{result['evaluations'] / full:.0%} of the model evaluations, "
+              f"relative latent error {result['error']:.4f}, cosine {result['cosine']:.4f}")
+
+def benchmark_guidance(pipeline=None, image=None, schedules=GUIDANCE_SCHEDULES, **kwargs):
+    """
+    Compare limited classifier-free guidance schedules with full guidance, on
+    a tiny random pipeline unless given one.
+    """
+    if pipeline is None:
+        pipeline, (image,) = tiny_pipeline(num_images=1)
+    results = compare_sampling(pipeline, image, schedules, **kwargs)
+    print_results(results)
+    return results
+
+def benchmark_block_cache(pipeline=None, image=None, policies=BLOCK_CACHE_POLICIES, **kwargs):
+    """
+    Compare block cache policies with uncached sampling, on a small random
+    pipeline unless given one.
+    """
+    if pipeline is None:
+        pipeline, (image,) = tiny_pipeline(num_images=1, hidden_size=128, depth=4, depth_single_blocks=8)
+    results = compare_sampling(pipeline, image, policies, **kwargs)
+    print_results(results)
+    return results
+
+def check_fast_sampling(steps=50, fast_steps=5, rtol=0.05):
+    """
+    Sample with the flow matching and the consistency scheduler on a small
+    random pipeline.
+
+    At the same number of steps both integrate the same flow on matching sigma
+    schedules, so their latents must agree within `rtol`. The fast mode must
+    run the model once per step.
+    """
+    pipeline, (image,) = tiny_pipeline(num_images=1, hidden_size=128, depth=4, depth_single_blocks=8)
+    results = compare_sampling(pipeline, image, {
+        'flow matching': dict(num_inference_steps=steps),
+        'consistency': dict(num_inference_steps=steps, fast=True),
+        'consistency fast': dict(num_inference_steps=fast_steps, fast=True),
+    })
+    print_results(results)
+    return (results['consistency']['error'] <= rtol
+            and [result['calls'] for result in results.values()] == [steps, steps, fast_steps]
+            and bool(torch.isfinite(results['consistency fast']['latents']).all()))
+
+if __name__ == '__main__':
+    benchmark_guidance()
+    benchmark_block_cache()
+    print(f'fast sampling matches: {check_fast_sampling()}')
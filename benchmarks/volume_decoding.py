@@ -0,0 +1,217 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from hy3dgen.shapegen.models.autoencoders.attention_blocks import CrossAttentionDecoder, FourierEmbedder
+from hy3dgen.shapegen.models.autoencoders.volume_decoders import FlashVDMVolumeDecoding, QueryGridCache, \
+    VoxelGridDecoder, dilate_mask, extract_near_surface_volume_fn, generate_dense_grid_points
+from profiler import _read_rss, _reset_peak_rss
+
+def extract_near_surface_dense(input_tensor, alpha):
+    """
+    Padded-copy reference of extract_near_surface_volume_fn, the original
+    implementation.
+    """
+    device = input_tensor.device
+    D = input_tensor.shape[0]
+    signed_val = 0.0
+
+    # 添加偏移并处理无效值
+    val = input_tensor + alpha
+    valid_mask = val > -9000  # 假设-9000是无效值
+
+    # 改进的邻居获取函数（保持维度一致）
+    def get_neighbor(t, shift, axis):
+        """根据指定轴进行位移并保持维度一致"""
+        if shift == 0:
+            return t.clone()
+
+        # 确定填充轴（输入为[D, D, D]对应z,y,x轴）
+        pad_dims = [0, 0, 0, 0, 0, 0]  # 格式：[x前，x后，y前，y后，z前，z后]
+
+        # 根据轴类型设置填充
+        if axis == 0:  # x轴（最后一个维度）
+            pad_idx = 0 if shift > 0 else 1
+            pad_dims[pad_idx] = abs(shift)
+        elif axis == 1:  # y轴（中间维度）
+            pad_idx = 2 if shift > 0 else 3
+            pad_dims[pad_idx] = abs(shift)
+        elif axis == 2:  # z轴（第一个维度）
+            pad_idx = 4 if shift > 0 else 5
+            pad_dims[pad_idx] = abs(shift)
+
+        # 执行填充（添加batch和channel维度适配F.pad）
+        padded = F.pad(t.unsqueeze(0).unsqueeze(0), pad_dims[::-1], mode='replicate')  # 反转顺序适配F.pad
+
+        # 构建动态切片索引
+        slice_dims = [slice(None)] * 3  # 初始化为全切片
+        if axis == 0:  # x轴（dim=2）
+            if shift > 0:
+                slice_dims[0] = slice(shift, None)
+            else:
+                slice_dims[0] = slice(None, shift)
+        elif axis == 1:  # y轴（dim=1）
+            if shift > 0:
+                slice_dims[1] = slice(shift, None)
+            else:
+                slice_dims[1] = slice(None, shift)
+        elif axis == 2:  # z轴（dim=0）
+            if shift > 0:
+                slice_dims[2] = slice(shift, None)
+            else:
+                slice_dims[2] = slice(None, shift)
+
+        # 应用切片并恢复维度
+        padded = padded.squeeze(0).squeeze(0)
+        sliced = padded[tuple(slice_dims)]
+        return sliced
+
+    # 获取各方向邻居（确保维度一致）
+    left = get_neighbor(val, 1, axis=0)  # x方向
+    right = get_neighbor(val, -1, axis=0)
+    back = get_neighbor(val, 1, axis=1)  # y方向
+    front = get_neighbor(val, -1, axis=1)
+    down = get_neighbor(val, 1, axis=2)  # z方向
+    up = get_neighbor(val, -1, axis=2)
+
+    # 处理边界无效值（使用where保持维度一致）
+    def safe_where(neighbor):
+        return torch.where(neighbor > -9000, neighbor, val)
+
+    left = safe_where(left)
+    right = safe_where(right)
+    back = safe_where(back)
+    front = safe_where(front)
+    down = safe_where(down)
+    up = safe_where(up)
+
+    # 计算符号一致性（转换为float32确保精度）
+    sign = torch.sign(val.to(torch.float32))
+    neighbors_sign = torch.stack([
+        torch.sign(left.to(torch.float32)),
+        torch.sign(right.to(torch.float32)),
+        torch.sign(back.to(torch.float32)),
+        torch.sign(front.to(torch.float32)),
+        torch.sign(down.to(torch.float32)),
+        torch.sign(up.to(torch.float32))
+    ], dim=0)
+
+    # 检查所有符号是否一致
+    same_sign = torch.all(neighbors_sign == sign, dim=0)
+
+    # 生成最终掩码
+    mask = (~same_sign).to(torch.int32)
+    return mask * valid_mask.to(torch.int32)
+
+def near_surface_band(grid_logits, mc_level, dilate_fn, extract_fn):
+    curr_points = extract_fn(grid_logits, mc_level) > 0
+    curr_points |= (grid_logits > -0.95) & (grid_logits < 0.95)
+    return dilate_fn(curr_points)
+
+def benchmark_near_surface(resolutions=(64, 128, 256, 512), reference_max_resolution=256):
+    """
+    Time and measure the CPU peak memory of the band extraction and dilation
+    of one octree level against the padded-copy and Conv3d reference, on a
+    bumpy sphere logit grid.
+    """
+    dilate = nn.Conv3d(1, 1, 3, padding=1, bias=False)
+    dilate.weight = torch.nn.Parameter(torch.ones(dilate.weight.shape))
+
+    def conv_dilate(mask):
+        with torch.no_grad():
+            return dilate(mask.unsqueeze(0).float()).squeeze(0) > 0
+
+    for resolution in resolutions:
+        xyz, _, _ = generate_dense_grid_points(np.array([-1.01] * 3), np.array([1.01] * 3), resolution)
+        xyz = torch.from_numpy(xyz)
+        grid_logits = (0.5 - xyz.norm(dim=-1) + 0.05 * torch.sin(9 * xyz[..., 0])) * 10
+        del xyz
+        results = {}
+        for name, dilate_fn, extract_fn in (('lean', dilate_mask, extract_near_surface_volume_fn),
+                                            ('reference', conv_dilate, extract_near_surface_dense)):
+            if name == 'reference' and resolution > reference_max_resolution:
+                continue
+            _reset_peak_rss()
+            rss, _ = _read_rss()
+            start = time.perf_counter()
+            band = near_surface_band(grid_logits, 0.0, dilate_fn, extract_fn)
+            elapsed = time.perf_counter() - start
+            _, peak = _read_rss()
+            results[name] = band
+            print(f'[r{resolution + 1}] {name}: {elapsed:.2f}s, peak +{peak - rss:.0f} MB')
+        if 'reference' in results:
+            print(f'[r{resolution + 1}] masks identical: {torch.equal(results["lean"], results["reference"])}')
+
+class SphereGeoDecoder(nn.Module):
+    """
+    A random CrossAttentionDecoder offsetting the logits of a sphere, so that
+    volume decoders have a surface band to refine.
+    """
+
+    def __init__(self, num_latents=512, width=128, heads=8):
+        super().__init__()
+        self.decoder = CrossAttentionDecoder(num_latents=num_latents, out_channels=1,
+                                             fourier_embedder=FourierEmbedder(num_freqs=8),
+                                             width=width, heads=heads)
+
+    def get_cross_attention_processor(self):
+        return self.decoder.get_cross_attention_processor()
+
+    def set_cross_attention_processor(self, processor):
+        self.decoder.set_cross_attention_processor(processor)
+
+    def forward(self, queries, latents):
+        radius = queries.float().norm(dim=-1, keepdim=True)
+        return (0.5 - radius) * 20 + 0.5 * self.decoder(queries=queries, latents=latents)
+
+def benchmark_flashvdm_cells(octree_resolution=256, num_latents=512, width=128, heads=8, num_chunks=50000,
+                             device=None):
+    """
+    Time FlashVDM decoding with the packed per-cell attention against one
+    attention call per cell, with a small random CrossAttentionDecoder, on
+    CUDA when it is available.
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    geo_decoder = SphereGeoDecoder(num_latents, width, heads).eval().to(device)
+    latents = torch.randn(1, num_latents, width, device=device)
+    results = {}
+    for name, packed in (('packed', True), ('per-cell', False)):
+        decoder = FlashVDMVolumeDecoding(cache=QueryGridCache(), packed=packed)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        results[name] = decoder(latents, geo_decoder, octree_resolution=octree_resolution,
+                                num_chunks=num_chunks, enable_pbar=False)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        print(f'[r{octree_resolution + 1}] {name} on {device}: {time.perf_counter() - start:.2f}s')
+    packed, per_cell = (torch.nan_to_num(results[name]) for name in ('packed', 'per-cell'))
+    print(f'[r{octree_resolution + 1}] max logit difference: {(packed - per_cell).abs().max().item():.2e}, '
+          f'sign agreement: {((packed > 0) == (per_cell > 0)).float().mean().item():.6f}')
+
+def check_voxel_decoder(voxel_resolution=32, octree_resolution=64, num_latents=64, width=32, heads=2):
+    """
+    Check on CPU that voxel decoding after a FlashVDM decode attends to all
+    latents, and gives the geo decoder its FlashVDM processor back.
+    """
+    torch.manual_seed(0)
+    geo_decoder = SphereGeoDecoder(num_latents, width, heads).eval()
+    latents = torch.randn(1, num_latents, width)
+    decode_voxels = VoxelGridDecoder(cache=QueryGridCache())
+    reference = decode_voxels(latents, geo_decoder, voxel_resolution=voxel_resolution, enable_pbar=False)
+    flashvdm = FlashVDMVolumeDecoding(cache=QueryGridCache())
+    flashvdm(latents, geo_decoder, octree_resolution=octree_resolution, enable_pbar=False)
+    voxels = decode_voxels(latents, geo_decoder, voxel_resolution=voxel_resolution, enable_pbar=False)
+    restored = geo_decoder.get_cross_attention_processor() is flashvdm.processor
+    print(f'[v{voxel_resolution}] voxels unchanged by FlashVDM: {torch.equal(voxels, reference)}, '
+          f'FlashVDM processor restored: {restored}')
+
+if __name__ == '__main__':
+    benchmark_near_surface()
+    benchmark_flashvdm_cells()
+    check_voxel_decoder()
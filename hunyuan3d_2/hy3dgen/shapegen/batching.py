@@ -0,0 +1,178 @@
+# Hunyuan 3D is licensed under the TENCENT HUNYUAN NON-COMMERCIAL LICENSE AGREEMENT
+# except for the third-party components listed below.
+# Hunyuan 3D does not impose any additional limitations beyond what is outlined
+# in the repsective licenses of these third-party components.
+# Users must comply with all terms and conditions of original licenses of these third-party
+# components and must ensure that the usage of the third party components adheres to
+# all relevant laws and regulations.
+
+# For avoidance of doubts, Hunyuan 3D means the large language models and
+# their software and algorithms, including trained model weights, parameters (including
+# optimizer states), machine-learning model code, inference-enabling code, training-enabling code,
+# fine-tuning enabling code and other elements of the foregoing made publicly available
+# by Tencent in accordance with TENCENT HUNYUAN COMMUNITY LICENSE AGREEMENT.
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+import torch
+
+from .utils import logger, profiler
+
+
+class ShapeRequest:
+    def __init__(self, image, generator, diffusion_kwargs, export_kwargs):
+        self.image = image
+        self.generator = generator
+        self.diffusion_kwargs = diffusion_kwargs
+        self.export_kwargs = export_kwargs
+        self.future = Future()
+        # the scheduler thread records spans into the trace of the submitting thread
+        self.trace = None if profiler is None else profiler.current_trace()
+
+    @property
+    def batch_key(self):
+        return tuple(self.diffusion_kwargs.values()) + (self.export_kwargs['octree_resolution'],)
+
+
+class BatchScheduler:
+    """Queue shape requests from any thread and run the ones sharing their diffusion parameters and
+    octree_resolution as one batched diffusion of the pipeline.
+
+    The oldest pending request opens a batch, which waits up to `max_wait` seconds for compatible requests and
+    runs once it holds `max_batch_size` of them. With `max_concurrency`, the most requests callers keep in flight
+    at once, the batch does not wait once that many are pending, as no other request can arrive. Every request keeps its own generator, so its initial noise does
+    not depend on the batch it lands in, and its latents only differ from an unbatched call by float rounding.
+    The latents are split back per request and exported with the export parameters of that request.
+
+    The spans of the batched diffusion are attached to the profiler trace of every request in the batch, and the
+    spans of an export to the trace of its request.
+    """
+
+    def __init__(self, pipeline, max_batch_size=4, max_wait=0.05, max_concurrency=None):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.num_batches = 0
+        self.num_requests = 0
+        self.worker = threading.Thread(target=self._serve, name='shape-batch-scheduler', daemon=True)
+        self.worker.start()
+
+    def submit(
+        self,
+        image,
+        generator=None,
+        num_inference_steps=50,
+        guidance_scale=5.0,
+        octree_resolution=384,
+        guidance_interval=None,
+        reuse_uncond=False,
+        block_cache=None,
+        fast=False,
+        **export_kwargs,
+    ) -> Future:
+        request = ShapeRequest(
+            image,
+            generator,
+            dict(num_inference_steps=num_inference_steps, guidance_scale=guidance_scale,
+                 guidance_interval=None if guidance_interval is None else tuple(guidance_interval),
+                 reuse_uncond=reuse_uncond, block_cache=block_cache,
+                 fast=fast),
+            dict(export_kwargs, octree_resolution=octree_resolution),
+        )
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The batch scheduler is closed')
+            self.pending.append(request)
+            self.condition.notify_all()
+        return request.future
+
+    def __call__(self, image, **kwargs):
+        return self.submit(image, **kwargs).result()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            key = self.pending[0].batch_key
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                batch = [request for request in self.pending if request.batch_key == key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) == self.max_batch_size or remaining <= 0 or self.closed or self.saturated():
+                    break
+                self.condition.wait(remaining)
+            for request in batch:
+                self.pending.remove(request)
+            return batch
+
+    def saturated(self):
+        """Whether every request that can be in flight is already pending, the previous batch having completed."""
+        return self.max_concurrency is not None and len(self.pending) >= self.max_concurrency
+
+    def run_batch(self, batch):
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        logger.info(f'Running a batch of {len(batch)} shape requests')
+        try:
+            with self.record(batch, 'Batched diffusion', batch_size=len(batch)):
+                latents = self.pipeline(
+                    image=[request.image for request in batch],
+                    generator=[request.generator for request in batch],
+                    output_type='latent',
+                    enable_pbar=False,
+                    **batch[0].diffusion_kwargs,
+                )
+        except Exception as exc:
+            for request in batch:
+                request.future.set_exception(exc)
+            return
+        for i, request in enumerate(batch):
+            try:
+                with self.record([request], 'Shape export'), torch.inference_mode():
+                    outputs = self.pipeline._export(latents[i:i + 1], enable_pbar=False, **request.export_kwargs)
+                request.future.set_result(outputs)
+            except Exception as exc:
+                request.future.set_exception(exc)
+
+    @contextmanager
+    def record(self, requests, name, **attrs):
+        """Trace a stage on this thread and attach its spans to the traces of the requests it serves."""
+        traces = [request.trace for request in requests if request.trace is not None]
+        if not traces:
+            yield
+            return
+        trace = profiler.Trace(name, sync_device=traces[0].sync_device, **attrs)
+        try:
+            with trace:
+                yield
+        finally:
+            # the submitting threads wait on their futures, so their open spans do not move
+            span = trace.to_dict()
+            for request_trace in traces:
+                request_trace.attach(span)
+
+    def _serve(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.run_batch(batch)
+
+    def stats(self):
+        return dict(batches=self.num_batches, requests=self.num_requests)
@@ -0,0 +1,137 @@
+# Hunyuan 3D is licensed under the TENCENT HUNYUAN NON-COMMERCIAL LICENSE AGREEMENT
+# except for the third-party components listed below.
+# Hunyuan 3D does not impose any additional limitations beyond what is outlined
+# in the repsective licenses of these third-party components.
+# Users must comply with all terms and conditions of original licenses of these third-party
+# components and must ensure that the usage of the third party components adheres to
+# all relevant laws and regulations.
+
+# For avoidance of doubts, Hunyuan 3D means the large language models and
+# their software and algorithms, including trained model weights, parameters (including
+# optimizer states), machine-learning model code, inference-enabling code, training-enabling code,
+# fine-tuning enabling code and other elements of the foregoing made publicly available
+# by Tencent in accordance with TENCENT HUNYUAN COMMUNITY LICENSE AGREEMENT.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+from ..disk_cache import DiskCache
+
+
+def _update_hash(digest, value):
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().contiguous()
+        digest.update(f'tensor{tuple(value.shape)}{value.dtype}'.encode())
+        digest.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(f'array{value.shape}{value.dtype}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, Image.Image):
+        digest.update(f'image{value.size}{value.mode}'.encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, torch.Generator):
+        _update_hash(digest, value.get_state())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key in sorted(value):
+            digest.update(repr(key).encode())
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'list{len(value)}'.encode())
+        for item in value:
+            _update_hash(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def hash_inputs(**inputs):
+    """Content hash of tensors, arrays, images, generator states and plain values, stable across processes."""
+    digest = hashlib.sha256()
+    _update_hash(digest, inputs)
+    return digest.hexdigest()
+
+
+class LatentCache:
+    """Post-diffusion shape latents on disk, one safetensors file per key, in a `DiskCache` evicting the least
+    recently used files once they exceed `max_bytes`.
+
+    Keys are content hashes of everything the diffusion depends on, see `hash_inputs`, so that changing only the
+    export parameters of a request reuses its latents. Several processes may share a cache directory.
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 << 30):
+        self.disk = DiskCache(cache_dir, max_bytes, suffix='.safetensors')
+
+    def get(self, key, device=None, dtype=None):
+        import safetensors.torch
+        data = self.disk.read(key)
+        if data is None:
+            return None
+        latents = safetensors.torch.load(data)['latents']
+        return latents.to(device=device, dtype=dtype)
+
+    def put(self, key, latents):
+        import safetensors.torch
+        self.disk.write(key, safetensors.torch.save({'latents': latents.detach().contiguous().cpu()}))
+
+    def clear(self):
+        self.disk.clear()
+
+    def stats(self):
+        return self.disk.stats()
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    return sum(_nbytes(v) for v in value.values())
+
+
+class CondCache:
+    """Conditioner outputs in memory, on the device they were computed on, evicted least recently used first once
+    they exceed `max_bytes`."""
+
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            cond = self.entries.get(key)
+            if cond is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cond
+
+    def put(self, key, cond):
+        nbytes = _nbytes(cond)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= _nbytes(self.entries.pop(key))
+            self.entries[key] = cond
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= _nbytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries), bytes=self.nbytes)
@@ -474,6 +474,9 @@ class CrossAttentionDecoder(nn.Module):
         self.label_type = label_type
         self.count = 0
 
+    def get_cross_attention_processor(self):
+        return self.cross_attn_decoder.attn.attention.attn_processor
+
     def set_cross_attention_processor(self, processor):
         self.cross_attn_decoder.attn.attention.attn_processor = processor
 
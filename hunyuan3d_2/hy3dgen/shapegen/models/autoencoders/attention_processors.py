@@ -32,9 +32,26 @@ class CrossAttentionProcessor:
         return out
 
 
+def gather_cell_tokens(x, index):
+    """Gather the tokens of x (B, H, L, C) at index (B, H, cells, K) into one (B, cells, H, K, C) block per cell."""
+    index = index.unsqueeze(-1).expand(-1, -1, -1, -1, x.shape[-1])
+    x = x.unsqueeze(2).expand(-1, -1, index.shape[2], -1, -1)
+    return torch.gather(x, 3, index).transpose(1, 2)
+
+
 class FlashVDMCrossAttentionProcessor:
-    def __init__(self, topk=None):
+    # every select_stride-th query of a cell votes for the latents the cell attends to
+    select_stride = 50
+    # cells attended in one call are padded to the largest of them, up to this factor of their queries
+    max_padding = 1.25
+
+    def __init__(self, topk=None, packed=False):
         self.topk = topk
+        # opt in to attending groups of cells in padded calls, see cell_attention, instead of one call per cell.
+        # It is slower where it was measured, on CPU, as the padding and gathers cost more than the calls they
+        # save, and is kept for devices where the launch of many small attention calls dominates, to be enabled
+        # once benchmark_flashvdm_cells shows a win there
+        self.packed = packed
 
     def __call__(self, attn, q, k, v):
         if k.shape[-2] == 3072:
@@ -55,23 +72,89 @@ class FlashVDMCrossAttentionProcessor:
             out = scaled_dot_product_attention(q, k0, v0)
         elif self.topk is False:
             out = scaled_dot_product_attention(q, k, v)
+        elif self.packed:
+            out = self.cell_attention(q, k, v, self.topk, topk)
         else:
-            idx, counts = self.topk
-            start = 0
-            outs = []
-            for grid_coord, count in zip(idx, counts):
-                end = start + count
-                q_chunk = q[:, :, start:end, :]
-                k0, v0 = self.select_topkv(q_chunk, k, v, topk)
-                out = scaled_dot_product_attention(q_chunk, k0, v0)
-                outs.append(out)
-                start += count
-            out = torch.cat(outs, dim=-2)
+            out = self.cell_attention_loop(q, k, v, self.topk, topk)
         self.topk = False
         return out
 
+    def cell_attention(self, q, k, v, cell_offsets, topk):
+        """Attend the queries of every cell, laid out at cell_offsets, to the latents selected for that cell,
+        with one attention call per group of similarly sized cells padded to the largest of them."""
+        batch, heads, num_queries, channels = q.shape
+        counts = cell_offsets.diff()
+        num_cells = counts.shape[0]
+        cell = torch.repeat_interleave(torch.arange(num_cells, device=q.device), counts, output_size=num_queries)
+        position = torch.arange(num_queries, device=q.device) - cell_offsets[cell]
+        k0, v0, kv_mask = self.select_cell_topkv(q, k, v, cell, position, num_cells, topk)
+
+        # the padded cells of every group are attended one after the other into out, at base of each cell
+        groups = self.cell_groups(counts)
+        out = q.new_empty(batch, heads, sum(len(group) * max_count for group, max_count in groups), v.shape[-1])
+        base = torch.empty_like(counts)
+        start = 0
+        for group, max_count in groups:
+            group = torch.tensor(group, device=q.device)
+            num_group = group.shape[0]
+            padding = torch.arange(max_count, device=q.device)
+            base[group] = start + max_count * torch.arange(num_group, device=q.device)
+            index = (cell_offsets[group].unsqueeze(-1) + padding).clamp_(max=num_queries - 1)
+            q_cells = q[:, :, index].transpose(1, 2).reshape(-1, heads, max_count, channels)
+            k_cells = k0[:, group].flatten(0, 1)
+            v_cells = v0[:, group].flatten(0, 1)
+            if kv_mask is None:
+                out_cells = scaled_dot_product_attention(q_cells, k_cells, v_cells)
+            else:
+                mask = kv_mask[:, group].expand(batch, -1, -1).reshape(-1, 1, 1, kv_mask.shape[-1])
+                out_cells = scaled_dot_product_attention(q_cells, k_cells, v_cells, attn_mask=mask)
+            out[:, :, start:start + num_group * max_count] = \
+                out_cells.view(batch, num_group, heads, max_count, -1).transpose(1, 2).flatten(2, 3)
+            start += num_group * max_count
+        return out[:, :, base[cell] + position]
+
+    def cell_groups(self, counts):
+        """Group the cells from the largest down while padding them to the largest wastes at most max_padding,
+        returns the cells and padded size of every group."""
+        counts = counts.tolist()
+        groups = []
+        for cell in sorted(range(len(counts)), key=counts.__getitem__, reverse=True):
+            if groups and groups[-1][1] * (len(groups[-1][0]) + 1) <= self.max_padding * (total + counts[cell]):
+                groups[-1][0].append(cell)
+                total += counts[cell]
+            else:
+                groups.append(([cell], counts[cell]))
+                total = counts[cell]
+        return groups
+
+    def select_cell_topkv(self, q, k, v, cell, position, num_cells, topk):
+        """Select the top-k latents of every cell, returns (B, cells, H, topk, C) keys and values and no mask."""
+        voter = position % self.select_stride == 0
+        voter_cell = cell[voter]
+        # the mean score of the voting queries is the score of their mean query
+        q_mean = torch.zeros(*q.shape[:2], num_cells, q.shape[-1], dtype=torch.float32, device=q.device)
+        q_mean.index_add_(2, voter_cell, q[:, :, voter].float())
+        q_mean /= torch.bincount(voter_cell, minlength=num_cells).unsqueeze(-1)
+        sim = q_mean @ k.float().transpose(-1, -2)
+        topk_ind = torch.topk(sim, dim=-1, k=topk).indices
+        return gather_cell_tokens(k, topk_ind), gather_cell_tokens(v, topk_ind), None
+
+    def cell_attention_loop(self, q, k, v, cell_offsets, topk):
+        """One top-k selection and attention call per cell, the default unless the processor is built with
+        `packed=True`."""
+        start = 0
+        outs = []
+        for count in cell_offsets.diff().tolist():
+            end = start + count
+            q_chunk = q[:, :, start:end, :]
+            k0, v0 = self.select_topkv(q_chunk, k, v, topk)
+            out = scaled_dot_product_attention(q_chunk, k0, v0)
+            outs.append(out)
+            start += count
+        return torch.cat(outs, dim=-2)
+
     def select_topkv(self, q_chunk, k, v, topk):
-        q1 = q_chunk[:, :, ::50, :]
+        q1 = q_chunk[:, :, ::self.select_stride, :]
         sim = q1 @ k.transpose(-1, -2)
         sim = torch.mean(sim, -2)
         topk_ind = torch.topk(sim, dim=-1, k=topk).indices.squeeze(-2).unsqueeze(-1)
@@ -82,8 +165,32 @@ class FlashVDMCrossAttentionProcessor:
 
 
 class FlashVDMTopMCrossAttentionProcessor(FlashVDMCrossAttentionProcessor):
+    select_stride = 30
+    # voting queries scored against all latents at once
+    voter_block = 1024
+
+    def select_cell_topkv(self, q, k, v, cell, position, num_cells, topk):
+        """Select every latent some voting query of a cell attends to, returns keys and values padded to the
+        cell with the most latents and the (1, cells, K) mask of the selected ones."""
+        voter = position % self.select_stride == 0
+        voter_cell = cell[voter]
+        q1 = q[:, :, voter]
+        hits = torch.zeros(num_cells, k.shape[-2], dtype=torch.int32, device=q.device)
+        for start in range(0, q1.shape[-2], self.voter_block):
+            sim = q1[:, :, start:start + self.voter_block] @ k.transpose(-1, -2)
+            sim = torch.mean(sim.softmax(-1), 1)
+            hits.index_add_(0, voter_cell[start:start + self.voter_block], (sim > 1e-6).any(0).int())
+        activated = hits > 0
+        kv_counts = activated.sum(-1)
+        # the selected latents first, in latent order
+        index = torch.sort(activated.to(torch.uint8), dim=-1, descending=True, stable=True).indices
+        index = index[:, :int(kv_counts.max())]
+        kv_mask = torch.arange(index.shape[-1], device=q.device) < kv_counts.unsqueeze(-1)
+        index = index.expand(*k.shape[:2], -1, -1)
+        return gather_cell_tokens(k, index), gather_cell_tokens(v, index), kv_mask.unsqueeze(0)
+
     def select_topkv(self, q_chunk, k, v, topk):
-        q1 = q_chunk[:, :, ::30, :]
+        q1 = q_chunk[:, :, ::self.select_stride, :]
         sim = q1 @ k.transpose(-1, -2)
         # sim = sim.to(torch.float32)
         sim = sim.softmax(-1)
@@ -19,8 +19,9 @@ import torch.nn as nn
 import yaml
 
 from .attention_blocks import FourierEmbedder, Transformer, CrossAttentionDecoder
-from .surface_extractors import MCSurfaceExtractor, SurfaceExtractors
-from .volume_decoders import VanillaVolumeDecoder, FlashVDMVolumeDecoding, HierarchicalVolumeDecoding
+from .surface_extractors import MCSurfaceExtractor, SurfaceExtractors, VoxelExtractor
+from .volume_decoders import VanillaVolumeDecoder, FlashVDMVolumeDecoding, HierarchicalVolumeDecoding, \
+    VoxelGridDecoder
 from ...utils import logger, synchronize_timer, smart_load_model
 
 
@@ -101,24 +102,35 @@ class VectsetVAE(nn.Module):
             surface_extractor = MCSurfaceExtractor()
         self.volume_decoder = volume_decoder
         self.surface_extractor = surface_extractor
+        self.voxel_decoder = VoxelGridDecoder()
+        self.voxel_extractor = VoxelExtractor()
 
     def latents2mesh(self, latents: torch.FloatTensor, **kwargs):
         with synchronize_timer('Volume decoding'):
-            grid_logits = self.volume_decoder(latents, self.geo_decoder, **kwargs)
+            sparse_output = getattr(self.surface_extractor, 'sparse_input', False)
+            grid_logits = self.volume_decoder(latents, self.geo_decoder, sparse_output=sparse_output, **kwargs)
         with synchronize_timer('Surface extraction'):
             outputs = self.surface_extractor(grid_logits, **kwargs)
         return outputs
 
+    def latents2voxels(self, latents: torch.FloatTensor, **kwargs):
+        with synchronize_timer('Voxel decoding'):
+            grid_logits = self.voxel_decoder(latents, self.geo_decoder, **kwargs)
+        with synchronize_timer('Voxel extraction'):
+            outputs = self.voxel_extractor(grid_logits, **kwargs)
+        return outputs
+
     def enable_flashvdm_decoder(
         self,
         enabled: bool = True,
         adaptive_kv_selection=True,
         topk_mode='mean',
         mc_algo='dmc',
+        packed=False,
     ):
         if enabled:
             if adaptive_kv_selection:
-                self.volume_decoder = FlashVDMVolumeDecoding(topk_mode)
+                self.volume_decoder = FlashVDMVolumeDecoding(topk_mode, packed=packed)
             else:
                 self.volume_decoder = HierarchicalVolumeDecoding()
             if mc_algo not in SurfaceExtractors.keys():
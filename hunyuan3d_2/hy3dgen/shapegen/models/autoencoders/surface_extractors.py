@@ -12,18 +12,55 @@
 # fine-tuning enabling code and other elements of the foregoing made publicly available
 # by Tencent in accordance with TENCENT HUNYUAN COMMUNITY LICENSE AGREEMENT.
 
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from typing import Union, Tuple, List
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from skimage import measure
 
+from .volume_decoders import SparseGridLogits
+from ...utils import logger
+
+
+class SurfaceExtractionError:
+    """Why the surface of one sample of a batch could not be extracted."""
+
+    def __init__(self, index, exc_type, message, traceback=None):
+        self.index = index
+        self.exc_type = exc_type
+        self.message = message
+        self.traceback = traceback
+
+    @classmethod
+    def from_exception(cls, index, exc):
+        return cls(index, type(exc).__name__, str(exc), ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
+
+    def __repr__(self):
+        return f'SurfaceExtractionError(index={self.index}, {self.exc_type}: {self.message})'
+
 
 class Latent2MeshOutput:
 
-    def __init__(self, mesh_v=None, mesh_f=None):
+    def __init__(self, mesh_v=None, mesh_f=None, error: SurfaceExtractionError = None):
         self.mesh_v = mesh_v
         self.mesh_f = mesh_f
+        self.error = error
+
+
+class Latent2VoxelOutput:
+
+    def __init__(self, occupancy=None, surface=None, bbox_min=None, voxel_size=None):
+        self.occupancy = occupancy
+        self.surface = surface
+        self.bbox_min = bbox_min
+        self.voxel_size = voxel_size
 
 
 def center_vertices(vertices):
@@ -34,7 +71,41 @@ def center_vertices(vertices):
     return vertices - vert_center
 
 
+def drop_nan_faces(vertices, faces):
+    """Drop the faces touching a NaN vertex, left by marching cubes next to undecoded samples, and the vertices
+    no face uses anymore."""
+    faces = faces[~np.isnan(vertices).any(axis=1)[faces].any(axis=1)]
+    used = np.zeros(len(vertices), dtype=bool)
+    used[faces] = True
+    remap = np.cumsum(used) - 1
+    return vertices[used], remap[faces]
+
+
+def clean_mesh(vertices, faces):
+    vertices, faces = drop_nan_faces(vertices, faces)
+    return vertices.astype(np.float32), np.ascontiguousarray(faces)
+
+
+def _extract_shared(extractor, name, shape, dtype, kwargs):
+    """Extract the surface of a grid the parent process left in shared memory."""
+    memory = shared_memory.SharedMemory(name=name)
+    volume = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    try:
+        return clean_mesh(*extractor.run(torch.from_numpy(volume), **kwargs))
+    finally:
+        del volume
+        memory.close()
+
+
 class SurfaceExtractor:
+    # samples of a batch are extracted by this many processes, each reading its grid from shared memory
+    batch_workers = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('executor', None)
+        return state
+
     def _compute_box_stat(self, bounds: Union[Tuple[float], List[float], float], octree_resolution: int):
         if isinstance(bounds, float):
             bounds = [-bounds, -bounds, -bounds, bounds, bounds, bounds]
@@ -48,23 +119,71 @@ class SurfaceExtractor:
         return NotImplementedError
 
     def __call__(self, grid_logits, **kwargs):
+        if self.batch_workers > 1 and isinstance(grid_logits, torch.Tensor) and grid_logits.shape[0] > 1:
+            return self.extract_parallel(grid_logits, **kwargs)
         outputs = []
         for i in range(grid_logits.shape[0]):
             try:
-                vertices, faces = self.run(grid_logits[i], **kwargs)
-                vertices = vertices.astype(np.float32)
-                faces = np.ascontiguousarray(faces)
+                vertices, faces = clean_mesh(*self.run(grid_logits[i], **kwargs))
                 outputs.append(Latent2MeshOutput(mesh_v=vertices, mesh_f=faces))
+            except Exception as exc:
+                outputs.append(self.failed(i, exc))
+
+        return outputs
+
+    @staticmethod
+    def failed(index, exc):
+        error = SurfaceExtractionError.from_exception(index, exc)
+        logger.error(f'Surface extraction of sample {index} failed\n{error.traceback}')
+        return Latent2MeshOutput(error=error)
+
+    def extract_parallel(self, grid_logits, **kwargs):
+        """Extract the samples in batch_workers processes, with at most batch_workers grids copied to shared
+        memory at a time."""
+        if getattr(self, 'executor', None) is None:
+            self.executor = ProcessPoolExecutor(self.batch_workers, mp_context=multiprocessing.get_context('spawn'))
+        outputs = [None] * grid_logits.shape[0]
+        pending = {}
 
-            except Exception:
-                import traceback
-                traceback.print_exc()
-                outputs.append(None)
+        def finish(future):
+            i, memory = pending.pop(future)
+            try:
+                vertices, faces = future.result()
+                outputs[i] = Latent2MeshOutput(mesh_v=vertices, mesh_f=faces)
+            except Exception as exc:
+                if isinstance(exc, BrokenProcessPool):
+                    self.executor = None
+                outputs[i] = self.failed(i, exc)
+            finally:
+                memory.close()
+                memory.unlink()
 
+        try:
+            for i in range(grid_logits.shape[0]):
+                while len(pending) >= self.batch_workers:
+                    for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                        finish(future)
+                grid_logit = grid_logits[i].detach()
+                memory = shared_memory.SharedMemory(create=True, size=grid_logit.numel() * grid_logit.element_size())
+                dtype = torch.empty(0, dtype=grid_logit.dtype).numpy().dtype
+                volume = np.ndarray(tuple(grid_logit.shape), dtype=dtype, buffer=memory.buf)
+                torch.from_numpy(volume).copy_(grid_logit)
+                future = self.executor.submit(_extract_shared, self, memory.name, volume.shape, volume.dtype, kwargs)
+                del volume
+                pending[future] = (i, memory)
+            for future in wait(pending).done:
+                finish(future)
+        finally:
+            for i, memory in pending.values():
+                memory.close()
+                memory.unlink()
         return outputs
 
 
 class MCSurfaceExtractor(SurfaceExtractor):
+    def __init__(self, batch_workers=0):
+        self.batch_workers = batch_workers
+
     def run(self, grid_logit, *, mc_level, bounds, octree_resolution, **kwargs):
         vertices, faces, normals, _ = measure.marching_cubes(
             grid_logit.cpu().numpy(),
@@ -76,6 +195,108 @@ class MCSurfaceExtractor(SurfaceExtractor):
         return vertices, faces
 
 
+def march_block(origin, shape, local_index, values, mc_level):
+    """Run marching cubes over one NaN-padded block and return its vertices in grid coordinates.
+
+    Faces touching a NaN sample are dropped, like the dense path once its mesh is processed by trimesh.
+    """
+    volume = np.full(shape, np.nan, dtype=np.float32)
+    volume[tuple(local_index.T)] = values
+    if not np.nanmin(volume) <= mc_level <= np.nanmax(volume):
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    vertices, faces, _, _ = measure.marching_cubes(volume, mc_level, method="lewiner")
+    vertices, faces = drop_nan_faces(vertices, faces)
+    return vertices + origin, faces
+
+
+def _march_blocks(blocks):
+    return [march_block(*block) for block in blocks]
+
+
+class SparseMCSurfaceExtractor(MCSurfaceExtractor):
+    """Marching cubes over the narrow band kept by the hierarchical volume decoders.
+
+    The grid is split into blocks of `block_size` cells and only blocks holding a decoded sample are marched,
+    across `num_workers` processes. Vertices shared by neighbouring blocks are welded by position, which gives
+    the faces of the dense path once trimesh has dropped its NaN vertices and merged duplicates.
+    """
+    sparse_input = True
+
+    def __init__(self, block_size=32, num_workers=None):
+        self.block_size = block_size
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.executor = None
+
+    def split_blocks(self, index, values, grid_size, mc_level):
+        block_size = self.block_size
+        cells = np.array(grid_size) - 1
+        num_blocks = -(-cells // block_size)
+        # a sample on a block face is also a corner of the cubes of the previous block along that axis
+        home = np.minimum(index // block_size, num_blocks - 1)
+        shared = (index % block_size == 0) & (index > 0) & (index < cells)
+        samples, block_index = [], []
+        for offset in np.ndindex(2, 2, 2):
+            offset = np.array(offset)
+            selected = np.flatnonzero(np.all(shared | (offset == 0), axis=1))
+            samples.append(selected)
+            block_index.append(home[selected] - offset)
+        samples = np.concatenate(samples)
+        block_index = np.concatenate(block_index)
+        block_id = np.ravel_multi_index(tuple(block_index.T), tuple(num_blocks))
+        order = np.argsort(block_id, kind='stable')
+        samples, block_id = samples[order], block_id[order]
+        starts = np.flatnonzero(np.r_[True, block_id[1:] != block_id[:-1]])
+
+        blocks = []
+        for start, stop in zip(starts, np.r_[starts[1:], len(samples)]):
+            block = np.array(np.unravel_index(block_id[start], tuple(num_blocks)))
+            origin = block * block_size
+            shape = tuple(np.minimum(block_size, cells - origin) + 1)
+            selected = samples[start:stop]
+            blocks.append((origin, shape, index[selected] - origin, values[selected], mc_level))
+        return blocks
+
+    def march(self, blocks):
+        if self.num_workers <= 1 or len(blocks) < 2 * self.num_workers:
+            return _march_blocks(blocks)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'))
+        chunk_size = -(-len(blocks) // (4 * self.num_workers))
+        chunks = [blocks[start:start + chunk_size] for start in range(0, len(blocks), chunk_size)]
+        return [result for results in self.executor.map(_march_blocks, chunks) for result in results]
+
+    def run(self, grid_logit, *, mc_level, bounds, octree_resolution, **kwargs):
+        if not isinstance(grid_logit, SparseGridLogits):
+            return super().run(grid_logit, mc_level=mc_level, bounds=bounds, octree_resolution=octree_resolution)
+
+        index = grid_logit.index.cpu().numpy()
+        values = grid_logit.values.float().cpu().numpy()
+        results = self.march(self.split_blocks(index, values, grid_logit.grid_size, mc_level))
+
+        offsets = np.cumsum([0] + [len(vertices) for vertices, _ in results])
+        vertices = np.concatenate([vertices for vertices, _ in results])
+        faces = np.concatenate([faces + offset for (_, faces), offset in zip(results, offsets)])
+
+        # weld the copies of vertices lying on block faces, and the vertices that lewiner repeats on a
+        # sample lying exactly at mc_level
+        cells = np.array(grid_logit.grid_size) - 1
+        on_face = np.any((vertices % self.block_size == 0) & (vertices > 0) & (vertices < cells), axis=1)
+        on_sample = np.all(vertices == np.round(vertices), axis=1)
+        shared = np.flatnonzero(on_face | on_sample)
+        _, first, inverse = np.unique(vertices[shared], axis=0, return_index=True, return_inverse=True)
+        remap = np.arange(len(vertices))
+        remap[shared] = shared[first][inverse.reshape(-1)]
+        keep = np.zeros(len(vertices), dtype=bool)
+        keep[remap] = True
+        compact = np.cumsum(keep) - 1
+        vertices = vertices[keep]
+        faces = compact[remap[faces]]
+
+        grid_size, bbox_min, bbox_size = self._compute_box_stat(bounds, octree_resolution)
+        vertices = vertices / grid_size * bbox_size + bbox_min
+        return vertices, faces
+
+
 class DMCSurfaceExtractor(SurfaceExtractor):
     def run(self, grid_logit, *, octree_resolution, **kwargs):
         device = grid_logit.device
@@ -94,7 +315,47 @@ class DMCSurfaceExtractor(SurfaceExtractor):
         return vertices, faces
 
 
+class VoxelExtractor:
+    """Threshold voxel-center logits into occupancy grids and their one-voxel surface shells.
+
+    `occupancy[i, j, k]` is the voxel centered at `bbox_min + (i + 0.5, j + 0.5, k + 0.5) * voxel_size`,
+    using the same axes as the meshes produced by the surface extractors.
+    """
+
+    @staticmethod
+    def extract_surface_shell(occupancy: torch.Tensor):
+        # a voxel belongs to the shell if any of its 6 neighbours is empty, voxels outside the grid count as empty
+        padded = F.pad(occupancy[None, None].to(torch.uint8), (1, 1, 1, 1, 1, 1)).bool()[0, 0]
+        enclosed = occupancy.clone()
+        enclosed &= padded[2:, 1:-1, 1:-1]
+        enclosed &= padded[:-2, 1:-1, 1:-1]
+        enclosed &= padded[1:-1, 2:, 1:-1]
+        enclosed &= padded[1:-1, :-2, 1:-1]
+        enclosed &= padded[1:-1, 1:-1, 2:]
+        enclosed &= padded[1:-1, 1:-1, :-2]
+        return occupancy & ~enclosed
+
+    def __call__(self, grid_logits, *, mc_level, bounds, voxel_resolution, **kwargs):
+        if isinstance(bounds, float):
+            bounds = [-bounds, -bounds, -bounds, bounds, bounds, bounds]
+        bbox_min, bbox_max = np.array(bounds[0:3]), np.array(bounds[3:6])
+        voxel_size = (bbox_max - bbox_min) / voxel_resolution
+
+        outputs = []
+        for i in range(grid_logits.shape[0]):
+            occupancy = grid_logits[i] > mc_level
+            surface = self.extract_surface_shell(occupancy)
+            outputs.append(Latent2VoxelOutput(
+                occupancy=occupancy.cpu().numpy(),
+                surface=surface.cpu().numpy(),
+                bbox_min=bbox_min,
+                voxel_size=voxel_size,
+            ))
+        return outputs
+
+
 SurfaceExtractors = {
     'mc': MCSurfaceExtractor,
     'dmc': DMCSurfaceExtractor,
+    'sparse_mc': SparseMCSurfaceExtractor,
 }
@@ -12,6 +12,8 @@
 # fine-tuning enabling code and other elements of the foregoing made publicly available
 # by Tencent in accordance with TENCENT HUNYUAN COMMUNITY LICENSE AGREEMENT.
 
+import threading
+from collections import OrderedDict
 from typing import Union, Tuple, List, Callable
 
 import numpy as np
@@ -22,101 +24,76 @@ from einops import repeat
 from tqdm import tqdm
 
 from .attention_blocks import CrossAttentionDecoder
-from .attention_processors import FlashVDMCrossAttentionProcessor, FlashVDMTopMCrossAttentionProcessor
+from .attention_processors import CrossAttentionProcessor, FlashVDMCrossAttentionProcessor, \
+    FlashVDMTopMCrossAttentionProcessor
 from ...utils import logger
 
 
 def extract_near_surface_volume_fn(input_tensor: torch.Tensor, alpha: float):
-    device = input_tensor.device
-    D = input_tensor.shape[0]
-    signed_val = 0.0
-
-    # 添加偏移并处理无效值
-    val = input_tensor + alpha
-    valid_mask = val > -9000  # 假设-9000是无效值
-
-    # 改进的邻居获取函数（保持维度一致）
-    def get_neighbor(t, shift, axis):
-        """根据指定轴进行位移并保持维度一致"""
-        if shift == 0:
-            return t.clone()
-
-        # 确定填充轴（输入为[D, D, D]对应z,y,x轴）
-        pad_dims = [0, 0, 0, 0, 0, 0]  # 格式：[x前，x后，y前，y后，z前，z后]
-
-        # 根据轴类型设置填充
-        if axis == 0:  # x轴（最后一个维度）
-            pad_idx = 0 if shift > 0 else 1
-            pad_dims[pad_idx] = abs(shift)
-        elif axis == 1:  # y轴（中间维度）
-            pad_idx = 2 if shift > 0 else 3
-            pad_dims[pad_idx] = abs(shift)
-        elif axis == 2:  # z轴（第一个维度）
-            pad_idx = 4 if shift > 0 else 5
-            pad_dims[pad_idx] = abs(shift)
-
-        # 执行填充（添加batch和channel维度适配F.pad）
-        padded = F.pad(t.unsqueeze(0).unsqueeze(0), pad_dims[::-1], mode='replicate')  # 反转顺序适配F.pad
-
-        # 构建动态切片索引
-        slice_dims = [slice(None)] * 3  # 初始化为全切片
-        if axis == 0:  # x轴（dim=2）
-            if shift > 0:
-                slice_dims[0] = slice(shift, None)
-            else:
-                slice_dims[0] = slice(None, shift)
-        elif axis == 1:  # y轴（dim=1）
-            if shift > 0:
-                slice_dims[1] = slice(shift, None)
-            else:
-                slice_dims[1] = slice(None, shift)
-        elif axis == 2:  # z轴（dim=0）
-            if shift > 0:
-                slice_dims[2] = slice(shift, None)
-            else:
-                slice_dims[2] = slice(None, shift)
-
-        # 应用切片并恢复维度
-        padded = padded.squeeze(0).squeeze(0)
-        sliced = padded[slice_dims]
-        return sliced
-
-    # 获取各方向邻居（确保维度一致）
-    left = get_neighbor(val, 1, axis=0)  # x方向
-    right = get_neighbor(val, -1, axis=0)
-    back = get_neighbor(val, 1, axis=1)  # y方向
-    front = get_neighbor(val, -1, axis=1)
-    down = get_neighbor(val, 1, axis=2)  # z方向
-    up = get_neighbor(val, -1, axis=2)
-
-    # 处理边界无效值（使用where保持维度一致）
-    def safe_where(neighbor):
-        return torch.where(neighbor > -9000, neighbor, val)
-
-    left = safe_where(left)
-    right = safe_where(right)
-    back = safe_where(back)
-    front = safe_where(front)
-    down = safe_where(down)
-    up = safe_where(up)
-
-    # 计算符号一致性（转换为float32确保精度）
-    sign = torch.sign(val.to(torch.float32))
-    neighbors_sign = torch.stack([
-        torch.sign(left.to(torch.float32)),
-        torch.sign(right.to(torch.float32)),
-        torch.sign(back.to(torch.float32)),
-        torch.sign(front.to(torch.float32)),
-        torch.sign(down.to(torch.float32)),
-        torch.sign(up.to(torch.float32))
-    ], dim=0)
-
-    # 检查所有符号是否一致
-    same_sign = torch.all(neighbors_sign == sign, dim=0)
-
-    # 生成最终掩码
-    mask = (~same_sign).to(torch.int32)
-    return mask * valid_mask.to(torch.int32)
+    """Mark the valid samples whose sign differs from one of their six valid face neighbours.
+
+    Built from one int8 sign grid and boolean slab comparisons instead of padded copies of the grid. Works on the
+    last three dimensions, so a batch of grids is handled in one go.
+    """
+    val = input_tensor + alpha if alpha else input_tensor
+    valid = val > -9000
+    sign = (val > 0).to(torch.int8) - (val < 0).to(torch.int8)
+    del val
+
+    mask = torch.zeros_like(valid)
+    for dim in range(-3, 0):
+        size = sign.shape[dim]
+        # neighbours outside the grid or invalid fall back to the sample itself, so they never differ
+        differ = sign.narrow(dim, 0, size - 1) != sign.narrow(dim, 1, size - 1)
+        mask.narrow(dim, 0, size - 1).logical_or_(differ & valid.narrow(dim, 1, size - 1))
+        mask.narrow(dim, 1, size - 1).logical_or_(differ & valid.narrow(dim, 0, size - 1))
+        del differ
+    mask &= valid
+    return mask
+
+
+def dilate_mask(mask: torch.Tensor):
+    """Boolean 3x3x3 dilation of the last three dimensions, equal to thresholding an all-ones Conv3d with zero
+    padding above 0."""
+    for dim in range(-3, 0):
+        size = mask.shape[dim]
+        dilated = mask.clone()
+        dilated.narrow(dim, 1, size - 1).logical_or_(mask.narrow(dim, 0, size - 1))
+        dilated.narrow(dim, 0, size - 1).logical_or_(mask.narrow(dim, 1, size - 1))
+        mask = dilated
+    return mask
+
+
+class SparseGridLogits:
+    """Logits decoded only at `index` of a dense grid, every other grid sample is NaN.
+
+    `index` is an (N, 3) long tensor into a grid of `grid_size` samples per axis and `values` holds the N logits.
+    A batch packs the samples of every grid one after the other, grid b being `offsets[b]:offsets[b + 1]`;
+    indexing a batch returns the SparseGridLogits of one grid, like the dense `grid_logits[b]`.
+    """
+
+    def __init__(self, index: torch.Tensor, values: torch.Tensor, grid_size, offsets: torch.Tensor = None):
+        self.index = index
+        self.values = values
+        self.grid_size = tuple(int(s) for s in grid_size)
+        self.offsets = offsets
+
+    @property
+    def shape(self):
+        if self.offsets is None:
+            return self.grid_size
+        return (len(self.offsets) - 1, *self.grid_size)
+
+    def __getitem__(self, item):
+        start, stop = self.offsets[item].item(), self.offsets[item + 1].item()
+        return SparseGridLogits(self.index[start:stop], self.values[start:stop], self.grid_size)
+
+    def to_dense(self):
+        if self.offsets is None:
+            dense = torch.full(self.grid_size, float('nan'), dtype=self.values.dtype, device=self.values.device)
+            dense[self.index[:, 0], self.index[:, 1], self.index[:, 2]] = self.values
+            return dense
+        return torch.stack([self[i].to_dense() for i in range(self.shape[0])])
 
 
 def generate_dense_grid_points(
@@ -138,7 +115,159 @@ def generate_dense_grid_points(
     return xyz, grid_size, length
 
 
+def generate_voxel_center_points(
+    bbox_min: np.ndarray,
+    bbox_max: np.ndarray,
+    voxel_resolution: int,
+):
+    voxel_size = (bbox_max - bbox_min) / voxel_resolution
+    offsets = np.arange(voxel_resolution, dtype=np.float32) + 0.5
+    x = (bbox_min[0] + offsets * voxel_size[0]).astype(np.float32)
+    y = (bbox_min[1] + offsets * voxel_size[1]).astype(np.float32)
+    z = (bbox_min[2] + offsets * voxel_size[2]).astype(np.float32)
+    [xs, ys, zs] = np.meshgrid(x, y, z, indexing="ij")
+    xyz = np.stack((xs, ys, zs), axis=-1)
+    grid_size = [voxel_resolution, voxel_resolution, voxel_resolution]
+
+    return xyz, grid_size, voxel_size
+
+
+class QueryGridCache:
+    """LRU cache of the device-resident query grids built by the volume decoders.
+
+    Entries are keyed by everything they are built from and the least recently used ones are evicted once
+    their tensors take more than `max_bytes`. `hits` and `misses` count lookups since the last `clear`.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build: Callable):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+        value = build()
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return value
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.nbytes}
+
+
+query_grid_cache = QueryGridCache()
+
+
+def _bounds_key(bbox_min, bbox_max):
+    return tuple(float(v) for v in bbox_min) + tuple(float(v) for v in bbox_max)
+
+
+def cached_dense_grid_points(cache, bbox_min, bbox_max, octree_resolution, device, dtype):
+    """Return the flattened `generate_dense_grid_points` queries as a tensor on `device`, and the grid size."""
+    def build():
+        xyz_samples, _, _ = generate_dense_grid_points(bbox_min, bbox_max, octree_resolution, indexing="ij")
+        return torch.from_numpy(xyz_samples).to(device, dtype=dtype).contiguous().reshape(-1, 3)
+
+    key = ('dense', _bounds_key(bbox_min, bbox_max), int(octree_resolution), str(device), dtype)
+    return cache.get(key, build), [int(octree_resolution) + 1] * 3
+
+
+def cached_mini_grid_points(cache, bbox_min, bbox_max, octree_resolution, mini_grid_num, device, dtype):
+    """Return the dense queries regrouped into `mini_grid_num`^3 contiguous mini grids, and the grid size."""
+    def build():
+        xyz_samples, _, _ = generate_dense_grid_points(bbox_min, bbox_max, octree_resolution, indexing="ij")
+        xyz_samples = torch.from_numpy(xyz_samples).to(device, dtype=dtype)
+        mini_grid_size = xyz_samples.shape[0] // mini_grid_num
+        return xyz_samples.view(
+            mini_grid_num, mini_grid_size,
+            mini_grid_num, mini_grid_size,
+            mini_grid_num, mini_grid_size, 3
+        ).permute(
+            0, 2, 4, 1, 3, 5, 6
+        ).reshape(
+            -1, mini_grid_size * mini_grid_size * mini_grid_size, 3
+        )
+
+    key = ('mini_grid', _bounds_key(bbox_min, bbox_max), int(octree_resolution), mini_grid_num, str(device), dtype)
+    return cache.get(key, build), [int(octree_resolution) + 1] * 3
+
+
+def cached_voxel_center_points(cache, bbox_min, bbox_max, voxel_resolution, device, dtype):
+    """Return the flattened `generate_voxel_center_points` queries as a tensor on `device`, and the grid size."""
+    def build():
+        xyz_samples, _, _ = generate_voxel_center_points(bbox_min, bbox_max, voxel_resolution)
+        return torch.from_numpy(xyz_samples).to(device, dtype=dtype).contiguous().reshape(-1, 3)
+
+    key = ('voxel_centers', _bounds_key(bbox_min, bbox_max), int(voxel_resolution), str(device), dtype)
+    return cache.get(key, build), [int(voxel_resolution)] * 3
+
+
+def estimate_query_bytes(geo_decoder: Callable, latents: torch.FloatTensor):
+    """Rough upper bound of the activation memory one query point takes in a `CrossAttentionDecoder` call.
+
+    Counts the query-side activations of the cross attention block and one materialised attention row over the
+    latents, which is what the non-fused attention kernels allocate.
+    """
+    block = getattr(geo_decoder, 'cross_attn_decoder', None)
+    if block is None:
+        return 64 * 1024
+    width = block.attn.width
+    hidden = block.mlp.c_fc.out_features
+    elements = 8 * width + hidden + block.attn.heads * latents.shape[1]
+    return elements * latents.element_size() * latents.shape[0]
+
+
+def budget_num_chunks(memory_budget: int, num_chunks: int, query_bytes: int, reserved_bytes: int = 0,
+                      min_chunks: int = 1024):
+    """Return the number of queries per decoder call that fits `memory_budget` bytes next to `reserved_bytes`,
+    or `num_chunks` when no budget is given."""
+    if memory_budget is None:
+        return num_chunks
+    return max(int((memory_budget - reserved_bytes) // query_bytes), min_chunks)
+
+
+def octree_resolution_for_voxels(octree_resolution: int, voxel_resolution: int, min_resolution: int = 63,
+                                 cells_per_voxel: int = 2):
+    """Return the coarsest refinement level of `octree_resolution` that still has `cells_per_voxel` cells per voxel
+    of a `voxel_resolution`^3 grid.
+
+    The hierarchical decoders halve `octree_resolution` down to `min_resolution`, so decoding at the returned
+    resolution runs the same levels and stops early.
+    """
+    target = voxel_resolution * cells_per_voxel
+    while octree_resolution // 2 >= max(min_resolution, target):
+        octree_resolution //= 2
+    return octree_resolution
+
+
 class VanillaVolumeDecoder:
+    def __init__(self, cache: QueryGridCache = None):
+        self.cache = cache if cache is not None else query_grid_cache
+
     @torch.no_grad()
     def __call__(
         self,
@@ -148,24 +277,21 @@ class VanillaVolumeDecoder:
         num_chunks: int = 10000,
         octree_resolution: int = None,
         enable_pbar: bool = True,
+        memory_budget: int = None,
         **kwargs,
     ):
         device = latents.device
         dtype = latents.dtype
         batch_size = latents.shape[0]
+        num_chunks = budget_num_chunks(memory_budget, num_chunks, estimate_query_bytes(geo_decoder, latents))
 
         # 1. generate query points
         if isinstance(bounds, float):
             bounds = [-bounds, -bounds, -bounds, bounds, bounds, bounds]
 
         bbox_min, bbox_max = np.array(bounds[0:3]), np.array(bounds[3:6])
-        xyz_samples, grid_size, length = generate_dense_grid_points(
-            bbox_min=bbox_min,
-            bbox_max=bbox_max,
-            octree_resolution=octree_resolution,
-            indexing="ij"
-        )
-        xyz_samples = torch.from_numpy(xyz_samples).to(device, dtype=dtype).contiguous().reshape(-1, 3)
+        xyz_samples, grid_size = cached_dense_grid_points(
+            self.cache, bbox_min, bbox_max, octree_resolution, device, dtype)
 
         # 2. latents to 3d volume
         batch_logits = []
@@ -182,7 +308,66 @@ class VanillaVolumeDecoder:
         return grid_logits
 
 
+class VoxelGridDecoder:
+    """Decode logits at the centers of a `voxel_resolution`^3 grid spanning `bounds`."""
+
+    def __init__(self, cache: QueryGridCache = None):
+        self.cache = cache if cache is not None else query_grid_cache
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        latents: torch.FloatTensor,
+        geo_decoder: CrossAttentionDecoder,
+        bounds: Union[Tuple[float], List[float], float] = 1.01,
+        num_chunks: int = 10000,
+        voxel_resolution: int = None,
+        enable_pbar: bool = True,
+        memory_budget: int = None,
+        **kwargs,
+    ):
+        # adaptive kv selection from FlashVDM is only valid on the octree grids, the processor the octree decoders
+        # set is restored for their next call
+        processor = geo_decoder.get_cross_attention_processor()
+        geo_decoder.set_cross_attention_processor(CrossAttentionProcessor())
+        try:
+            return self.decode(latents, geo_decoder, bounds, num_chunks, voxel_resolution, enable_pbar, memory_budget)
+        finally:
+            geo_decoder.set_cross_attention_processor(processor)
+
+    def decode(self, latents, geo_decoder, bounds, num_chunks, voxel_resolution, enable_pbar, memory_budget):
+        device = latents.device
+        dtype = latents.dtype
+        batch_size = latents.shape[0]
+        num_chunks = budget_num_chunks(memory_budget, num_chunks, estimate_query_bytes(geo_decoder, latents))
+
+        # 1. generate query points
+        if isinstance(bounds, float):
+            bounds = [-bounds, -bounds, -bounds, bounds, bounds, bounds]
+
+        bbox_min, bbox_max = np.array(bounds[0:3]), np.array(bounds[3:6])
+        xyz_samples, grid_size = cached_voxel_center_points(
+            self.cache, bbox_min, bbox_max, voxel_resolution, device, dtype)
+
+        # 2. latents to voxel logits
+        batch_logits = []
+        for start in tqdm(range(0, xyz_samples.shape[0], num_chunks), desc=f"Voxel Decoding [r{voxel_resolution}]",
+                          disable=not enable_pbar):
+            chunk_queries = xyz_samples[start: start + num_chunks, :]
+            chunk_queries = repeat(chunk_queries, "p c -> b p c", b=batch_size)
+            logits = geo_decoder(queries=chunk_queries, latents=latents)
+            batch_logits.append(logits)
+
+        grid_logits = torch.cat(batch_logits, dim=1)
+        grid_logits = grid_logits.view((batch_size, *grid_size)).float()
+
+        return grid_logits
+
+
 class HierarchicalVolumeDecoding:
+    def __init__(self, cache: QueryGridCache = None):
+        self.cache = cache if cache is not None else query_grid_cache
+
     @torch.no_grad()
     def __call__(
         self,
@@ -194,6 +379,8 @@ class HierarchicalVolumeDecoding:
         octree_resolution: int = None,
         min_resolution: int = 63,
         enable_pbar: bool = True,
+        sparse_output: bool = False,
+        memory_budget: int = None,
         **kwargs,
     ):
         device = latents.device
@@ -214,25 +401,18 @@ class HierarchicalVolumeDecoding:
         bbox_max = np.array(bounds[3:6])
         bbox_size = bbox_max - bbox_min
 
-        xyz_samples, grid_size, length = generate_dense_grid_points(
-            bbox_min=bbox_min,
-            bbox_max=bbox_max,
-            octree_resolution=resolutions[0],
-            indexing="ij"
-        )
-
-        dilate = nn.Conv3d(1, 1, 3, padding=1, bias=False, device=device, dtype=dtype)
-        dilate.weight = torch.nn.Parameter(torch.ones(dilate.weight.shape, dtype=dtype, device=device))
-
+        xyz_samples, grid_size = cached_dense_grid_points(
+            self.cache, bbox_min, bbox_max, resolutions[0], device, dtype)
         grid_size = np.array(grid_size)
-        xyz_samples = torch.from_numpy(xyz_samples).to(device, dtype=dtype).contiguous().reshape(-1, 3)
 
         # 2. latents to 3d volume
+        query_bytes = estimate_query_bytes(geo_decoder, latents)
+        level_chunks = budget_num_chunks(memory_budget, num_chunks, query_bytes)
         batch_logits = []
         batch_size = latents.shape[0]
-        for start in tqdm(range(0, xyz_samples.shape[0], num_chunks),
+        for start in tqdm(range(0, xyz_samples.shape[0], level_chunks),
                           desc=f"Hierarchical Volume Decoding [r{resolutions[0] + 1}]"):
-            queries = xyz_samples[start: start + num_chunks, :]
+            queries = xyz_samples[start: start + level_chunks, :]
             batch_queries = repeat(queries, "p c -> b p c", b=batch_size)
             logits = geo_decoder(queries=batch_queries, latents=latents)
             batch_logits.append(logits)
@@ -242,34 +422,44 @@ class HierarchicalVolumeDecoding:
         for octree_depth_now in resolutions[1:]:
             grid_size = np.array([octree_depth_now + 1] * 3)
             resolution = bbox_size / octree_depth_now
-            next_index = torch.zeros(tuple(grid_size), dtype=dtype, device=device)
+            next_index = torch.zeros(tuple(grid_size), dtype=torch.bool, device=device)
             next_logits = torch.full(next_index.shape, -10000., dtype=dtype, device=device)
             curr_points = extract_near_surface_volume_fn(grid_logits.squeeze(0), mc_level)
-            curr_points += grid_logits.squeeze(0).abs() < 0.95
+            curr_points |= (grid_logits.squeeze(0) > -0.95) & (grid_logits.squeeze(0) < 0.95)
 
             if octree_depth_now == resolutions[-1]:
                 expand_num = 0
             else:
                 expand_num = 1
             for i in range(expand_num):
-                curr_points = dilate(curr_points.unsqueeze(0).to(dtype)).squeeze(0)
-            (cidx_x, cidx_y, cidx_z) = torch.where(curr_points > 0)
-            next_index[cidx_x * 2, cidx_y * 2, cidx_z * 2] = 1
+                curr_points = dilate_mask(curr_points)
+            (cidx_x, cidx_y, cidx_z) = torch.where(curr_points)
+            next_index[cidx_x * 2, cidx_y * 2, cidx_z * 2] = True
             for i in range(2 - expand_num):
-                next_index = dilate(next_index.unsqueeze(0)).squeeze(0)
-            nidx = torch.where(next_index > 0)
+                next_index = dilate_mask(next_index)
+            nidx = torch.where(next_index)
+            # the dense logits of the level and the band coordinates stay allocated while the band is decoded
+            band_size = nidx[0].shape[0]
+            level_chunks = budget_num_chunks(memory_budget, num_chunks, query_bytes,
+                                             reserved_bytes=next_logits.numel() * next_logits.element_size() +
+                                             band_size * 3 * 16)
+            logger.debug(f"[r{octree_depth_now + 1}] decoding a band of {band_size} points, "
+                         f"{level_chunks} per chunk")
 
             next_points = torch.stack(nidx, dim=1)
             next_points = (next_points * torch.tensor(resolution, dtype=next_points.dtype, device=device) +
                            torch.tensor(bbox_min, dtype=next_points.dtype, device=device))
             batch_logits = []
-            for start in tqdm(range(0, next_points.shape[0], num_chunks),
+            for start in tqdm(range(0, next_points.shape[0], level_chunks),
                               desc=f"Hierarchical Volume Decoding [r{octree_depth_now + 1}]"):
-                queries = next_points[start: start + num_chunks, :]
+                queries = next_points[start: start + level_chunks, :]
                 batch_queries = repeat(queries, "p c -> b p c", b=batch_size)
                 logits = geo_decoder(queries=batch_queries.to(latents.dtype), latents=latents)
                 batch_logits.append(logits)
             grid_logits = torch.cat(batch_logits, dim=1)
+            if sparse_output and octree_depth_now == resolutions[-1]:
+                offsets = torch.tensor([0, grid_logits.shape[1]], device=device)
+                return SparseGridLogits(torch.stack(nidx, dim=1), grid_logits[0, ..., 0], grid_size, offsets=offsets)
             next_logits[nidx] = grid_logits[0, ..., 0]
             grid_logits = next_logits.unsqueeze(0)
         grid_logits[grid_logits == -10000.] = float('nan')
@@ -278,14 +468,15 @@ class HierarchicalVolumeDecoding:
 
 
 class FlashVDMVolumeDecoding:
-    def __init__(self, topk_mode='mean'):
+    def __init__(self, topk_mode='mean', cache: QueryGridCache = None, packed: bool = False):
+        self.cache = cache if cache is not None else query_grid_cache
         if topk_mode not in ['mean', 'merge']:
             raise ValueError(f'Unsupported topk_mode {topk_mode}, available: {["mean", "merge"]}')
 
         if topk_mode == 'mean':
-            self.processor = FlashVDMCrossAttentionProcessor()
+            self.processor = FlashVDMCrossAttentionProcessor(packed=packed)
         else:
-            self.processor = FlashVDMTopMCrossAttentionProcessor()
+            self.processor = FlashVDMTopMCrossAttentionProcessor(packed=packed)
 
     @torch.no_grad()
     def __call__(
@@ -299,6 +490,8 @@ class FlashVDMVolumeDecoding:
         min_resolution: int = 63,
         mini_grid_num: int = 4,
         enable_pbar: bool = True,
+        sparse_output: bool = False,
+        memory_budget: int = None,
         **kwargs,
     ):
         processor = self.processor
@@ -327,108 +520,109 @@ class FlashVDMVolumeDecoding:
         bbox_max = np.array(bounds[3:6])
         bbox_size = bbox_max - bbox_min
 
-        xyz_samples, grid_size, length = generate_dense_grid_points(
-            bbox_min=bbox_min,
-            bbox_max=bbox_max,
-            octree_resolution=resolutions[0],
-            indexing="ij"
-        )
-
-        dilate = nn.Conv3d(1, 1, 3, padding=1, bias=False, device=device, dtype=dtype)
-        dilate.weight = torch.nn.Parameter(torch.ones(dilate.weight.shape, dtype=dtype, device=device))
-
+        xyz_samples, grid_size = cached_mini_grid_points(
+            self.cache, bbox_min, bbox_max, resolutions[0], mini_grid_num, device, dtype)
         grid_size = np.array(grid_size)
 
         # 2. latents to 3d volume
-        xyz_samples = torch.from_numpy(xyz_samples).to(device, dtype=dtype)
         batch_size = latents.shape[0]
-        mini_grid_size = xyz_samples.shape[0] // mini_grid_num
-        xyz_samples = xyz_samples.view(
-            mini_grid_num, mini_grid_size,
-            mini_grid_num, mini_grid_size,
-            mini_grid_num, mini_grid_size, 3
-        ).permute(
-            0, 2, 4, 1, 3, 5, 6
-        ).reshape(
-            -1, mini_grid_size * mini_grid_size * mini_grid_size, 3
-        )
+        mini_grid_size = int(grid_size[0]) // mini_grid_num
+        query_bytes = estimate_query_bytes(geo_decoder, latents[:1])
+        level_chunks = budget_num_chunks(memory_budget, num_chunks, query_bytes)
         batch_logits = []
-        num_batchs = max(num_chunks // xyz_samples.shape[1], 1)
+        # every call decodes the same mini grids of all samples, each selecting top-k latents of its own sample
+        num_batchs = max(level_chunks // (xyz_samples.shape[1] * batch_size), 1)
         for start in tqdm(range(0, xyz_samples.shape[0], num_batchs),
                           desc=f"FlashVDM Volume Decoding", disable=not enable_pbar):
             queries = xyz_samples[start: start + num_batchs, :]
             batch = queries.shape[0]
-            batch_latents = repeat(latents.squeeze(0), "p c -> b p c", b=batch)
+            batch_queries = repeat(queries, "n p c -> (b n) p c", b=batch_size)
+            batch_latents = repeat(latents, "b p c -> (b n) p c", n=batch)
             processor.topk = True
-            logits = geo_decoder(queries=queries, latents=batch_latents)
-            batch_logits.append(logits)
-        grid_logits = torch.cat(batch_logits, dim=0).reshape(
+            logits = geo_decoder(queries=batch_queries, latents=batch_latents)
+            batch_logits.append(logits.view(batch_size, batch, -1))
+        grid_logits = torch.cat(batch_logits, dim=1).reshape(
+            batch_size,
             mini_grid_num, mini_grid_num, mini_grid_num,
             mini_grid_size, mini_grid_size,
             mini_grid_size
-        ).permute(0, 3, 1, 4, 2, 5).contiguous().view(
+        ).permute(0, 1, 4, 2, 5, 3, 6).contiguous().view(
             (batch_size, grid_size[0], grid_size[1], grid_size[2])
         )
 
         for octree_depth_now in resolutions[1:]:
             grid_size = np.array([octree_depth_now + 1] * 3)
             resolution = bbox_size / octree_depth_now
-            next_index = torch.zeros(tuple(grid_size), dtype=dtype, device=device)
+            next_index = torch.zeros((batch_size, *grid_size), dtype=torch.bool, device=device)
             next_logits = torch.full(next_index.shape, -10000., dtype=dtype, device=device)
-            curr_points = extract_near_surface_volume_fn(grid_logits.squeeze(0), mc_level)
-            curr_points += grid_logits.squeeze(0).abs() < 0.95
+            curr_points = extract_near_surface_volume_fn(grid_logits, mc_level)
+            curr_points |= (grid_logits > -0.95) & (grid_logits < 0.95)
 
             if octree_depth_now == resolutions[-1]:
                 expand_num = 0
             else:
                 expand_num = 1
             for i in range(expand_num):
-                curr_points = dilate(curr_points.unsqueeze(0).to(dtype)).squeeze(0)
-            (cidx_x, cidx_y, cidx_z) = torch.where(curr_points > 0)
+                curr_points = dilate_mask(curr_points)
+            (cidx_b, cidx_x, cidx_y, cidx_z) = torch.where(curr_points)
 
-            next_index[cidx_x * 2, cidx_y * 2, cidx_z * 2] = 1
+            next_index[cidx_b, cidx_x * 2, cidx_y * 2, cidx_z * 2] = True
             for i in range(2 - expand_num):
-                next_index = dilate(next_index.unsqueeze(0)).squeeze(0)
-            nidx = torch.where(next_index > 0)
-
-            next_points = torch.stack(nidx, dim=1)
+                next_index = dilate_mask(next_index)
+            # the bands of all samples packed one after the other, sample b at offsets[b]:offsets[b + 1]
+            nidx = torch.where(next_index)
+            sample = nidx[0]
+            offsets = torch.cumsum(torch.bincount(sample, minlength=batch_size), 0)
+            offsets = torch.cat([offsets.new_zeros(1), offsets])
+            # the dense logits of the level and the band coordinates stay allocated while the band is decoded
+            band_size = sample.shape[0]
+            level_chunks = budget_num_chunks(memory_budget, num_chunks, query_bytes,
+                                             reserved_bytes=next_logits.numel() * next_logits.element_size() +
+                                             band_size * 4 * 16)
+            logger.debug(f"[r{octree_depth_now + 1}] decoding bands of {offsets.diff().tolist()} points, "
+                         f"{level_chunks} per chunk")
+
+            next_points = torch.stack(nidx[1:], dim=1)
             next_points = (next_points * torch.tensor(resolution, dtype=torch.float32, device=device) +
                            torch.tensor(bbox_min, dtype=torch.float32, device=device))
 
+            # group the queries of each sample by cell of a query_grid_num^3 grid over its own band, a chunk
+            # only holds cells of one sample so that it selects the top-k latents of that sample
             query_grid_num = 6
-            min_val = next_points.min(axis=0).values
-            max_val = next_points.max(axis=0).values
+            per_sample = sample[:, None].expand(-1, 3)
+            min_val = next_points.new_full((batch_size, 3), float('inf')).scatter_reduce(
+                0, per_sample, next_points, 'amin', include_self=False)[sample]
+            max_val = next_points.new_full((batch_size, 3), float('-inf')).scatter_reduce(
+                0, per_sample, next_points, 'amax', include_self=False)[sample]
             vol_queries_index = (next_points - min_val) / (max_val - min_val) * (query_grid_num - 0.001)
             index = torch.floor(vol_queries_index).long()
             index = index[..., 0] * (query_grid_num ** 2) + index[..., 1] * query_grid_num + index[..., 2]
-            index = index.sort()
+            index = (sample * query_grid_num ** 3 + index).sort()
             next_points = next_points[index.indices].unsqueeze(0).contiguous()
-            unique_values = torch.unique(index.values, return_counts=True)
+            # cells and chunks are laid out on device: a chunk takes the cells of one sample that start within
+            # the same level_chunks span of its band, so it overshoots level_chunks by less than one cell
+            cell_key, cell_counts = torch.unique_consecutive(index.values, return_counts=True)
+            cell_offsets = torch.cat([cell_counts.new_zeros(1), torch.cumsum(cell_counts, 0)])
+            cell_sample = torch.div(cell_key, query_grid_num ** 3, rounding_mode='floor')
+            cell_span = torch.div(cell_offsets[:-1] - offsets[cell_sample], level_chunks, rounding_mode='floor')
+            chunk_key = cell_sample * (band_size + 1) + cell_span
+            chunk_cells = torch.searchsorted(chunk_key, torch.unique_consecutive(chunk_key))
+            chunk_cells = torch.cat([chunk_cells, chunk_cells.new_full((1,), cell_key.shape[0])])
+            schedule = torch.stack([chunk_cells[:-1], chunk_cells[1:], cell_offsets[chunk_cells[:-1]],
+                                    cell_offsets[chunk_cells[1:]], cell_sample[chunk_cells[:-1]]], dim=1)
             grid_logits = torch.zeros((next_points.shape[1]), dtype=latents.dtype, device=latents.device)
-            input_grid = [[], []]
             logits_grid_list = []
-            start_num = 0
-            sum_num = 0
-            for grid_index, count in zip(unique_values[0].cpu().tolist(), unique_values[1].cpu().tolist()):
-                if sum_num + count < num_chunks or sum_num == 0:
-                    sum_num += count
-                    input_grid[0].append(grid_index)
-                    input_grid[1].append(count)
-                else:
-                    processor.topk = input_grid
-                    logits_grid = geo_decoder(queries=next_points[:, start_num:start_num + sum_num], latents=latents)
-                    start_num = start_num + sum_num
-                    logits_grid_list.append(logits_grid)
-                    input_grid = [[grid_index], [count]]
-                    sum_num = count
-            if sum_num > 0:
-                processor.topk = input_grid
-                logits_grid = geo_decoder(queries=next_points[:, start_num:start_num + sum_num], latents=latents)
+            for first_cell, last_cell, start_num, end_num, chunk_sample in schedule.tolist():
+                processor.topk = cell_offsets[first_cell:last_cell + 1] - start_num
+                logits_grid = geo_decoder(queries=next_points[:, start_num:end_num],
+                                          latents=latents[chunk_sample:chunk_sample + 1])
                 logits_grid_list.append(logits_grid)
             logits_grid = torch.cat(logits_grid_list, dim=1)
             grid_logits[index.indices] = logits_grid.squeeze(0).squeeze(-1)
+            if sparse_output and octree_depth_now == resolutions[-1]:
+                return SparseGridLogits(torch.stack(nidx[1:], dim=1), grid_logits, grid_size, offsets=offsets)
             next_logits[nidx] = grid_logits
-            grid_logits = next_logits.unsqueeze(0)
+            grid_logits = next_logits
 
         grid_logits[grid_logits == -10000.] = float('nan')
 
@@ -186,6 +186,10 @@ class DoubleStreamBlock(nn.Module):
             nn.Linear(mlp_hidden_dim, hidden_size, bias=True),
         )
 
+    def modulated_input(self, img: Tensor, vec: Tensor) -> Tensor:
+        img_mod1, _ = self.img_mod(vec)
+        return (1 + img_mod1.scale) * self.img_norm1(img) + img_mod1.shift
+
     def forward(self, img: Tensor, txt: Tensor, vec: Tensor, pe: Tensor) -> Tuple[Tensor, Tensor]:
         img_mod1, img_mod2 = self.img_mod(vec)
         txt_mod1, txt_mod2 = self.txt_mod(vec)
@@ -251,6 +255,10 @@ class SingleStreamBlock(nn.Module):
         self.mlp_act = GELU(approximate="tanh")
         self.modulation = Modulation(hidden_size, double=False)
 
+    def modulated_input(self, x: Tensor, vec: Tensor) -> Tensor:
+        mod, _ = self.modulation(vec)
+        return (1 + mod.scale) * self.pre_norm(x) + mod.shift
+
     def forward(self, x: Tensor, vec: Tensor, pe: Tensor) -> Tensor:
         mod, _ = self.modulation(vec)
 
@@ -281,6 +289,71 @@ class LastLayer(nn.Module):
         return x
 
 
+@dataclass(frozen=True)
+class BlockCachePolicy:
+    """
+    Which block ranges of a Hunyuan3DDiT may reuse their residual from an earlier diffusion step, as in FORA and
+    DeepCache.
+
+    A range is skipped, adding its residual from the last step that computed it, while the modulated input of its
+    first block differs from the one of that step by less than `threshold` in mean absolute value relative to it,
+    for at most `max_reuse` steps in a row. The first `warmup` steps are always computed.
+
+    Args:
+        single_blocks: `(start, end)` index ranges into `single_blocks`, `end` None meaning the last block
+        double_blocks: `(start, end)` index ranges into `double_blocks`
+        threshold: relative change of the modulated input up to which a range is skipped
+        max_reuse: number of consecutive steps a residual may be reused
+        warmup: number of first steps always computed
+    """
+    single_blocks: Tuple[Tuple[int, Optional[int]], ...] = ((0, None),)
+    double_blocks: Tuple[Tuple[int, Optional[int]], ...] = ()
+    threshold: float = 0.1
+    max_reuse: int = 2
+    warmup: int = 3
+
+
+@dataclass
+class _CachedResidual:
+    probe: Tensor
+    residuals: Tuple[Tensor, ...]
+    reused: int = 0
+
+
+class BlockCache:
+    """The residuals of one diffusion under a BlockCachePolicy, and the number of blocks skipped per step."""
+
+    def __init__(self, policy: BlockCachePolicy):
+        self.policy = policy
+        self.entries = {}
+        self.skipped = []
+        self.total = []
+
+    def next_step(self):
+        self.skipped.append(0)
+        self.total.append(0)
+
+    def ranges(self, kind: str, num_blocks: int):
+        ranges = self.policy.single_blocks if kind == 'single' else self.policy.double_blocks
+        return {start: num_blocks if end is None else end for start, end in ranges}
+
+    def lookup(self, key, probe: Tensor, num_blocks: int):
+        entry = self.entries.get(key)
+        if entry is None or len(self.skipped) <= self.policy.warmup or entry.probe.shape != probe.shape \
+                or entry.reused >= self.policy.max_reuse:
+            return None
+        change = (probe - entry.probe).abs().mean() / entry.probe.abs().mean().clamp_min(1e-12)
+        # written so that a non-finite change, e.g. from a non-finite probe, misses
+        if not change.item() <= self.policy.threshold:
+            return None
+        entry.reused += 1
+        self.skipped[-1] += num_blocks
+        return entry.residuals
+
+    def store(self, key, probe: Tensor, residuals: Tuple[Tensor, ...]):
+        self.entries[key] = _CachedResidual(probe, residuals)
+
+
 class Hunyuan3DDiT(nn.Module):
     def __init__(
         self,
@@ -398,13 +471,49 @@ class Hunyuan3DDiT(nn.Module):
         cond = self.cond_in(cond)
         pe = None
 
-        for block in self.double_blocks:
-            latent, cond = block(img=latent, txt=cond, vec=vec, pe=pe)
-
-        latent = torch.cat((cond, latent), 1)
-        for block in self.single_blocks:
-            latent = block(latent, vec=vec, pe=pe)
+        block_cache = kwargs.get('block_cache', None)
+        if block_cache is None:
+            for block in self.double_blocks:
+                latent, cond = block(img=latent, txt=cond, vec=vec, pe=pe)
+
+            latent = torch.cat((cond, latent), 1)
+            for block in self.single_blocks:
+                latent = block(latent, vec=vec, pe=pe)
+        else:
+            block_cache.next_step()
+            latent, cond = self.forward_cached_blocks(
+                'double', self.double_blocks, (latent, cond), vec, block_cache,
+                lambda block, streams: block(img=streams[0], txt=streams[1], vec=vec, pe=pe),
+            )
+            latent = torch.cat((cond, latent), 1)
+            latent, = self.forward_cached_blocks(
+                'single', self.single_blocks, (latent,), vec, block_cache,
+                lambda block, streams: (block(streams[0], vec=vec, pe=pe),),
+            )
 
         latent = latent[:, cond.shape[1]:, ...]
         latent = self.final_layer(latent, vec)
         return latent
+
+    def forward_cached_blocks(self, kind, blocks, streams, vec, block_cache, run_block):
+        ranges = block_cache.ranges(kind, len(blocks))
+        i = 0
+        while i < len(blocks):
+            end = ranges.get(i)
+            if end is None:
+                streams = run_block(blocks[i], streams)
+                block_cache.total[-1] += 1
+                i += 1
+                continue
+            probe = blocks[i].modulated_input(streams[0], vec)
+            residuals = block_cache.lookup((kind, i), probe, end - i)
+            if residuals is None:
+                inputs = streams
+                for block in blocks[i:end]:
+                    streams = run_block(block, streams)
+                block_cache.store((kind, i), probe, tuple(out - x for out, x in zip(streams, inputs)))
+            else:
+                streams = tuple(x + residual for x, residual in zip(streams, residuals))
+            block_cache.total[-1] += end - i
+            i = end
+        return streams
@@ -28,7 +28,10 @@ from diffusers.utils.import_utils import is_accelerate_version, is_accelerate_av
 from tqdm import tqdm
 
 from .models.autoencoders import ShapeVAE
-from .models.autoencoders import SurfaceExtractors
+from .models.autoencoders import SurfaceExtractors, octree_resolution_for_voxels
+from .models.denoisers import BlockCache, BlockCachePolicy
+from .schedulers import ConsistencyFlowMatchEulerDiscreteScheduler
+from .latent_cache import LatentCache, CondCache, hash_inputs
 from .utils import logger, synchronize_timer, smart_load_model
 
 
@@ -91,12 +94,47 @@ def retrieve_timesteps(
     return timesteps, num_inference_steps
 
 
+def guidance_steps(num_inference_steps, guidance_interval=None):
+    """Which steps apply classifier-free guidance.
+
+    `guidance_interval` is a `(start, end)` range of the steps as fractions of `num_inference_steps`, step 0 being
+    pure noise; None guides every step.
+    """
+    if guidance_interval is None:
+        return [True] * num_inference_steps
+    start, end = guidance_interval
+    return [start <= i / num_inference_steps < end for i in range(num_inference_steps)]
+
+
+def slice_cond(cond, batch_size):
+    """The first `batch_size` samples of a nested conditioning dict, e.g. its conditional half."""
+    if isinstance(cond, torch.Tensor):
+        return cond[:batch_size]
+    return {k: slice_cond(v, batch_size) for k, v in cond.items()}
+
+
+def select_samples(inputs, index):
+    """The samples at the positions `index` of nested dicts of batched tensors and per-sample lists."""
+    if isinstance(inputs, torch.Tensor):
+        return inputs[index]
+    if isinstance(inputs, dict):
+        return {k: select_samples(v, index) for k, v in inputs.items()}
+    return [inputs[i] for i in index]
+
+
+def cat_samples(samples):
+    """Concatenate nested dicts of batched tensors along the batch."""
+    if isinstance(samples[0], torch.Tensor):
+        return torch.cat(samples)
+    return {k: cat_samples([sample[k] for sample in samples]) for k in samples[0]}
+
+
 @synchronize_timer('Export to trimesh')
 def export_to_trimesh(mesh_output):
     if isinstance(mesh_output, list):
         outputs = []
         for mesh in mesh_output:
-            if mesh is None:
+            if mesh is None or mesh.error is not None:
                 outputs.append(None)
             else:
                 mesh.mesh_f = mesh.mesh_f[:, ::-1]
@@ -243,6 +281,9 @@ class Hunyuan3DDiTPipeline:
         self.conditioner = conditioner
         self.image_processor = image_processor
         self.kwargs = kwargs
+        self.latent_cache = None
+        self.cond_cache = None
+        self.uncond_embeddings = {}
         self.to(device, dtype)
 
     def compile(self):
@@ -257,6 +298,7 @@ class Hunyuan3DDiTPipeline:
         topk_mode='mean',
         mc_algo='mc',
         replace_vae=True,
+        packed=False,
     ):
         if enabled:
             model_path = self.kwargs['from_pretrained_kwargs']['model_path']
@@ -277,7 +319,8 @@ class Hunyuan3DDiTPipeline:
                 enabled=enabled,
                 adaptive_kv_selection=adaptive_kv_selection,
                 topk_mode=topk_mode,
-                mc_algo=mc_algo
+                mc_algo=mc_algo,
+                packed=packed,
             )
         else:
             model_path = self.kwargs['from_pretrained_kwargs']['model_path']
@@ -292,7 +335,85 @@ class Hunyuan3DDiTPipeline:
                 self.vae = ShapeVAE.from_pretrained(model_path, subfolder=subfolder)
             self.vae.enable_flashvdm_decoder(enabled=False)
 
+    def enable_latent_cache(self, cache_dir, max_bytes=4 << 30, model_id=None):
+        """Keep the post-diffusion latents of every seeded request on disk, so that exporting a request again with
+        other export parameters only costs the VAE decoding and meshing."""
+        if model_id is None:
+            if 'from_pretrained_kwargs' not in self.kwargs:
+                raise ValueError('Please pass the model_id of a pipeline not loaded with from_pretrained')
+            pretrained = self.kwargs['from_pretrained_kwargs']
+            model_id = f"{pretrained['model_path']}/{pretrained['subfolder']}/{pretrained['variant']}"
+        self.latent_cache = LatentCache(cache_dir, max_bytes)
+        self.latent_cache_model_id = model_id
+
+    def latent_cache_keys(self, image, additional_cond_inputs, generator, **params):
+        """Keys of the latents of every sample of a request, None when the cache is disabled or the samples are not
+        seeded by their own generators. A sample gets the same key alone or batched with other requests."""
+        if self.latent_cache is None or generator is None:
+            return None
+        generators = generator if isinstance(generator, list) else [generator]
+        if len(generators) != image.shape[0]:
+            return None
+        return [
+            hash_inputs(
+                pipeline=type(self).__name__,
+                model_id=self.latent_cache_model_id,
+                scheduler=(type(self.scheduler).__name__, dict(self.scheduler.config)),
+                image=image[i:i + 1],
+                additional_cond_inputs=select_samples(additional_cond_inputs, [i]),
+                generator=generators[i],
+                **params,
+            )
+            for i in range(len(generators))
+        ]
+
+    def enable_cond_cache(self, max_bytes=256 << 20):
+        """Keep the conditioner outputs of recent images in memory, so that encoding the same preprocessed image
+        again skips the image encoder."""
+        self.cond_cache = CondCache(max_bytes)
+
+    def cache_stats(self):
+        return dict(
+            cond=None if self.cond_cache is None else self.cond_cache.stats(),
+            latents=None if self.latent_cache is None else self.latent_cache.stats(),
+        )
+
+    def cached_latents(self, cache_keys):
+        """The cached latents of every sample, None for the samples to diffuse, or None when nothing is cached."""
+        if cache_keys is None:
+            return None
+        cached = [self.latent_cache.get(key, device=self.device, dtype=self.dtype) for key in cache_keys]
+        hits = sum(latents is not None for latents in cached)
+        if hits:
+            logger.info(f'Reusing cached latents of {hits} of {len(cached)} samples, skipping their conditioning '
+                        f'and diffusion')
+        return cached
+
+    def uncached_inputs(self, cached, image, cond_inputs, generator):
+        """The inputs of the samples missing from `cached`, diffused as a smaller batch."""
+        if cached is None or all(latents is None for latents in cached):
+            return image, cond_inputs, generator
+        misses = [i for i, latents in enumerate(cached) if latents is None]
+        generators = generator if isinstance(generator, list) else [generator]
+        return image[misses], select_samples(cond_inputs, misses), [generators[i] for i in misses]
+
+    def store_latents(self, cache_keys, cached, latents):
+        """Cache the latents of the diffused samples and assemble them with the cached ones in batch order."""
+        if cache_keys is None:
+            return latents
+        diffused = iter(latents.split(1))
+        samples = []
+        for key, sample in zip(cache_keys, cached):
+            if sample is None:
+                sample = next(diffused)
+                self.latent_cache.put(key, sample)
+            samples.append(sample)
+        return torch.cat(samples)
+
     def to(self, device=None, dtype=None):
+        self.uncond_embeddings.clear()
+        if self.cond_cache is not None:
+            self.cond_cache.clear()
         if dtype is not None:
             self.dtype = dtype
             self.vae.to(dtype=dtype)
@@ -418,10 +539,13 @@ class Hunyuan3DDiTPipeline:
     @synchronize_timer('Encode cond')
     def encode_cond(self, image, additional_cond_inputs, do_classifier_free_guidance, dual_guidance):
         bsz = image.shape[0]
-        cond = self.conditioner(image=image, **additional_cond_inputs)
+        if self.cond_cache is not None:
+            cond = self.cached_cond(image, additional_cond_inputs)
+        else:
+            cond = self.conditioner(image=image, **additional_cond_inputs)
 
         if do_classifier_free_guidance:
-            un_cond = self.conditioner.unconditional_embedding(bsz, **additional_cond_inputs)
+            un_cond = self.unconditional_embedding(bsz, additional_cond_inputs)
 
             if dual_guidance:
                 un_cond_drop_main = copy.deepcopy(un_cond)
@@ -448,6 +572,37 @@ class Hunyuan3DDiTPipeline:
                 cond = cat_recursive(cond, un_cond)
         return cond
 
+    def cached_cond(self, image, additional_cond_inputs):
+        """Conditioner outputs of every sample, encoding only the samples missing from the cond cache as a smaller
+        batch."""
+        # the conditioner object identifies its weights for the lifetime of the pipeline
+        cache_keys = [
+            hash_inputs(conditioner=id(self.conditioner), dtype=self.dtype, image=image[i:i + 1],
+                        additional_cond_inputs=select_samples(additional_cond_inputs, [i]))
+            for i in range(image.shape[0])
+        ]
+        samples = [self.cond_cache.get(key) for key in cache_keys]
+        misses = [i for i, cond in enumerate(samples) if cond is None]
+        if misses:
+            cond = self.conditioner(image=image[misses], **select_samples(additional_cond_inputs, misses))
+            for j, i in enumerate(misses):
+                # indexing copies the sample, a view would keep the whole batch alive in the cache
+                samples[i] = select_samples(cond, [j])
+                self.cond_cache.put(cache_keys[i], samples[i])
+        return cat_samples(samples)
+
+    def unconditional_embedding(self, batch_size, additional_cond_inputs):
+        # the embedding follows the conditioner weights, which CPU offloading moves between devices, and ignores
+        # the image masks, but not the view indices of multiview conditioners
+        weight = next(self.conditioner.parameters())
+        shape_inputs = {k: v for k, v in additional_cond_inputs.items() if k != 'mask'}
+        key = (batch_size, weight.dtype, weight.device, id(self.conditioner),
+               hash_inputs(**shape_inputs) if shape_inputs else None)
+        if key not in self.uncond_embeddings:
+            self.uncond_embeddings[key] = self.conditioner.unconditional_embedding(batch_size,
+                                                                                   **additional_cond_inputs)
+        return self.uncond_embeddings[key]
+
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -562,6 +717,10 @@ class Hunyuan3DDiTPipeline:
         mc_algo=None,
         output_type: Optional[str] = "trimesh",
         enable_pbar=True,
+        voxel_resolution=None,
+        memory_budget=None,
+        memory_fraction=None,
+        max_voxel_resolution=None,
         **kwargs,
     ) -> List[List[trimesh.Trimesh]]:
         callback = kwargs.pop("callback", None)
@@ -575,8 +734,24 @@ class Hunyuan3DDiTPipeline:
                                       getattr(self.model, 'guidance_cond_proj_dim', None) is None
         dual_guidance = dual_guidance_scale >= 0 and dual_guidance
 
+        export_kwargs = dict(
+            output_type=output_type, box_v=box_v, mc_level=mc_level, num_chunks=num_chunks,
+            octree_resolution=octree_resolution, mc_algo=mc_algo, voxel_resolution=voxel_resolution,
+            memory_budget=memory_budget, memory_fraction=memory_fraction,
+            max_voxel_resolution=max_voxel_resolution,
+        )
+
         cond_inputs = self.prepare_image(image)
         image = cond_inputs.pop('image')
+        cache_keys = self.latent_cache_keys(
+            image, cond_inputs, generator,
+            num_inference_steps=num_inference_steps, timesteps=timesteps, sigmas=sigmas, eta=eta,
+            guidance_scale=guidance_scale, dual_guidance_scale=dual_guidance_scale, dual_guidance=dual_guidance,
+        )
+        cached = self.cached_latents(cache_keys)
+        if cached is not None and all(latents is not None for latents in cached):
+            return self._export(torch.cat(cached), **export_kwargs)
+        image, cond_inputs, generator = self.uncached_inputs(cached, image, cond_inputs, generator)
         cond = self.encode_cond(
             image=image,
             additional_cond_inputs=cond_inputs,
@@ -634,11 +809,8 @@ class Hunyuan3DDiTPipeline:
                     step_idx = i // getattr(self.scheduler, "order", 1)
                     callback(step_idx, t, outputs)
 
-        return self._export(
-            latents,
-            output_type,
-            box_v, mc_level, num_chunks, octree_resolution, mc_algo,
-        )
+        latents = self.store_latents(cache_keys, cached, latents)
+        return self._export(latents, **export_kwargs)
 
     def _export(
         self,
@@ -649,9 +821,33 @@ class Hunyuan3DDiTPipeline:
         num_chunks=20000,
         octree_resolution=256,
         mc_algo='mc',
-        enable_pbar=True
+        enable_pbar=True,
+        voxel_resolution=None,
+        memory_budget=None,
+        memory_fraction=None,
+        max_voxel_resolution=None,
     ):
-        if not output_type == "latent":
+        if memory_budget is None and memory_fraction is not None and output_type != 'latent' and latents.is_cuda:
+            # measured here, after diffusion has released its activations
+            free_memory, _ = torch.cuda.mem_get_info(latents.device)
+            memory_budget = int(free_memory * memory_fraction)
+        if output_type == "voxels":
+            # sample occupancy directly at voxel centers, skipping the octree decode and surface extraction
+            latents = 1. / self.vae.scale_factor * latents
+            latents = self.vae(latents)
+            outputs = self.vae.latents2voxels(
+                latents,
+                bounds=box_v,
+                mc_level=mc_level,
+                num_chunks=num_chunks,
+                voxel_resolution=voxel_resolution or octree_resolution,
+                enable_pbar=enable_pbar,
+                memory_budget=memory_budget,
+            )
+        elif not output_type == "latent":
+            if max_voxel_resolution is not None:
+                # only refine the octree as far as the voxelization of the mesh can tell apart
+                octree_resolution = octree_resolution_for_voxels(octree_resolution, max_voxel_resolution)
             latents = 1. / self.vae.scale_factor * latents
             latents = self.vae(latents)
             outputs = self.vae.latents2mesh(
@@ -662,6 +858,7 @@ class Hunyuan3DDiTPipeline:
                 octree_resolution=octree_resolution,
                 mc_algo=mc_algo,
                 enable_pbar=enable_pbar,
+                memory_budget=memory_budget,
             )
         else:
             outputs = latents
@@ -674,6 +871,15 @@ class Hunyuan3DDiTPipeline:
 
 class Hunyuan3DDiTFlowMatchingPipeline(Hunyuan3DDiTPipeline):
 
+    def fast_scheduler(self):
+        """The consistency scheduler sampling in few steps, on the same [0, 1] sigma range as the pipeline scheduler."""
+        if isinstance(self.scheduler, ConsistencyFlowMatchEulerDiscreteScheduler):
+            return self.scheduler
+        if getattr(self, '_fast_scheduler', None) is None:
+            self._fast_scheduler = ConsistencyFlowMatchEulerDiscreteScheduler(
+                num_train_timesteps=self.scheduler.config.num_train_timesteps)
+        return self._fast_scheduler
+
     @torch.inference_mode()
     def __call__(
         self,
@@ -691,8 +897,31 @@ class Hunyuan3DDiTFlowMatchingPipeline(Hunyuan3DDiTPipeline):
         num_chunks=8000,
         output_type: Optional[str] = "trimesh",
         enable_pbar=True,
+        voxel_resolution=None,
+        memory_budget=None,
+        memory_fraction=None,
+        max_voxel_resolution=None,
+        guidance_interval=None,
+        reuse_uncond=False,
+        block_cache=None,
+        fast=False,
         **kwargs,
     ) -> List[List[trimesh.Trimesh]]:
+        """
+        Classifier-free guidance runs the model on a conditional and an unconditional copy of the latents. With
+        `guidance_interval=(start, end)` only that range of the steps, as fractions of `num_inference_steps`, is
+        guided and the others run the conditional copy alone, e.g. `(0.0, 0.4)` saves 30% of the model
+        evaluations. With `reuse_uncond`, the unguided steps after a guided one still apply the guidance against
+        the last unconditional prediction.
+
+        `block_cache=True`, or a `BlockCachePolicy`, reuses the residuals of DiT block ranges across steps whose
+        inputs barely change, see `BlockCachePolicy`.
+
+        `fast` samples with `fast_scheduler()` instead of the pipeline scheduler, meant for 4 to 10 steps.
+
+        `memory_budget` bounds the bytes of a volume decoding chunk, `memory_fraction` sets it to that fraction of
+        the device memory still free once the latents are sampled.
+        """
         callback = kwargs.pop("callback", None)
         callback_steps = kwargs.pop("callback_steps", None)
 
@@ -705,8 +934,25 @@ class Hunyuan3DDiTFlowMatchingPipeline(Hunyuan3DDiTPipeline):
             self.model.guidance_embed is True
         )
 
+        export_kwargs = dict(
+            output_type=output_type, box_v=box_v, mc_level=mc_level, num_chunks=num_chunks,
+            octree_resolution=octree_resolution, mc_algo=mc_algo, enable_pbar=enable_pbar,
+            voxel_resolution=voxel_resolution, memory_budget=memory_budget, memory_fraction=memory_fraction,
+            max_voxel_resolution=max_voxel_resolution,
+        )
+
         cond_inputs = self.prepare_image(image)
         image = cond_inputs.pop('image')
+        cache_keys = self.latent_cache_keys(
+            image, cond_inputs, generator,
+            num_inference_steps=num_inference_steps, timesteps=timesteps, sigmas=sigmas,
+            guidance_scale=guidance_scale, guidance_interval=guidance_interval, reuse_uncond=reuse_uncond,
+            block_cache=block_cache or None, fast=fast,
+        )
+        cached = self.cached_latents(cache_keys)
+        if cached is not None and all(latents is not None for latents in cached):
+            return self._export(torch.cat(cached), **export_kwargs)
+        image, cond_inputs, generator = self.uncached_inputs(cached, image, cond_inputs, generator)
         cond = self.encode_cond(
             image=image,
             additional_cond_inputs=cond_inputs,
@@ -714,17 +960,25 @@ class Hunyuan3DDiTFlowMatchingPipeline(Hunyuan3DDiTPipeline):
             dual_guidance=False,
         )
         batch_size = image.shape[0]
+        cond_only = slice_cond(cond, batch_size) if do_classifier_free_guidance else cond
 
         # 5. Prepare timesteps
         # NOTE: this is slightly different from common usage, we start from 0.
         sigmas = np.linspace(0, 1, num_inference_steps) if sigmas is None else sigmas
+        scheduler = self.fast_scheduler() if fast else self.scheduler
         timesteps, num_inference_steps = retrieve_timesteps(
-            self.scheduler,
+            scheduler,
             num_inference_steps,
             device,
             sigmas=sigmas,
         )
         latents = self.prepare_latents(batch_size, dtype, device, generator)
+        guided = guidance_steps(num_inference_steps, guidance_interval)
+        noise_pred_uncond = None
+        if block_cache:
+            block_cache = BlockCache(BlockCachePolicy() if block_cache is True else block_cache)
+        else:
+            block_cache = None
 
         guidance = None
         if hasattr(self.model, 'guidance_embed') and \
@@ -735,31 +989,36 @@ class Hunyuan3DDiTFlowMatchingPipeline(Hunyuan3DDiTPipeline):
         with synchronize_timer('Diffusion Sampling'):
             for i, t in enumerate(tqdm(timesteps, disable=not enable_pbar, desc="Diffusion Sampling:")):
                 # expand the latents if we are doing classifier free guidance
-                if do_classifier_free_guidance:
+                guide_step = do_classifier_free_guidance and guided[i]
+                if guide_step:
                     latent_model_input = torch.cat([latents] * 2)
                 else:
                     latent_model_input = latents
 
                 # NOTE: we assume model get timesteps ranged from 0 to 1
                 timestep = t.expand(latent_model_input.shape[0]).to(
-                    latents.dtype) / self.scheduler.config.num_train_timesteps
-                noise_pred = self.model(latent_model_input, timestep, cond, guidance=guidance)
+                    latents.dtype) / scheduler.config.num_train_timesteps
+                noise_pred = self.model(latent_model_input, timestep, cond if guide_step else cond_only,
+                                        guidance=guidance, block_cache=block_cache)
+                if block_cache is not None:
+                    logger.debug(f'Step {i}: skipped {block_cache.skipped[-1]} of {block_cache.total[-1]} blocks')
 
-                if do_classifier_free_guidance:
+                if guide_step:
                     noise_pred_cond, noise_pred_uncond = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
+                elif do_classifier_free_guidance and reuse_uncond and noise_pred_uncond is not None:
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred - noise_pred_uncond)
 
                 # compute the previous noisy sample x_t -> x_t-1
-                outputs = self.scheduler.step(noise_pred, t, latents)
+                outputs = scheduler.step(noise_pred, t, latents)
                 latents = outputs.prev_sample
 
                 if callback is not None and i % callback_steps == 0:
-                    step_idx = i // getattr(self.scheduler, "order", 1)
+                    step_idx = i // getattr(scheduler, "order", 1)
                     callback(step_idx, t, outputs)
 
-        return self._export(
-            latents,
-            output_type,
-            box_v, mc_level, num_chunks, octree_resolution, mc_algo,
-            enable_pbar=enable_pbar,
-        )
+        if block_cache is not None:
+            logger.info(f'Block cache skipped {sum(block_cache.skipped)} of {sum(block_cache.total)} blocks, '
+                        f'per step: {block_cache.skipped}')
+        latents = self.store_latents(cache_keys, cached, latents)
+        return self._export(latents, **export_kwargs)
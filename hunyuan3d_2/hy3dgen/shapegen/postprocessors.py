@@ -59,43 +59,51 @@ def remove_floater(mesh: pymeshlab.MeshSet):
     return mesh
 
 
-def pymeshlab2trimesh(mesh: pymeshlab.MeshSet):
-    with tempfile.NamedTemporaryFile(suffix='.ply', delete=False) as temp_file:
-        mesh.save_current_mesh(temp_file.name)
-        mesh = trimesh.load(temp_file.name)
-    # 检查加载的对象类型
-    if isinstance(mesh, trimesh.Scene):
-        combined_mesh = trimesh.Trimesh()
-        # 如果是Scene，遍历所有的geometry并合并
-        for geom in mesh.geometry.values():
-            combined_mesh = trimesh.util.concatenate([combined_mesh, geom])
-        mesh = combined_mesh
+def remove_degenerate_faces(mesh: pymeshlab.MeshSet):
+    mesh.apply_filter("meshing_remove_duplicate_vertices")
+    mesh.apply_filter("meshing_remove_null_faces")
+    mesh.apply_filter("meshing_remove_duplicate_faces")
+    mesh.apply_filter("meshing_remove_unreferenced_vertices")
     return mesh
 
 
+def pymeshlab2trimesh(mesh: pymeshlab.MeshSet):
+    """Convert the current mesh of a MeshSet to trimesh without going through a file."""
+    current = mesh.current_mesh()
+    vertex_colors = None
+    if current.has_vertex_color():
+        vertex_colors = (current.vertex_color_matrix() * 255).round().astype(np.uint8)
+    return trimesh.Trimesh(
+        vertices=current.vertex_matrix(),
+        faces=current.face_matrix(),
+        vertex_colors=vertex_colors,
+        process=False
+    )
+
+
 def trimesh2pymeshlab(mesh: trimesh.Trimesh):
-    with tempfile.NamedTemporaryFile(suffix='.ply', delete=False) as temp_file:
-        if isinstance(mesh, trimesh.scene.Scene):
-            for idx, obj in enumerate(mesh.geometry.values()):
-                if idx == 0:
-                    temp_mesh = obj
-                else:
-                    temp_mesh = temp_mesh + obj
-            mesh = temp_mesh
-        mesh.export(temp_file.name)
-        mesh = pymeshlab.MeshSet()
-        mesh.load_new_mesh(temp_file.name)
-    return mesh
+    """Convert a trimesh mesh or scene to a MeshSet without going through a file."""
+    if isinstance(mesh, trimesh.scene.Scene):
+        mesh = trimesh.util.concatenate(list(mesh.geometry.values()))
+    attributes = {}
+    if mesh.visual.kind == 'vertex':
+        attributes['v_color_matrix'] = np.asarray(mesh.visual.vertex_colors, dtype=np.float64) / 255.0
+    ms = pymeshlab.MeshSet()
+    ms.add_mesh(pymeshlab.Mesh(
+        vertex_matrix=np.asarray(mesh.vertices, dtype=np.float64),
+        face_matrix=np.asarray(mesh.faces, dtype=np.int32),
+        **attributes
+    ), "converted_mesh")
+    return ms
 
 
 def export_mesh(input, output):
     if isinstance(input, pymeshlab.MeshSet):
         mesh = output
     elif isinstance(input, Latent2MeshOutput):
-        output = Latent2MeshOutput()
-        output.mesh_v = output.current_mesh().vertex_matrix()
-        output.mesh_f = output.current_mesh().face_matrix()
-        mesh = output
+        mesh = Latent2MeshOutput()
+        mesh.mesh_v = output.current_mesh().vertex_matrix()
+        mesh.mesh_f = output.current_mesh().face_matrix()
     else:
         mesh = pymeshlab2trimesh(output)
     return mesh
@@ -105,9 +113,9 @@ def import_mesh(mesh: Union[pymeshlab.MeshSet, trimesh.Trimesh, Latent2MeshOutpu
     if isinstance(mesh, str):
         mesh = load_mesh(mesh)
     elif isinstance(mesh, Latent2MeshOutput):
-        mesh = pymeshlab.MeshSet()
-        mesh_pymeshlab = pymeshlab.Mesh(vertex_matrix=mesh.mesh_v, face_matrix=mesh.mesh_f)
-        mesh.add_mesh(mesh_pymeshlab, "converted_mesh")
+        ms = pymeshlab.MeshSet()
+        ms.add_mesh(pymeshlab.Mesh(vertex_matrix=mesh.mesh_v, face_matrix=mesh.mesh_f), "converted_mesh")
+        mesh = ms
 
     if isinstance(mesh, (trimesh.Trimesh, trimesh.scene.Scene)):
         mesh = trimesh2pymeshlab(mesh)
@@ -147,12 +155,30 @@ class DegenerateFaceRemover:
         mesh: Union[pymeshlab.MeshSet, trimesh.Trimesh, Latent2MeshOutput, str],
     ) -> Union[pymeshlab.MeshSet, trimesh.Trimesh, Latent2MeshOutput]:
         ms = import_mesh(mesh)
+        ms = remove_degenerate_faces(ms)
+        mesh = export_mesh(mesh, ms)
+        return mesh
 
-        with tempfile.NamedTemporaryFile(suffix='.ply', delete=False) as temp_file:
-            ms.save_current_mesh(temp_file.name)
-            ms = pymeshlab.MeshSet()
-            ms.load_new_mesh(temp_file.name)
 
+class MeshPostprocessor:
+    """
+    Floater removal, degenerate face cleanup and face reduction on a single
+    MeshSet, so the mesh is converted only once on the way in and out.
+    """
+
+    @synchronize_timer('MeshPostprocessor')
+    def __call__(
+        self,
+        mesh: Union[pymeshlab.MeshSet, trimesh.Trimesh, Latent2MeshOutput, str],
+        max_facenum: int = 40000
+    ) -> Union[pymeshlab.MeshSet, trimesh.Trimesh, Latent2MeshOutput]:
+        ms = import_mesh(mesh)
+        with synchronize_timer('FloaterRemover'):
+            ms = remove_floater(ms)
+        with synchronize_timer('DegenerateFaceRemover'):
+            ms = remove_degenerate_faces(ms)
+        with synchronize_timer('FaceReducer'):
+            ms = reduce_face(ms, max_facenum=max_facenum)
         mesh = export_mesh(mesh, ms)
         return mesh
 
@@ -18,6 +18,12 @@ from functools import wraps
 
 import torch
 
+try:
+    # Pipeline-wide profiler, only available when running inside the glb2vox app
+    import profiler
+except ImportError:
+    profiler = None
+
 
 def get_logger(name):
     logger = logging.getLogger(name)
@@ -38,7 +44,8 @@ logger = get_logger('hy3dgen.shapgen')
 class synchronize_timer:
     """ Synchronized timer to count the inference time of `nn.Module.forward`.
 
-        Supports both context manager and decorator usage.
+        Supports both context manager and decorator usage. When a profiler
+        trace is active the timed region is also recorded as a trace span.
 
         Example as context manager:
         ```python
@@ -59,6 +66,10 @@ class synchronize_timer:
 
     def __enter__(self):
         """Context manager entry: start timing."""
+        self.span = None
+        if profiler is not None and self.name is not None:
+            self.span = profiler.span(self.name)
+            self.span.__enter__()
         if os.environ.get('HY3DGEN_DEBUG', '0') == '1':
             self.start = torch.cuda.Event(enable_timing=True)
             self.end = torch.cuda.Event(enable_timing=True)
@@ -73,13 +84,16 @@ class synchronize_timer:
             self.time = self.start.elapsed_time(self.end)
             if self.name is not None:
                 logger.info(f'{self.name} takes {self.time} ms')
+        if self.span is not None:
+            self.span.__exit__(exc_type, exc_value, exc_tb)
 
     def __call__(self, func):
         """Decorator: wrap the function to time its execution."""
 
         @wraps(func)
         def wrapper(*args, **kwargs):
-            with self:
+            # A fresh timer per call keeps nested and concurrent calls apart
+            with synchronize_timer(self.name):
                 result = func(*args, **kwargs)
             return result
 
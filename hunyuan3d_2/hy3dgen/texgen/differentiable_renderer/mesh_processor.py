@@ -13,51 +13,135 @@
 # by Tencent in accordance with TENCENT HUNYUAN COMMUNITY LICENSE AGREEMENT.
 
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import spsolve_triangular
+
+
+def uv_texels(vtx_uv, uv_idx, texture_height, texture_width):
+    """Return the (row, column) texel of every face corner, flattened in face order."""
+    corner_uv = vtx_uv[uv_idx.reshape(-1)]
+    uv_v = np.rint(corner_uv[:, 0] * (texture_width - 1)).astype(np.int64)
+    uv_u = np.rint((1.0 - corner_uv[:, 1]) * (texture_height - 1)).astype(np.int64)
+    return uv_u, uv_v
+
+
+def last_occurrence(keys):
+    """Return the indices of the last occurrence of every distinct key."""
+    _, reversed_index = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - reversed_index
+
 
 def meshVerticeInpaint_smooth(texture, mask, vtx_pos, vtx_uv, pos_idx, uv_idx):
+    """
+    Fill texels of vertices outside the mask with the inverse squared distance
+    weighted colour of their coloured neighbours.
+
+    Vectorized equivalent of the original per-vertex loop. The loop visits
+    the uncoloured corners in face order and updates colours in place, so a
+    corner sees the colours assigned earlier in the same pass. Each pass is
+    therefore solved as one sparse unit lower-triangular system over the
+    corner visits, after finding the visits that get coloured by
+    reachability from the already coloured vertices.
+    """
     texture_height, texture_width, texture_channel = texture.shape
     vtx_num = vtx_pos.shape[0]
 
-    vtx_mask = np.zeros(vtx_num, dtype=np.float32)
-    vtx_color = [np.zeros(texture_channel, dtype=np.float32) for _ in range(vtx_num)]
-    uncolored_vtxs = []
-    G = [[] for _ in range(vtx_num)]
-
-    for i in range(uv_idx.shape[0]):
-        for k in range(3):
-            vtx_uv_idx = uv_idx[i, k]
-            vtx_idx = pos_idx[i, k]
-            uv_v = int(round(vtx_uv[vtx_uv_idx, 0] * (texture_width - 1)))
-            uv_u = int(round((1.0 - vtx_uv[vtx_uv_idx, 1]) * (texture_height - 1)))
-            if mask[uv_u, uv_v] > 0:
-                vtx_mask[vtx_idx] = 1.0
-                vtx_color[vtx_idx] = texture[uv_u, uv_v]
-            else:
-                uncolored_vtxs.append(vtx_idx)
-            G[pos_idx[i, k]].append(pos_idx[i, (k + 1) % 3])
+    corner_vtx = pos_idx.reshape(-1).astype(np.int64)
+    uv_u, uv_v = uv_texels(vtx_uv, uv_idx, texture_height, texture_width)
+    colored_corner = mask[uv_u, uv_v] > 0
+
+    vtx_mask = np.zeros(vtx_num, dtype=bool)
+    vtx_color = np.zeros((vtx_num, texture_channel), dtype=np.float64)
+    colored = np.flatnonzero(colored_corner)
+    colored = colored[last_occurrence(corner_vtx[colored])]
+    vtx_mask[corner_vtx[colored]] = True
+    vtx_color[corner_vtx[colored]] = texture[uv_u[colored], uv_v[colored]]
+
+    # CSR adjacency from every corner to the next corner of its face
+    next_vtx = pos_idx[:, [1, 2, 0]].reshape(-1).astype(np.int64)
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(corner_vtx)), (corner_vtx, next_vtx)), shape=(vtx_num, vtx_num))
+    adjacency.sum_duplicates()
+
+    # One visit per uncoloured corner, each reading the visit's vertex neighbours
+    visit_vtx = corner_vtx[~colored_corner]
+    visit_num = len(visit_vtx)
+    if visit_num:
+        degree = np.diff(adjacency.indptr)[visit_vtx]
+        edge_visit = np.repeat(np.arange(visit_num), degree)
+        edge_offset = np.arange(len(edge_visit)) - np.repeat(np.cumsum(degree) - degree, degree)
+        edge_slot = adjacency.indptr[visit_vtx][edge_visit] + edge_offset
+        edge_vtx = adjacency.indices[edge_slot].astype(np.int64)
+        dist = np.sqrt(np.sum((vtx_pos[visit_vtx[edge_visit]] - vtx_pos[edge_vtx]) ** 2, axis=1))
+        edge_weight = adjacency.data[edge_slot] / np.maximum(dist, 1e-4) ** 2
+
+        # Most recent earlier visit of a vertex, -1 when the vertex isn't visited before
+        visit_order = np.lexsort((np.arange(visit_num), visit_vtx))
+        visit_key = visit_vtx[visit_order] * visit_num + visit_order
+
+        def previous_visit(vertices, visits):
+            position = np.searchsorted(visit_key, vertices * visit_num + visits) - 1
+            found = position >= 0
+            found[found] = visit_vtx[visit_order[position[found]]] == vertices[found]
+            return np.where(found, visit_order[np.maximum(position, 0)], -1)
+
+        edge_previous = previous_visit(edge_vtx, edge_visit)
+        self_previous = previous_visit(visit_vtx, np.arange(visit_num))
+        linked = edge_previous >= 0
+        # Visit DAG from earlier visits of a neighbour, plus a source node at visit_num
+        dag_rows = edge_previous[linked]
+        dag_cols = edge_visit[linked]
+        last_visit = last_occurrence(visit_vtx)
 
     smooth_count = 2
     last_uncolored_vtx_count = 0
-    while smooth_count > 0:
-        uncolored_vtx_count = 0
-        for vtx_idx in uncolored_vtxs:
-            sum_color = np.zeros(texture_channel, dtype=np.float32)
-            total_weight = 0.0
-            vtx_0 = vtx_pos[vtx_idx]
-            for connected_idx in G[vtx_idx]:
-                if vtx_mask[connected_idx] > 0:
-                    vtx1 = vtx_pos[connected_idx]
-                    dist = np.sqrt(np.sum((vtx_0 - vtx1) ** 2))
-                    dist_weight = 1.0 / max(dist, 1e-4)
-                    dist_weight *= dist_weight
-                    sum_color += vtx_color[connected_idx] * dist_weight
-                    total_weight += dist_weight
-            if total_weight > 0:
-                vtx_color[vtx_idx] = sum_color / total_weight
-                vtx_mask[vtx_idx] = 1.0
-            else:
-                uncolored_vtx_count += 1
+    while visit_num and smooth_count > 0:
+        # A visit gets coloured when a neighbour was coloured before the pass or
+        # by an earlier visit of the same pass
+        seeds = np.flatnonzero(np.bincount(edge_visit, weights=vtx_mask[edge_vtx], minlength=visit_num))
+        graph = sparse.csr_matrix(
+            (np.ones(len(dag_rows) + len(seeds)),
+             (np.append(dag_rows, np.full(len(seeds), visit_num)), np.append(dag_cols, seeds))),
+            shape=(visit_num + 1, visit_num + 1))
+        reached = csgraph.breadth_first_order(graph, visit_num, directed=True, return_predecessors=False)
+        visit_colored = np.zeros(visit_num + 1, dtype=bool)
+        visit_colored[reached] = True
+        visit_colored = visit_colored[:visit_num]
 
+        active = vtx_mask[edge_vtx] | (linked & visit_colored[np.maximum(edge_previous, 0)])
+        total_weight = np.bincount(edge_visit[active], weights=edge_weight[active], minlength=visit_num)
+
+        # y_i - sum_j a_ij y_j = b_i with j < i the visits read by visit i
+        coef = np.where(active, edge_weight / np.maximum(total_weight[edge_visit], 1e-300), 0.0)
+        from_vertex = active & ~linked
+        rhs = sparse.csr_matrix(
+            (coef[from_vertex], (edge_visit[from_vertex], edge_vtx[from_vertex])),
+            shape=(visit_num, vtx_num)) @ vtx_color
+        from_visit = active & linked
+        rows = [edge_visit[from_visit]]
+        cols = [edge_previous[from_visit]]
+        values = [-coef[from_visit]]
+        # Visits without coloured neighbours keep the current colour of their vertex
+        keep = ~visit_colored
+        keep_previous = keep & (self_previous >= 0)
+        rows.append(np.flatnonzero(keep_previous))
+        cols.append(self_previous[keep_previous])
+        values.append(-np.ones(keep_previous.sum()))
+        keep_vertex = keep & (self_previous < 0)
+        rhs[keep_vertex] = vtx_color[visit_vtx[keep_vertex]]
+        rows.append(np.arange(visit_num))
+        cols.append(np.arange(visit_num))
+        values.append(np.ones(visit_num))
+        system = sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(visit_num, visit_num))
+        visit_color = spsolve_triangular(system, rhs, lower=True, unit_diagonal=True)
+
+        vtx_color[visit_vtx[last_visit]] = visit_color[last_visit]
+        vtx_mask[visit_vtx[visit_colored]] = True
+
+        uncolored_vtx_count = int(visit_num - visit_colored.sum())
         if last_uncolored_vtx_count == uncolored_vtx_count:
             smooth_count -= 1
         else:
@@ -66,19 +150,15 @@ def meshVerticeInpaint_smooth(texture, mask, vtx_pos, vtx_uv, pos_idx, uv_idx):
 
     new_texture = texture.copy()
     new_mask = mask.copy()
-    for face_idx in range(uv_idx.shape[0]):
-        for k in range(3):
-            vtx_uv_idx = uv_idx[face_idx, k]
-            vtx_idx = pos_idx[face_idx, k]
-            if vtx_mask[vtx_idx] == 1.0:
-                uv_v = int(round(vtx_uv[vtx_uv_idx, 0] * (texture_width - 1)))
-                uv_u = int(round((1.0 - vtx_uv[vtx_uv_idx, 1]) * (texture_height - 1)))
-                new_texture[uv_u, uv_v] = vtx_color[vtx_idx]
-                new_mask[uv_u, uv_v] = 255
+    write = np.flatnonzero(vtx_mask[corner_vtx])
+    write = write[last_occurrence(uv_u[write] * texture_width + uv_v[write])]
+    new_texture[uv_u[write], uv_v[write]] = vtx_color[corner_vtx[write]].astype(np.float32)
+    new_mask[uv_u[write], uv_v[write]] = 255
     return new_texture, new_mask
 
+
 def meshVerticeInpaint(texture, mask, vtx_pos, vtx_uv, pos_idx, uv_idx, method="smooth"):
     if method == "smooth":
         return meshVerticeInpaint_smooth(texture, mask, vtx_pos, vtx_uv, pos_idx, uv_idx)
     else:
-        raise ValueError("Invalid method. Use 'smooth' or 'forward'.")
\ No newline at end of file
+        raise ValueError("Invalid method. Use 'smooth' or 'forward'.")
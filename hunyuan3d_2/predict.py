@@ -4,10 +4,11 @@ import os
 from PIL import Image
 import time
 import subprocess
-import shutil
-from hy3dgen.shapegen import FaceReducer, FloaterRemover, DegenerateFaceRemover, Hunyuan3DDiTFlowMatchingPipeline
+import tempfile
+from hy3dgen.shapegen import MeshPostprocessor, Hunyuan3DDiTFlowMatchingPipeline
 from hy3dgen.shapegen.models.autoencoders import SurfaceExtractors
-from hy3dgen.shapegen.utils import logger
+from hy3dgen.shapegen.batching import BatchScheduler
+from hy3dgen.shapegen.utils import logger, synchronize_timer
 from hy3dgen.rembg import BackgroundRemover
 from hy3dgen.texgen import Hunyuan3DPaintPipeline
 
@@ -20,6 +21,13 @@ U2NET_PATH = os.path.join(CHECKPOINTS_PATH, ".u2net/")
 DELIGHT_URL = "https://weights.replicate.delivery/default/tencent/Hunyuan3D-2/hunyuan3d-dit-v2-0/delight.tar"
 PAINT_URL = "https://weights.replicate.delivery/default/tencent/Hunyuan3D-2/hunyuan3d-dit-v2-0/paint.tar"
 U2NET_URL = "https://weights.replicate.delivery/default/comfy-ui/rembg/u2net.onnx.tar"
+LATENT_CACHE_PATH = "/tmp/hy3dgen/latents"
+LATENT_CACHE_BYTES = 2 << 30
+COND_CACHE_BYTES = 256 << 20
+SHAPE_BATCH_SIZE = 4
+SHAPE_BATCH_WAIT = 0.05
+# cog.yaml sets no concurrency, so Cog runs one prediction at a time and batches never wait for a second one
+SHAPE_CONCURRENCY = 1
 
 def download_if_not_exists(url, dest):
     if not os.path.exists(dest):
@@ -76,12 +84,17 @@ class Predictor(BasePredictor):
             HUNYUAN3D_REPO,
             subfolder=HUNYUAN3D_MODEL
         )
-        self.i23d_worker.enable_flashvdm(mc_algo='mc')
-        self.i23d_worker.vae.surface_extractor = SurfaceExtractors['mc']()
+        # packed cell attention stays off until it is measured faster on the GPU, see FlashVDMCrossAttentionProcessor
+        self.i23d_worker.enable_flashvdm(mc_algo='sparse_mc')
+        self.i23d_worker.vae.surface_extractor = SurfaceExtractors['sparse_mc']()
+        # re-meshing a request at another resolution reuses its diffusion latents
+        self.i23d_worker.enable_latent_cache(LATENT_CACHE_PATH, LATENT_CACHE_BYTES)
+        # retries and A/B runs on the same image reuse its DINO embedding
+        self.i23d_worker.enable_cond_cache(COND_CACHE_BYTES)
+        # concurrent predictions with the same settings share one batched diffusion, once Cog runs them concurrently
+        self.shape_scheduler = BatchScheduler(self.i23d_worker, SHAPE_BATCH_SIZE, SHAPE_BATCH_WAIT, SHAPE_CONCURRENCY)
         self.texgen_worker = Hunyuan3DPaintPipeline.from_pretrained(HUNYUAN3D_REPO)
-        self.floater_remove_worker = FloaterRemover()
-        self.degenerate_face_remove_worker = DegenerateFaceRemover()
-        self.face_reduce_worker = FaceReducer()
+        self.postprocess_worker = MeshPostprocessor()
         self.rmbg_worker = BackgroundRemover()
         logger.info("Finished setting up environment")
 
@@ -116,11 +129,36 @@ class Predictor(BasePredictor):
             description="Whether to remove background from input image",
             default=True
         ),
+        preview: bool = Input(
+            description="Generate a quick preview shape in preview_steps steps with the consistency scheduler",
+            default=False
+        ),
+        preview_steps: int = Input(
+            description="Number of inference steps of a preview",
+            default=5,
+            ge=4,
+            le=10,
+        ),
     ) -> Output:
-        if os.path.exists("output"):
-            shutil.rmtree("output")
-        
-        os.makedirs("output", exist_ok=True)
+        output_dir = tempfile.mkdtemp(prefix="hunyuan3d-")
+        mesh = self.generate_mesh(
+            image=image,
+            steps=preview_steps if preview else steps,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            octree_resolution=octree_resolution,
+            remove_background=remove_background,
+            fast=preview,
+            output_dir=output_dir,
+        )
+        output_path = self.export_mesh(mesh, Path(os.path.join(output_dir, "mesh.glb")))
+        return Output(mesh=output_path)
+
+    def generate_mesh(self, image, steps, guidance_scale, seed, octree_resolution, remove_background,
+                      max_voxel_resolution=None, fast=False, output_dir=None):
+        # Concurrent requests are batched by the shape scheduler, so each one writes to its own directory
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp(prefix="hunyuan3d-")
 
         max_facenum = 40000
 
@@ -130,29 +168,36 @@ class Predictor(BasePredictor):
         if image is not None:
             input_image = Image.open(str(image))
             if remove_background:
-                input_image = self.rmbg_worker(input_image.convert('RGB'))
+                with synchronize_timer('Background removal'):
+                    input_image = self.rmbg_worker(input_image.convert('RGB'))
         else:
             raise ValueError("Image must be provided")
 
-        input_image.save("output/input.png")
-
-        mesh = self.i23d_worker(
-            image=input_image,
-            num_inference_steps=steps,
-            guidance_scale=guidance_scale,
-            generator=generator,
-            octree_resolution=octree_resolution,
-            num_chunks=200000
-        )[0]
-
-        mesh = self.floater_remove_worker(mesh)
-        mesh = self.degenerate_face_remove_worker(mesh)
-        mesh = self.face_reduce_worker(mesh, max_facenum=max_facenum)
-        mesh = self.texgen_worker(mesh, input_image)
-        output_path = Path("output/mesh.glb")
+        input_image.save(os.path.join(output_dir, "input.png"))
+
+        with synchronize_timer('Shape generation'):
+            mesh = self.shape_scheduler(
+                input_image,
+                num_inference_steps=steps,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                octree_resolution=octree_resolution,
+                # Size volume decoding chunks from half the device memory left after diffusion
+                memory_fraction=0.5,
+                max_voxel_resolution=max_voxel_resolution,
+                fast=fast,
+            )[0]
+
+        mesh = self.postprocess_worker(mesh, max_facenum=max_facenum)
+        with synchronize_timer('Texture generation'):
+            mesh = self.texgen_worker(mesh, input_image)
+        return mesh
+
+    @synchronize_timer('Mesh export')
+    def export_mesh(self, mesh, output_path):
         mesh.export(str(output_path), include_normals=True)
 
         if not Path(output_path).exists():
             raise RuntimeError(f"Failed to generate mesh file at {output_path}")
 
-        return Output(mesh=output_path)
+        return output_path
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from hy3dgen.disk_cache import DiskCache
+
+class ImageCache:
+    """
+    Content-addressed cache of encoded images, a memory tier in front of a
+    disk tier.
+
+    Both tiers evict their least recently used entries once they hold more
+    than their byte budget, and a disk hit is promoted to memory. The disk
+    tier is a DiskCache, which several processes may share.
+
+    Example:
+    ```python
+    cache = ImageCache('/tmp/images')
+    key = ImageCache.key(model='flux-dev', prompt='a cat', seed=1)
+    data = cache.get(key)
+    if data is None:
+        data = render()
+        cache.put(key, data)
+    ```
+
+    Args:
+        cache_dir (str): directory of the disk tier
+        max_bytes (int): byte budget of the disk tier
+        memory_max_bytes (int): byte budget of the memory tier
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 << 30, memory_max_bytes=256 << 20):
+        self.disk = DiskCache(cache_dir, max_bytes)
+        self.memory_max_bytes = memory_max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.memory_hits = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(**inputs):
+        """Return the hex digest of JSON serializable generation inputs."""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the bytes cached under key, or None."""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+        data = self.disk.read(key)
+        if data is not None:
+            with self.lock:
+                self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self.disk.write(key, data)
+        with self.lock:
+            self._remember(key, data)
+
+    def _remember(self, key, data):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        if len(data) > self.memory_max_bytes:
+            return
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def stats(self):
+        """Return the hit and miss counters and the bytes held in memory."""
+        disk = self.disk.stats()
+        with self.lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': disk['hits'],
+                'misses': disk['misses'],
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+            }
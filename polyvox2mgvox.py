@@ -1,19 +1,28 @@
 import struct
 import sys
 
+import numpy as np
+
+from voxels import VOXEL_DTYPE, DenseVoxels, SparseVoxels
+
+# MagicaVoxel models hold at most 256 voxels per axis
+MAX_MODEL_SIZE = 256
+
 def read_int(f):
     """Read a 4-byte little-endian integer from file."""
     return struct.unpack('<i', f.read(4))[0]
 
-def convert_poly2vox_to_magicavoxel(poly2vox_file, magicavoxel_file):
+def read_poly2vox(poly2vox_file):
     """
-    Convert a poly2vox .vox file to MagicaVoxel .vox format (version 150).
-    
+    Read a poly2vox .vox file.
+
     Args:
         poly2vox_file (str): Path to input poly2vox .vox file
-        magicavoxel_file (str): Path to output MagicaVoxel .vox file
+
+    Returns:
+        tuple: (grid, palette) where grid is a uint8 array of shape (xsiz, ysiz, zsiz)
+        holding palette indices (255 = empty) and palette is a (256, 3) uint8 array.
     """
-    # Read poly2vox file
     with open(poly2vox_file, 'rb') as f:
         xsiz = read_int(f)
         ysiz = read_int(f)
@@ -21,72 +30,214 @@ def convert_poly2vox_to_magicavoxel(poly2vox_file, magicavoxel_file):
         voxel_data = f.read(xsiz * ysiz * zsiz)
         palette = f.read(256 * 3)  # Assuming 256 RGB colors (768 bytes)
 
-    # Define directions for checking neighboring voxels
-    directions = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
-
-    # Process voxel data: collect only visible voxels
-    voxels = []
-    for z in range(zsiz):
-        for y in range(ysiz):
-            for x in range(xsiz):
-                idx = z + y * zsiz + x * zsiz * ysiz
-                v = voxel_data[idx]
-                if v != 255:
-                    # Check if voxel is visible (has at least one empty neighbor or is on boundary)
-                    is_visible = any(
-                        (nx < 0 or nx >= xsiz or ny < 0 or ny >= ysiz or nz < 0 or nz >= zsiz or
-                         voxel_data[nz + ny * zsiz + nx * zsiz * ysiz] == 255)
-                        for nx, ny, nz in [(x + dx, y + dy, z + dz) for dx, dy, dz in directions]
-                    )
-                    if is_visible:
-                        if v == 0:
-                            color_index = 255  # Default color for internal (but visible) voxels
-                        else:
-                            color_index = v  # Surface voxels use v directly (1-254)
-                        voxels.append((x, y + 1, z + 1, color_index))
-
-    # Prepare MagicaVoxel palette: 256 RGBA colors
-    mv_palette = []  # Index 0: unused, set to transparent black
-    for i in range(1, 255):
-        r = palette[i * 3]
-        g = palette[i * 3 + 1]
-        b = palette[i * 3 + 2]
-        mv_palette.append((r, g, b, 255))  # Indices 1-255: poly2vox[0-254] with A=255
-
-    mv_palette.append((0, 0, 0, 0))  # Indices 1-255: poly2vox[0-254] with A=255
-
-    # Build MagicaVoxel chunks
-    # SIZE chunk: dimensions
-    size_content = struct.pack('<iii', xsiz, ysiz, zsiz)
-    size_chunk = b'SIZE' + struct.pack('<ii', len(size_content), 0) + size_content
-
-    # XYZI chunk: voxel list
-    num_voxels = len(voxels)
-    xyzi_content = struct.pack('<i', num_voxels)
-    for x, y, z, c in voxels:
-        xyzi_content += struct.pack('<BBBB', x, ysiz - y, zsiz - z, c)
-    xyzi_chunk = b'XYZI' + struct.pack('<ii', len(xyzi_content), 0) + xyzi_content
-
-    # RGBA chunk: palette
-    rgba_content = b''
-    for r, g, b, a in mv_palette:
-        rgba_content += struct.pack('<BBBB', r * 4, g * 4, b * 4, a)
-    rgba_chunk = b'RGBA' + struct.pack('<ii', len(rgba_content), 0) + rgba_content
-
-    # MAIN chunk: contains SIZE, XYZI, RGBA
-    children = size_chunk + xyzi_chunk + rgba_chunk
-    main_chunk = b'MAIN' + struct.pack('<ii', 0, len(children)) + children
-
-    # Assemble full file
-    vox_file = b'VOX ' + struct.pack('<i', 150) + main_chunk
-
-    # Write to output file
+    grid = np.frombuffer(voxel_data, dtype=np.uint8).reshape(xsiz, ysiz, zsiz)
+    palette = np.frombuffer(palette, dtype=np.uint8).reshape(256, 3)
+    return grid, palette
+
+def read_string(data, offset):
+    """Read a MagicaVoxel STRING, returning it and the offset after it."""
+    size = struct.unpack_from('<i', data, offset)[0]
+    return data[offset + 4:offset + 4 + size].decode('utf-8'), offset + 4 + size
+
+def read_dict(data, offset):
+    """Read a MagicaVoxel DICT, returning it and the offset after it."""
+    num_pairs = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    pairs = {}
+    for _ in range(num_pairs):
+        key, offset = read_string(data, offset)
+        pairs[key], offset = read_string(data, offset)
+    return pairs, offset
+
+def read_magicavoxel(magicavoxel_file):
+    """
+    Read a MagicaVoxel .vox file.
+
+    Files with several models are assembled from the translations of the
+    transform nodes directly above each shape node, as written by
+    write_magicavoxel for tiled models.
+
+    Returns:
+        SparseVoxels: the voxel records in file order and the RGBA palette.
+    """
+    with open(magicavoxel_file, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'VOX ':
+        raise ValueError(f"{magicavoxel_file} is not a MagicaVoxel file")
+
+    sizes = []
+    models = []
+    transforms = {}
+    shapes = {}
+    rgba = None
+    offset = 20  # 'VOX ', version and the MAIN chunk header
+    while offset < len(data):
+        chunk_id = data[offset:offset + 4]
+        content_size, children_size = struct.unpack_from('<ii', data, offset + 4)
+        content = offset + 12
+        if chunk_id == b'SIZE':
+            sizes.append(np.array(struct.unpack_from('<iii', data, content)))
+        elif chunk_id == b'XYZI':
+            num_voxels = struct.unpack_from('<i', data, content)[0]
+            models.append(np.frombuffer(data, dtype=np.uint8, count=num_voxels * 4, offset=content + 4).reshape(-1, 4))
+        elif chunk_id == b'nTRN':
+            _, position = read_dict(data, content + 4)
+            child = struct.unpack_from('<i', data, position)[0]
+            frame, _ = read_dict(data, position + 16)
+            transforms[child] = np.array([int(v) for v in frame.get('_t', '0 0 0').split()])
+        elif chunk_id == b'nSHP':
+            node_id = struct.unpack_from('<i', data, content)[0]
+            _, position = read_dict(data, content + 4)
+            shapes[struct.unpack_from('<i', data, position + 4)[0]] = node_id
+        elif chunk_id == b'RGBA':
+            rgba = np.frombuffer(data, dtype=np.uint8, count=content_size, offset=content).reshape(-1, 4)
+        offset = content + content_size + children_size
+
+    # A model of size s translated by t covers world voxels t - s // 2 onwards
+    origins = [
+        transforms.get(shapes.get(i), size // 2) - size // 2
+        for i, size in enumerate(sizes)
+    ]
+    corner = np.min(origins, axis=0)
+    shape = np.max([origin + size for origin, size in zip(origins, sizes)], axis=0) - corner
+
+    voxels = np.empty(sum(len(xyzi) for xyzi in models), dtype=VOXEL_DTYPE)
+    start = 0
+    for xyzi, origin in zip(models, origins):
+        end = start + len(xyzi)
+        for i, field in enumerate('xyz'):
+            voxels[field][start:end] = xyzi[:, i] + (origin[i] - corner[i])
+        voxels['c'][start:end] = xyzi[:, 3]
+        start = end
+    return SparseVoxels(voxels, shape, rgba)
+
+def build_xyzi(records, origin=(0, 0, 0)):
+    """
+    Build XYZI voxel records relative to a model origin.
+
+    Returns:
+        np.ndarray: (N, 4) uint8 array of (x, y, z, color_index) rows.
+    """
+    xyzi = np.empty((len(records), 4), dtype=np.uint8)
+    for i, field in enumerate('xyz'):
+        xyzi[:, i] = records[field] - origin[i]
+    xyzi[:, 3] = records['c']
+    return xyzi
+
+def split_models(voxels):
+    """
+    Split a sparse voxel model into MagicaVoxel models of at most
+    MAX_MODEL_SIZE voxels per axis.
+
+    Voxels keep their relative order inside each tile. Empty tiles are kept
+    so the tiles always cover the whole grid.
+
+    Yields:
+        tuple: (origin, size, xyzi) for every tile.
+    """
+    shape = np.array(voxels.shape)
+    records = voxels.voxels
+    tiles = -(-shape // MAX_MODEL_SIZE)
+    tile_index = np.ravel_multi_index(
+        [records[field] // MAX_MODEL_SIZE for field in 'xyz'], tiles
+    )
+    order = np.argsort(tile_index, kind='stable')
+    bounds = np.searchsorted(tile_index[order], np.arange(np.prod(tiles) + 1))
+    for tile, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        origin = np.array(np.unravel_index(tile, tiles)) * MAX_MODEL_SIZE
+        size = np.minimum(shape - origin, MAX_MODEL_SIZE)
+        yield origin, size, build_xyzi(records[order[start:end]], origin)
+
+def pack_string(text):
+    text = text.encode('utf-8')
+    return struct.pack('<i', len(text)) + text
+
+def pack_dict(pairs):
+    return struct.pack('<i', len(pairs)) + b''.join(pack_string(k) + pack_string(v) for k, v in pairs.items())
+
+def write_chunk(f, chunk_id, content):
+    """Write a MagicaVoxel chunk without children, returning the number of bytes written."""
+    f.write(chunk_id + struct.pack('<ii', len(content), 0))
+    f.write(content)
+    return 12 + len(content)
+
+def write_model(f, size, xyzi):
+    """Write the SIZE and XYZI chunks of one model."""
+    written = write_chunk(f, b'SIZE', struct.pack('<iii', *(int(s) for s in size)))
+    written += write_chunk(f, b'XYZI', struct.pack('<i', len(xyzi)) + xyzi.tobytes())
+    return written
+
+def write_scene_graph(f, shape, models):
+    """
+    Write a root transform and group with one translated shape per model.
+
+    Node ids: 0 is the root transform, 1 the group, then each model gets a
+    transform and a shape node.
+    """
+    shape = np.asarray(shape)
+    child_ids = [2 + 2 * i for i in range(len(models))]
+    written = write_chunk(f, b'nTRN', struct.pack('<i', 0) + pack_dict({}) + struct.pack('<iiii', 1, -1, -1, 1)
+                          + pack_dict({}))
+    written += write_chunk(f, b'nGRP', struct.pack('<i', 1) + pack_dict({}) + struct.pack('<i', len(child_ids))
+                           + struct.pack(f'<{len(child_ids)}i', *child_ids))
+    for model_id, (node_id, (origin, size)) in enumerate(zip(child_ids, models)):
+        # MagicaVoxel places a model's voxel i at translation + i - size // 2
+        translation = origin + size // 2 - shape // 2
+        frame = {'_t': ' '.join(str(int(t)) for t in translation)}
+        written += write_chunk(f, b'nTRN', struct.pack('<i', node_id) + pack_dict({})
+                               + struct.pack('<iiii', node_id + 1, -1, 0, 1) + pack_dict(frame))
+        written += write_chunk(f, b'nSHP', struct.pack('<i', node_id + 1) + pack_dict({})
+                               + struct.pack('<ii', 1, model_id) + pack_dict({}))
+    return written
+
+def write_magicavoxel(voxels, magicavoxel_file):
+    """
+    Write a voxel model as a MagicaVoxel .vox file (version 150).
+
+    Dense models keep only their visible voxels, in poly2vox scan order.
+    Models larger than MAX_MODEL_SIZE on any axis are split into tiles
+    placed by a nTRN/nGRP/nSHP scene graph. Chunks are streamed to the file
+    and the MAIN chunk size is patched in at the end.
+
+    Args:
+        voxels (DenseVoxels or SparseVoxels): voxel model to write
+        magicavoxel_file (str): Path to output MagicaVoxel .vox file
+    """
+    sparse = voxels.to_sparse()
+
     with open(magicavoxel_file, 'wb') as f:
-        f.write(vox_file)
+        f.write(b'VOX ' + struct.pack('<i', 150) + b'MAIN' + struct.pack('<i', 0))
+        children_offset = f.tell()
+        f.write(struct.pack('<i', 0))
+
+        if max(sparse.shape) <= MAX_MODEL_SIZE:
+            children = write_model(f, sparse.shape, build_xyzi(sparse.voxels))
+        else:
+            children = 0
+            models = []
+            for origin, size, xyzi in split_models(sparse):
+                children += write_model(f, size, xyzi)
+                models.append((origin, size))
+            children += write_scene_graph(f, sparse.shape, models)
+        children += write_chunk(f, b'RGBA', np.ascontiguousarray(sparse.rgba).tobytes())
+
+        f.seek(children_offset)
+        f.write(struct.pack('<i', children))
+
+def convert_poly2vox_to_magicavoxel(poly2vox_file, magicavoxel_file):
+    """
+    Convert a poly2vox .vox file to MagicaVoxel .vox format (version 150).
+
+    Args:
+        poly2vox_file (str): Path to input poly2vox .vox file
+        magicavoxel_file (str): Path to output MagicaVoxel .vox file
+    """
+    grid, palette = read_poly2vox(poly2vox_file)
+    write_magicavoxel(DenseVoxels.from_poly2vox(grid, palette), magicavoxel_file)
 
 # Example usage
 if __name__ == "__main__":
     # Read input and output from args
     input_vox = sys.argv[1]
     output_vox = sys.argv[2]
-    convert_poly2vox_to_magicavoxel(input_vox, output_vox)
\ No newline at end of file
+    convert_poly2vox_to_magicavoxel(input_vox, output_vox)
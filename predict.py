@@ -1,14 +1,19 @@
 from cog import BasePredictor, Input, Path
 import torch
 import os
-import subprocess
 import sys
+import tempfile
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'cog_flux'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'hunyuan3d_2'))
 
 from cog_flux.predict import DevPredictor
 from hunyuan3d_2.predict import Predictor as HunyuanPredictor
+from image_cache import ImageCache
+from profiler import Trace, span
+from voxelizer import VoxelizerPool, prepare_mesh
+
+IMAGE_CACHE_PATH = "/tmp/glb2vox/images"
 
 class PipelinePredictor(BasePredictor):
     def setup(self):
@@ -18,6 +23,11 @@ class PipelinePredictor(BasePredictor):
         # Initialize Hunyuan3D-2 predictor
         self.hunyuan_predictor = HunyuanPredictor()
         self.hunyuan_predictor.setup()
+        # Warm voxelization workers, one per output resolution
+        self.voxelizer_pool = VoxelizerPool(processes=3)
+        self.voxelizer_pool.warmup()
+        # Flux images by generation inputs, a repeated request then also hits the shape latent cache
+        self.image_cache = ImageCache(IMAGE_CACHE_PATH)
 
     def predict(
         self,
@@ -30,7 +40,9 @@ class PipelinePredictor(BasePredictor):
         prompt_strength: float = Input(description="Prompt strength for img2img in Flux (only applicable if image is provided)", default=0.8, ge=0.0, le=1.0),
         steps: int = Input(description="Number of inference steps for Hunyuan", default=50, ge=20, le=50),
         guidance_scale: float = Input(description="Guidance scale for Hunyuan", default=5.5, ge=1.0, le=20.0),
-        octree_resolution: int = Input(description="Octree resolution for Hunyuan", choices=[256, 384, 512], default=512),
+        octree_resolution: int = Input(description="Maximum octree resolution for Hunyuan. Surface extraction stops at the coarsest octree level that still has two cells per voxel of the largest output, i.e. 256 for high detail and 128 for low detail.", choices=[256, 384, 512], default=512),
+        preview: bool = Input(description="Quick preview voxels: sample the Hunyuan shape in preview_steps steps with the consistency scheduler", default=False),
+        preview_steps: int = Input(description="Number of inference steps for a Hunyuan preview", default=5, ge=4, le=10),
     ) -> list[Path]:
         # Generate snake_case filename from prompt
         def to_snake_case(text):
@@ -61,56 +73,90 @@ class PipelinePredictor(BasePredictor):
             modified_prompt = prompt
         final_prompt = template.format(modified_prompt)
 
-        # Generate image using Flux dev
-        flux_output = self.flux_predictor.predict(
-            prompt=final_prompt,
-            aspect_ratio="1:1",
-            num_outputs=1,
-            num_inference_steps=num_inference_steps,
-            guidance=guidance,
-            seed=seed,
-            output_format="png",
-            output_quality=100,
-            disable_safety_checker=True,
-            go_fast=False,
-            megapixels="1",
-            image=None,
-            prompt_strength=prompt_strength,
-        )
-        image_path = flux_output[0]
+        # Every file of this request lives in its own directory, concurrent requests share the shape scheduler
+        output_dir = tempfile.mkdtemp(prefix="glb2vox-")
+        image_path = os.path.join(output_dir, "image.png")
 
-        # Generate GLB using Hunyuan3D-2
-        hunyuan_output = self.hunyuan_predictor.predict(
-            image=image_path,
-            steps=steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            octree_resolution=octree_resolution,
-            remove_background=remove_background,
-        )
-        glb_path = hunyuan_output.mesh
+        # Record every stage of the request, see profiler.Trace
+        trace = Trace('predict', prompt=prompt, detail_level=detail_level, seed=seed, preview=preview)
+        with trace:
+            # Generate image using Flux dev, unless the same inputs were rendered before
+            flux_inputs = dict(
+                prompt=final_prompt,
+                aspect_ratio="1:1",
+                num_outputs=1,
+                num_inference_steps=num_inference_steps,
+                guidance=guidance,
+                seed=seed,
+                output_format="png",
+                output_quality=100,
+                disable_safety_checker=True,
+                go_fast=False,
+                megapixels="1",
+                image=None,
+                prompt_strength=prompt_strength,
+            )
+            image_key = ImageCache.key(model="flux-dev", **flux_inputs)
+            with span('Flux') as flux_span:
+                image_data = self.image_cache.get(image_key)
+                cached = image_data is not None
+                if not cached:
+                    with open(self.flux_predictor.predict(**flux_inputs)[0], "rb") as f:
+                        image_data = f.read()
+                    self.image_cache.put(image_key, image_data)
+                with open(image_path, "wb") as f:
+                    f.write(image_data)
+                if flux_span is not None:
+                    flux_span.attrs['cached'] = cached
 
-        # Create a descriptive filename base from the prompt
-        filename_base = to_snake_case(prompt)
-        output_dir = os.path.dirname(glb_path)
-        
-        # Determine resolutions based on detail_level
-        if detail_level == "high":
-            resolutions = [96, 80, 64]
-        elif detail_level == "low":
-            resolutions = [64, 48, 32]
-        sizes = ['large', 'medium', 'small']
-        temp_base = os.path.splitext(glb_path)[0]
+            # Determine resolutions based on detail_level
+            if detail_level == "high":
+                resolutions = [96, 80, 64]
+            elif detail_level == "low":
+                resolutions = [64, 48, 32]
+            sizes = ['large', 'medium', 'small']
+
+            # Generate textured mesh using Hunyuan3D-2, refined only as far as the largest voxel model needs
+            mesh = self.hunyuan_predictor.generate_mesh(
+                image=image_path,
+                steps=preview_steps if preview else steps,
+                guidance_scale=guidance_scale,
+                seed=seed,
+                octree_resolution=octree_resolution,
+                remove_background=remove_background,
+                max_voxel_resolution=max(resolutions),
+                fast=preview,
+                output_dir=output_dir,
+            )
+            glb_path = os.path.join(output_dir, "mesh.glb")
+
+            # Create a descriptive filename base from the prompt
+            filename_base = to_snake_case(prompt)
+            temp_base = os.path.splitext(glb_path)[0]
         
-        # First run the conversions with temporary filenames
-        temp_vox_paths = []
-        for i, (size, res) in enumerate(zip(sizes, resolutions)):
-            temp_output_vox = f"{temp_base}_{size}.vox"
+            # Voxelize all resolutions in the worker pool while the GLB is exported
+            temp_vox_paths = [f"{temp_base}_{size}.vox" for size in sizes]
+            with span('Prepare mesh'):
+                prepared = prepare_mesh(mesh)
             # Only generate GLTF/GLB for the first (large) resolution
-            skip_gltf_steps = (i > 0)  # Skip for medium and small sizes
-            self.run_glb2vox(glb_path, res, temp_output_vox, skip_gltf_steps)
-            temp_vox_paths.append(temp_output_vox)
-        
+            futures = [
+                self.voxelizer_pool.submit(prepared, res, path, gltf=(size == 'large'))
+                for size, res, path in zip(sizes, resolutions, temp_vox_paths)
+            ]
+            self.hunyuan_predictor.export_mesh(mesh, glb_path)
+            with span('Wait for glb2vox'):
+                results = [future.result() for future in futures]
+            for result in results:
+                trace.attach(result['span'])
+
+        # Write the request trace next to the outputs
+        trace.root.attrs['image_cache'] = self.image_cache.stats()
+        for name, stats in self.hunyuan_predictor.i23d_worker.cache_stats().items():
+            if stats is not None:
+                trace.root.attrs[f'{name}_cache'] = stats
+        trace.write_json(os.path.join(output_dir, "trace.json"))
+        trace.write_chrome_trace(os.path.join(output_dir, "trace.chrome.json"))
+
         # Create output filenames with descriptive names
         final_glb_path = os.path.join(output_dir, f"{filename_base}.vox.glb")
         final_vox_paths = []
@@ -131,7 +177,3 @@ class PipelinePredictor(BasePredictor):
         
         # Return the final paths
         return [Path(final_glb_path)] + [Path(vox_path) for vox_path in final_vox_paths]
-
-    def run_glb2vox(self, glb_path, resolution, output_vox, skip_gltf_steps=False):
-        subprocess.run(["bash", "./glb2vox.sh", str(glb_path), str(resolution), str(output_vox), 
-                         "true" if skip_gltf_steps else "false"], check=True)
@@ -0,0 +1,260 @@
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+_local = threading.local()
+
+def _read_rss():
+    """
+    Return the (current, peak) resident set size of this process in MB, or
+    (None, None) when /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = f.read()
+    except OSError:
+        return None, None
+    values = {}
+    for line in status.splitlines():
+        if line.startswith(('VmRSS:', 'VmHWM:')):
+            values[line[:5]] = int(line.split()[1]) / 1024
+    return values.get('VmRSS'), values.get('VmHWM')
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter, see proc(5) clear_refs."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _device_active():
+    return torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized()
+
+def current_trace():
+    """Return the trace recording on this thread, or None."""
+    return getattr(_local, 'trace', None)
+
+class Span:
+    """
+    One timed region of a trace.
+
+    Records wall time, process CPU time (all threads), resident memory at the
+    end of the span, the peak resident memory and peak CUDA memory reached
+    while the span was open, and any attributes passed by the caller.
+    """
+
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.children = []
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+        self.start = None
+        self.wall = None
+        self.cpu = None
+        self.rss_mb = None
+        self.peak_rss_mb = None
+        self.device_peak_mb = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'rss_mb': self.rss_mb,
+            'peak_rss_mb': self.peak_rss_mb,
+            'device_peak_mb': self.device_peak_mb,
+            'attrs': self.attrs,
+            'pid': self.pid,
+            'tid': self.tid,
+            'children': [child if isinstance(child, dict) else child.to_dict() for child in self.children],
+        }
+
+class Trace:
+    """
+    Tree of nested spans recorded for one request.
+
+    While a trace is entered it is the current trace of its thread and
+    `span(...)` anywhere in the call stack records into it. Peak memory of
+    a span is tracked by folding the kernel and CUDA peak counters into every
+    open span and resetting them at each span boundary.
+
+    Example:
+    ```python
+    with Trace('predict') as trace:
+        with span('flux'):
+            run()
+    trace.write_json('trace.json')
+    trace.write_chrome_trace('trace.chrome.json')
+    ```
+
+    Args:
+        name (str): name of the root span
+        sync_device (bool): synchronize CUDA at span boundaries so queued
+            kernels are attributed to the span that launched them
+    """
+
+    def __init__(self, name, sync_device=True, **attrs):
+        self.root = Span(name, attrs)
+        self.sync_device = sync_device
+        self._stack = []
+        self._peaks = []
+
+    def __enter__(self):
+        self._previous = current_trace()
+        _local.trace = self
+        self.open(self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close(self.root)
+        _local.trace = self._previous
+
+    def _fold_peaks(self):
+        """Fold the current peak counters into every open span and reset them."""
+        _, peak_rss = _read_rss()
+        device_peak = None
+        if _device_active():
+            if self.sync_device:
+                torch.cuda.synchronize()
+            device_peak = torch.cuda.max_memory_allocated() / 2 ** 20
+            torch.cuda.reset_peak_memory_stats()
+        for peaks in self._peaks:
+            if peak_rss is not None:
+                peaks[0] = max(peaks[0] or 0.0, peak_rss)
+            if device_peak is not None:
+                peaks[1] = max(peaks[1] or 0.0, device_peak)
+        _reset_peak_rss()
+
+    def open(self, span):
+        if self._stack:
+            self._stack[-1].children.append(span)
+        self._fold_peaks()
+        self._stack.append(span)
+        self._peaks.append([None, None])
+        span.start = time.time()
+        span._wall_start = time.perf_counter()
+        span._cpu_start = time.process_time()
+
+    def close(self, span):
+        self._fold_peaks()
+        span.wall = time.perf_counter() - span._wall_start
+        span.cpu = time.process_time() - span._cpu_start
+        span.rss_mb, _ = _read_rss()
+        span.peak_rss_mb, span.device_peak_mb = self._peaks.pop()
+        popped = self._stack.pop()
+        assert popped is span, f"span {span.name} closed while {popped.name} is open"
+
+    def attach(self, span_dict):
+        """Attach a span recorded elsewhere, e.g. in a worker process, to the open span."""
+        self._stack[-1].children.append(span_dict)
+
+    def to_dict(self):
+        return self.root.to_dict()
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def chrome_events(self):
+        """Flatten the spans into Chrome trace complete ('X') events."""
+        origin = self.root.start
+        events = []
+
+        def visit(span):
+            args = {
+                key: span[key] for key in ('cpu', 'rss_mb', 'peak_rss_mb', 'device_peak_mb')
+                if span[key] is not None
+            }
+            args.update(span['attrs'])
+            events.append({
+                'name': span['name'],
+                'cat': 'pipeline',
+                'ph': 'X',
+                'ts': (span['start'] - origin) * 1e6,
+                'dur': span['wall'] * 1e6,
+                'pid': span['pid'],
+                'tid': span['tid'],
+                'args': args,
+            })
+            for child in span['children']:
+                visit(child)
+
+        visit(self.to_dict())
+        return events
+
+    def write_chrome_trace(self, path):
+        """Write the trace in the Chrome trace event format, see chrome://tracing or Perfetto."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """Return an indented text report with one line per span."""
+        lines = []
+
+        def visit(span, depth):
+            line = f"{'  ' * depth}{span['name']}: {span['wall']:.2f}s wall, {span['cpu']:.2f}s cpu"
+            if span['peak_rss_mb'] is not None:
+                line += f", peak rss {span['peak_rss_mb']:.0f}MB"
+            if span['device_peak_mb'] is not None:
+                line += f", peak device {span['device_peak_mb']:.0f}MB"
+            lines.append(line)
+            for child in span['children']:
+                visit(child, depth + 1)
+
+        visit(self.to_dict(), 0)
+        return '\n'.join(lines)
+
+class span:
+    """
+    Record a span in the current trace of this thread.
+
+    Does nothing when no trace is active, so library code can be instrumented
+    unconditionally. Supports both context manager and decorator usage.
+
+    Example:
+    ```python
+    with span('marching cubes', resolution=512):
+        run()
+
+    @span('export')
+    def export(mesh):
+        pass
+    ```
+    """
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        trace = current_trace()
+        self._trace = trace
+        if trace is None:
+            return None
+        self._span = Span(self.name, self.attrs)
+        trace.open(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self._trace is not None:
+            if exc_type is not None:
+                self._span.attrs['error'] = exc_type.__name__
+            self._trace.close(self._span)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(self.name, **self.attrs):
+                return func(*args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,228 @@
+import base64
+import json
+import struct
+import sys
+
+import numpy as np
+
+from polyvox2mgvox import read_magicavoxel
+
+# glTF component types
+UNSIGNED_INT = 5125
+FLOAT = 5126
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+def face_runs(faces):
+    """
+    Find runs of equal non-zero values along the last axis of a 3D array.
+
+    Returns:
+        tuple: (slice, row, start, end, value) arrays, one entry per run, with
+        `end` exclusive.
+    """
+    depth, rows, cols = faces.shape
+    # Pad every row with a zero so runs never continue into the next row
+    padded = np.zeros((depth, rows, cols + 1), dtype=faces.dtype)
+    padded[:, :, :cols] = faces
+    flat = padded.reshape(-1)
+    change = np.flatnonzero(np.diff(flat, prepend=0) != 0)
+    starts = change[flat[change] != 0]
+    ends = np.searchsorted(change, starts, side='right')
+    ends = np.append(change, len(flat))[ends]
+    slice_index, row, start = np.unravel_index(starts, padded.shape)
+    return slice_index, row, start, start + (ends - starts), flat[starts]
+
+def greedy_quads(faces):
+    """
+    Merge the visible faces of one axis direction into rectangles.
+
+    Faces are first merged into runs along the last axis, then runs with the
+    same slice, extent and colour on consecutive rows are merged together.
+
+    Args:
+        faces (np.ndarray): (D, U, V) array of colour indices, 0 where no face is visible
+
+    Returns:
+        np.ndarray: (N, 6) int64 array of (slice, u0, u1, v0, v1, colour) rectangles.
+    """
+    slice_index, row, start, end, value = face_runs(faces)
+    if len(row) == 0:
+        return np.zeros((0, 6), dtype=np.int64)
+
+    order = np.lexsort((row, value, end, start, slice_index))
+    slice_index, row, start, end, value = (a[order] for a in (slice_index, row, start, end, value))
+    same = np.zeros(len(row), dtype=bool)
+    same[1:] = (
+        (slice_index[1:] == slice_index[:-1]) & (start[1:] == start[:-1]) & (end[1:] == end[:-1])
+        & (value[1:] == value[:-1]) & (row[1:] == row[:-1] + 1)
+    )
+    first = np.flatnonzero(~same)
+    last = np.append(first[1:], len(row)) - 1
+    return np.stack([
+        slice_index[first], row[first], row[last] + 1, start[first], end[first], value[first]
+    ], axis=1).astype(np.int64)
+
+def greedy_mesh(colors):
+    """
+    Build a greedy-meshed surface for a dense colour index grid.
+
+    Args:
+        colors (np.ndarray): (X, Y, Z) uint8 array of MagicaVoxel colour indices, 0 = empty
+
+    Returns:
+        tuple: (positions, normals, color_index, indices) with four vertices per
+        quad, positions in voxel units and counter-clockwise triangles.
+    """
+    occupied = colors != 0
+    padded = np.pad(occupied, 1, mode='constant', constant_values=False)
+    positions, normals, color_index = [], [], []
+
+    for axis in range(3):
+        u_axis, v_axis = [a for a in range(3) if a != axis]
+        for direction in (1, -1):
+            shift = [slice(1, -1)] * 3
+            shift[axis] = slice(2, None) if direction > 0 else slice(None, -2)
+            visible = occupied & ~padded[tuple(shift)]
+            faces = np.where(visible, colors, 0).transpose(axis, u_axis, v_axis)
+            quads = greedy_quads(faces)
+            if len(quads) == 0:
+                continue
+
+            d = quads[:, 0] + (1 if direction > 0 else 0)
+            u0, u1, v0, v1 = quads[:, 1], quads[:, 2], quads[:, 3], quads[:, 4]
+            corners = np.zeros((len(quads), 4, 3), dtype=np.float32)
+            corners[:, :, axis] = d[:, None]
+            corners[:, :, u_axis] = np.stack([u0, u1, u1, u0], axis=1)
+            corners[:, :, v_axis] = np.stack([v0, v0, v1, v1], axis=1)
+            # (u, v, axis) is right handed only when the axis is 1, flip winding to keep faces outward
+            if (direction > 0) == (axis == 1):
+                corners = corners[:, ::-1]
+            normal = np.zeros(3, dtype=np.float32)
+            normal[axis] = direction
+
+            positions.append(corners.reshape(-1, 3))
+            normals.append(np.broadcast_to(normal, (len(quads) * 4, 3)))
+            color_index.append(np.repeat(quads[:, 5], 4))
+
+    if not positions:
+        empty = np.zeros((0, 3), dtype=np.float32)
+        return empty, empty, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+
+    positions = np.concatenate(positions)
+    quad_start = np.arange(0, len(positions), 4, dtype=np.uint32)[:, None]
+    indices = (quad_start + np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)).reshape(-1)
+    return positions, np.concatenate(normals), np.concatenate(color_index), indices
+
+def srgb_to_linear(rgb):
+    rgb = rgb.astype(np.float32) / 255.0
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+def build_gltf(voxels, voxel_size=1.0):
+    """
+    Build a glTF document and its binary buffer for a voxel model.
+
+    MagicaVoxel's z-up axes are converted to glTF's y-up axes, the model is
+    centered on the x and z axes and rests on y = 0.
+
+    Args:
+        voxels (DenseVoxels or SparseVoxels): voxel model to export, sparse
+            models are densified
+        voxel_size (float): edge length of one voxel in glTF units
+
+    Returns:
+        tuple: (gltf, buffer) with gltf a JSON-serializable dict and buffer bytes.
+    """
+    voxels = voxels.to_dense()
+    rgba = voxels.rgba
+    positions, normals, color_index, indices = greedy_mesh(voxels.colors)
+    xsiz, ysiz, _ = voxels.shape
+    positions = np.stack([
+        positions[:, 0] - xsiz / 2,
+        positions[:, 2],
+        ysiz / 2 - positions[:, 1],
+    ], axis=1).astype(np.float32) * voxel_size
+    normals = np.ascontiguousarray(normals[:, [0, 2, 1]] * np.array([1, 1, -1], dtype=np.float32))
+    palette = np.zeros((256, 3), dtype=np.float32)
+    palette[1:len(rgba) + 1] = srgb_to_linear(rgba[:, :3])
+    vertex_colors = palette[color_index]
+
+    views = []
+    accessors = []
+    buffer = bytearray()
+
+    def add_accessor(array, accessor_type, target, with_bounds=False):
+        offset = len(buffer)
+        buffer.extend(np.ascontiguousarray(array).tobytes())
+        buffer.extend(b'\0' * (-len(buffer) % 4))
+        views.append({'buffer': 0, 'byteOffset': offset, 'byteLength': array.nbytes, 'target': target})
+        accessor = {
+            'bufferView': len(views) - 1,
+            'componentType': UNSIGNED_INT if array.dtype == np.uint32 else FLOAT,
+            'count': len(array),
+            'type': accessor_type,
+        }
+        if with_bounds:
+            accessor['min'] = array.min(axis=0).tolist()
+            accessor['max'] = array.max(axis=0).tolist()
+        accessors.append(accessor)
+        return len(accessors) - 1
+
+    primitives = []
+    if len(indices):
+        primitives.append({
+            'attributes': {
+                'POSITION': add_accessor(positions, 'VEC3', ARRAY_BUFFER, with_bounds=True),
+                'NORMAL': add_accessor(normals, 'VEC3', ARRAY_BUFFER),
+                'COLOR_0': add_accessor(vertex_colors, 'VEC3', ARRAY_BUFFER),
+            },
+            'indices': add_accessor(indices, 'SCALAR', ELEMENT_ARRAY_BUFFER),
+            'material': 0,
+        })
+
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'vox2gltf'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        # glTF meshes need at least one primitive, an empty model is a bare node
+        'nodes': [{'mesh': 0} if primitives else {}],
+        'meshes': [{'primitives': primitives}] if primitives else [],
+        'materials': [{'pbrMetallicRoughness': {'metallicFactor': 0.0, 'roughnessFactor': 1.0}}],
+        'accessors': accessors,
+        'bufferViews': views,
+        'buffers': [{'byteLength': len(buffer)}],
+    }
+    return gltf, bytes(buffer)
+
+def write_glb(gltf, buffer, glb_file):
+    """Write a glTF document and its buffer as a single binary .glb file."""
+    content = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    content += b' ' * (-len(content) % 4)
+    buffer += b'\0' * (-len(buffer) % 4)
+    length = 12 + 8 + len(content) + 8 + len(buffer)
+    with open(glb_file, 'wb') as f:
+        f.write(struct.pack('<4sII', b'glTF', 2, length))
+        f.write(struct.pack('<I4s', len(content), b'JSON'))
+        f.write(content)
+        f.write(struct.pack('<I4s', len(buffer), b'BIN\0'))
+        f.write(buffer)
+
+def write_gltf(gltf, buffer, gltf_file):
+    """Write a glTF document as a .gltf file with the buffer embedded as a data URI."""
+    gltf = dict(gltf, buffers=[{
+        'byteLength': len(buffer),
+        'uri': 'data:application/octet-stream;base64,' + base64.b64encode(buffer).decode('ascii'),
+    }])
+    with open(gltf_file, 'w') as f:
+        json.dump(gltf, f, separators=(',', ':'))
+
+def vox_to_gltf(magicavoxel_file, gltf_file=None, glb_file=None):
+    """Convert a MagicaVoxel .vox file to .gltf and/or .glb files."""
+    gltf, buffer = build_gltf(read_magicavoxel(magicavoxel_file))
+    if gltf_file is not None:
+        write_gltf(gltf, buffer, gltf_file)
+    if glb_file is not None:
+        write_glb(gltf, buffer, glb_file)
+
+if __name__ == "__main__":
+    vox_to_gltf(sys.argv[1], gltf_file=f"{sys.argv[1]}.gltf", glb_file=f"{sys.argv[1]}.glb")
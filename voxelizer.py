@@ -0,0 +1,300 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import trimesh
+from PIL import Image
+from scipy import ndimage
+
+from polyvox2mgvox import write_magicavoxel
+from profiler import Trace, span
+from vox2gltf import build_gltf, write_glb, write_gltf
+from voxels import EMPTY, DenseVoxels
+
+INTERIOR = 0
+MAX_COLORS = 254
+DEFAULT_COLOR = (200, 200, 200)
+
+def load_mesh(glb_path):
+    """Load a GLB file as a single trimesh.Trimesh, keeping its UVs and texture."""
+    return trimesh.load(glb_path, force='mesh')
+
+def barycentric_pattern(n):
+    """
+    Return the (K, 3) barycentric weights of a triangle subdivided into n
+    segments per edge, including the corners.
+    """
+    i, j = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing='ij')
+    keep = i + j <= n
+    u = i[keep] / n
+    v = j[keep] / n
+    return np.stack([1.0 - u - v, u, v], axis=1)
+
+def sample_triangles(triangles, spacing):
+    """
+    Sample points on triangles so that neighbouring samples are at most
+    `spacing` apart.
+
+    Args:
+        triangles (np.ndarray): (F, 3, 3) triangle vertex positions
+        spacing (float): maximum distance between samples
+
+    Returns:
+        tuple: (face_index, weights) where face_index is (K,) and weights are
+        the (K, 3) barycentric coordinates of each sample.
+    """
+    edges = triangles - np.roll(triangles, 1, axis=1)
+    longest = np.linalg.norm(edges, axis=2).max(axis=1)
+    subdivisions = np.maximum(np.ceil(longest / spacing), 1).astype(np.int64)
+
+    face_index = []
+    weights = []
+    # Triangles are grouped by subdivision level so each group shares a pattern
+    for n in np.unique(subdivisions):
+        faces = np.nonzero(subdivisions == n)[0]
+        pattern = barycentric_pattern(n)
+        face_index.append(np.repeat(faces, len(pattern)))
+        weights.append(np.tile(pattern, (len(faces), 1)))
+    return np.concatenate(face_index), np.concatenate(weights)
+
+def material_image(visual):
+    """Return the base color texture of a TextureVisuals as an RGB array, or None."""
+    material = getattr(visual, 'material', None)
+    image = getattr(material, 'baseColorTexture', None)
+    if image is None:
+        image = getattr(material, 'image', None)
+    if image is None:
+        return None
+    return np.asarray(image.convert('RGB'))
+
+class PreparedMesh:
+    """
+    Resolution-independent mesh data needed for voxelization.
+
+    Holds triangles in poly2vox axis order together with either the per-corner
+    UVs and texture image or per-corner colours, so several resolutions can be
+    voxelized without re-reading the mesh or its texture. Instances are
+    picklable and can be shipped to worker processes.
+    """
+
+    def __init__(self, triangles, texture=None, corner_uv=None, corner_colors=None):
+        self.triangles = triangles
+        self.texture = texture
+        self.corner_uv = corner_uv
+        self.corner_colors = corner_colors
+
+    def sample_colors(self, face_index, weights):
+        """Look up an 8-bit RGB colour for every surface sample."""
+        if self.texture is not None:
+            uv = np.einsum('kc,kcd->kd', weights, self.corner_uv[face_index]) % 1.0
+            height, width = self.texture.shape[:2]
+            px = np.clip((uv[:, 0] * width).astype(np.int64), 0, width - 1)
+            py = np.clip(((1.0 - uv[:, 1]) * height).astype(np.int64), 0, height - 1)
+            return self.texture[py, px]
+        colors = np.einsum('kc,kcd->kd', weights, self.corner_colors[face_index])
+        return colors.round().astype(np.uint8)
+
+def prepare_mesh(mesh):
+    """
+    Extract the triangles and colour sources of a trimesh.Trimesh.
+
+    Vertices are reordered to poly2vox axes: x right, y away from the viewer
+    and z down.
+    """
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    vertices = np.stack([vertices[:, 0], vertices[:, 2], -vertices[:, 1]], axis=1)
+    faces = np.asarray(mesh.faces)
+    triangles = vertices[faces]
+
+    visual = mesh.visual
+    if visual.kind == 'texture':
+        texture = material_image(visual)
+        if texture is not None and visual.uv is not None:
+            corner_uv = np.asarray(visual.uv, dtype=np.float64)[faces]
+            return PreparedMesh(triangles, texture=texture, corner_uv=corner_uv)
+        visual = visual.to_color()
+    if visual.kind == 'vertex':
+        corner_colors = visual.vertex_colors[:, :3].astype(np.float64)[faces]
+    elif visual.kind == 'face':
+        corner_colors = np.repeat(visual.face_colors[:, None, :3].astype(np.float64), 3, axis=1)
+    else:
+        corner_colors = np.broadcast_to(np.array(DEFAULT_COLOR, dtype=np.float64), triangles.shape)
+    return PreparedMesh(triangles, corner_colors=corner_colors)
+
+def build_palette(colors):
+    """
+    Quantize 8-bit RGB colours into a poly2vox palette.
+
+    Returns:
+        tuple: (indices, palette) where indices are in 1-254 and palette is a
+        (256, 3) uint8 array of 6-bit colour components.
+    """
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    if len(colors) == 0:
+        return np.zeros(0, dtype=np.uint8), palette
+    strip = Image.fromarray(np.ascontiguousarray(colors).reshape(1, -1, 3))
+    quantized = strip.quantize(colors=MAX_COLORS, method=Image.Quantize.MEDIANCUT)
+    indices = np.asarray(quantized, dtype=np.uint8).reshape(-1)
+    used = np.asarray(quantized.getpalette()[:MAX_COLORS * 3], dtype=np.uint8).reshape(-1, 3)
+    palette[1:1 + len(used)] = used >> 2
+    return indices + 1, palette
+
+def voxelize_prepared(prepared, resolution):
+    """
+    Voxelize a PreparedMesh into a poly2vox-style palette index grid.
+
+    The longest side of the mesh bounding box spans `resolution` voxels. The
+    grid uses the poly2vox axis layout read by polyvox2mgvox: x follows the
+    mesh x axis, y follows the mesh z axis and z points down the mesh y axis.
+    Surface voxels hold palette indices 1-254, enclosed voxels hold 0 and
+    empty voxels hold 255.
+
+    Args:
+        prepared (PreparedMesh): mesh data from prepare_mesh
+        resolution (int): number of voxels along the longest axis
+
+    Returns:
+        tuple: (grid, palette) with grid a uint8 array of shape (xsiz, ysiz, zsiz)
+        and palette a (256, 3) uint8 array of 6-bit colour components.
+    """
+    triangles = prepared.triangles
+    bbox_min = triangles.reshape(-1, 3).min(axis=0)
+    extent = triangles.reshape(-1, 3).max(axis=0) - bbox_min
+    voxel_size = max(extent.max(), 1e-8) / resolution
+    shape = np.clip(np.ceil(extent / voxel_size).astype(np.int64), 1, resolution)
+
+    face_index, weights = sample_triangles(triangles, 0.5 * voxel_size)
+    points = np.einsum('kc,kcd->kd', weights, triangles[face_index])
+    cells = np.clip(((points - bbox_min) / voxel_size).astype(np.int64), 0, shape - 1)
+    flat = np.ravel_multi_index(cells.T, shape)
+
+    # Average the colour of all samples falling into the same voxel
+    colors = prepared.sample_colors(face_index, weights).astype(np.float64)
+    occupied, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    voxel_colors = np.stack(
+        [np.bincount(inverse, weights=colors[:, c], minlength=len(occupied)) for c in range(3)],
+        axis=1
+    ) / counts[:, None]
+    indices, palette = build_palette(voxel_colors.round().astype(np.uint8))
+
+    surface = np.zeros(shape, dtype=bool)
+    surface.reshape(-1)[occupied] = True
+    grid = np.full(shape, EMPTY, dtype=np.uint8)
+    grid[ndimage.binary_fill_holes(surface)] = INTERIOR
+    grid.reshape(-1)[occupied] = indices
+    return grid, palette
+
+def voxelize_mesh(mesh, resolution):
+    """Voxelize a trimesh.Trimesh at a single resolution, see voxelize_prepared."""
+    return voxelize_prepared(prepare_mesh(mesh), resolution)
+
+_worker_mesh = None
+
+def _init_worker(prepared):
+    global _worker_mesh
+    _worker_mesh = prepared
+
+def _voxelize_worker(resolution):
+    return voxelize_prepared(_worker_mesh, resolution)
+
+def voxelize_multi(mesh, resolutions, processes=None):
+    """
+    Voxelize one mesh at several resolutions, preparing it only once.
+
+    Args:
+        mesh (trimesh.Trimesh or PreparedMesh): mesh to voxelize
+        resolutions (list of int): resolutions to produce
+        processes (int, optional): number of worker processes. Resolutions are
+            voxelized in this process when None or 1.
+
+    Returns:
+        list of (grid, palette) tuples in the order of `resolutions`.
+    """
+    prepared = mesh if isinstance(mesh, PreparedMesh) else prepare_mesh(mesh)
+    if not processes or processes <= 1 or len(resolutions) <= 1:
+        return [voxelize_prepared(prepared, resolution) for resolution in resolutions]
+
+    # Workers receive the prepared mesh once through the initializer
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(min(processes, len(resolutions)), mp_context=context,
+                             initializer=_init_worker, initargs=(prepared,)) as pool:
+        return list(pool.map(_voxelize_worker, resolutions))
+
+def convert_job(prepared, resolution, output_vox, gltf=False):
+    """
+    Voxelize a PreparedMesh and write it as a MagicaVoxel .vox file.
+
+    When `gltf` is set the greedy-meshed model is also written next to it as
+    `<output_vox>.gltf` and `<output_vox>.glb`.
+
+    Returns:
+        dict: the resolution, output path, grid shape, per-stage timings in
+        seconds and the profiler span of the job, to be attached to the
+        caller's trace.
+    """
+    with Trace(f'glb2vox {resolution}', resolution=resolution) as trace:
+        with span('voxelize'):
+            voxels = DenseVoxels.from_poly2vox(*voxelize_prepared(prepared, resolution))
+        with span('write vox'):
+            write_magicavoxel(voxels, output_vox)
+        if gltf:
+            with span('gltf'):
+                document, buffer = build_gltf(voxels)
+                write_gltf(document, buffer, f"{output_vox}.gltf")
+                write_glb(document, buffer, f"{output_vox}.glb")
+    return {
+        'resolution': resolution,
+        'output_vox': output_vox,
+        'shape': voxels.shape,
+        'timings': {child.name: child.wall for child in trace.root.children},
+        'span': trace.to_dict(),
+    }
+
+def _warmup_job():
+    voxelize_mesh(trimesh.creation.box(), 4)
+    return os.getpid()
+
+class VoxelizerPool:
+    """
+    Long-lived pool of worker processes running voxelization jobs.
+
+    Workers are spawned rather than forked so they don't inherit the CUDA
+    state and threads of the predictor process.
+    """
+
+    def __init__(self, processes=3):
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def warmup(self):
+        """Start every worker and run a tiny conversion so requests don't pay for imports."""
+        futures = [self.executor.submit(_warmup_job) for _ in range(self.processes)]
+        return sorted(future.result() for future in futures)
+
+    def submit(self, prepared, resolution, output_vox, gltf=False):
+        """Queue a conversion job and return a Future resolving to the convert_job result."""
+        return self.executor.submit(convert_job, prepared, resolution, str(output_vox), gltf)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+def glb_to_vox(glb_path, resolutions, output_voxes, processes=None):
+    """
+    Voxelize a GLB file and write it as MagicaVoxel .vox files.
+
+    Args:
+        glb_path (str): path to the input GLB file
+        resolutions (int or list of int): resolution(s) to produce
+        output_voxes (str or list of str): output path for each resolution
+        processes (int, optional): number of worker processes, see voxelize_multi
+    """
+    if isinstance(resolutions, int):
+        resolutions, output_voxes = [resolutions], [output_voxes]
+    results = voxelize_multi(load_mesh(glb_path), resolutions, processes=processes)
+    for (grid, palette), output_vox in zip(results, output_voxes):
+        write_magicavoxel(DenseVoxels.from_poly2vox(grid, palette), output_vox)
+
+if __name__ == "__main__":
+    glb_to_vox(sys.argv[1], int(sys.argv[2]), sys.argv[3])
@@ -0,0 +1,129 @@
+import numpy as np
+
+# poly2vox palette index of empty voxels
+EMPTY = 255
+
+# One record per voxel of a SparseVoxels model, in MagicaVoxel coordinates
+VOXEL_DTYPE = np.dtype([('x', '<u2'), ('y', '<u2'), ('z', '<u2'), ('c', 'u1')])
+
+def build_rgba(palette):
+    """
+    Build the MagicaVoxel RGBA palette from a poly2vox 6-bit RGB palette.
+
+    poly2vox colors 1-254 map to MagicaVoxel indices 1-254 with A=255 and the
+    last entry is transparent black.
+    """
+    rgba = np.zeros((255, 4), dtype=np.uint8)
+    rgba[:254, :3] = palette[1:255] * 4
+    rgba[:254, 3] = 255
+    return rgba
+
+def magicavoxel_colors(grid):
+    """
+    Convert a poly2vox grid to a dense grid of MagicaVoxel colour indices.
+
+    The y and z axes are flipped into MagicaVoxel space, empty voxels become 0
+    and internal voxels use the default colour index 255.
+    """
+    colors = np.where(grid == 0, 255, grid)
+    colors[grid == EMPTY] = 0
+    return colors[:, ::-1, ::-1]
+
+def surface_mask(occupied):
+    """
+    Return a boolean mask of the occupied voxels that have at least one empty
+    6-neighbour (voxels on the grid boundary count as exposed).
+    """
+    padded = np.pad(occupied, 1, mode='constant', constant_values=False)
+    enclosed = occupied.copy()
+    enclosed &= padded[2:, 1:-1, 1:-1]
+    enclosed &= padded[:-2, 1:-1, 1:-1]
+    enclosed &= padded[1:-1, 2:, 1:-1]
+    enclosed &= padded[1:-1, :-2, 1:-1]
+    enclosed &= padded[1:-1, 1:-1, 2:]
+    enclosed &= padded[1:-1, 1:-1, :-2]
+    return occupied & ~enclosed
+
+class DenseVoxels:
+    """
+    Dense voxel model: a (X, Y, Z) uint8 array of MagicaVoxel colour indices
+    (0 = empty) in MagicaVoxel's z-up axes, plus an RGBA palette whose row i
+    holds colour index i + 1.
+
+    Slicing returns a DenseVoxels sharing the same colour array.
+    """
+
+    def __init__(self, colors, rgba):
+        self.colors = colors
+        self.rgba = rgba
+
+    @classmethod
+    def from_poly2vox(cls, grid, palette):
+        """Wrap a poly2vox grid and 6-bit palette, see magicavoxel_colors and build_rgba."""
+        return cls(magicavoxel_colors(grid), build_rgba(palette))
+
+    @property
+    def shape(self):
+        return self.colors.shape
+
+    def __getitem__(self, key):
+        colors = self.colors[key]
+        if colors.ndim != 3:
+            raise IndexError("DenseVoxels can only be sliced, not indexed")
+        return DenseVoxels(colors, self.rgba)
+
+    def surface_mask(self):
+        return surface_mask(self.colors != 0)
+
+    def to_dense(self):
+        return self
+
+    def to_sparse(self, surface_only=True):
+        """
+        Collect voxels into a SparseVoxels model.
+
+        Voxels are ordered by descending z, then descending y, then ascending
+        x, which is the scan order of poly2vox files.
+
+        Args:
+            surface_only (bool): keep only voxels with an empty 6-neighbour
+        """
+        mask = self.surface_mask() if surface_only else self.colors != 0
+        xsiz, ysiz, zsiz = self.shape
+        z, y, x = np.nonzero(mask[:, ::-1, ::-1].transpose(2, 1, 0))
+        voxels = np.empty(len(x), dtype=VOXEL_DTYPE)
+        voxels['x'] = x
+        voxels['y'] = ysiz - 1 - y
+        voxels['z'] = zsiz - 1 - z
+        voxels['c'] = self.colors[voxels['x'], voxels['y'], voxels['z']]
+        return SparseVoxels(voxels, self.shape, self.rgba)
+
+class SparseVoxels:
+    """
+    Sparse voxel model: a structured VOXEL_DTYPE array of (x, y, z, c)
+    records inside a grid of the given shape, plus an RGBA palette.
+
+    Slicing selects a range of records and, like the coordinate fields,
+    shares memory with the original array.
+    """
+
+    def __init__(self, voxels, shape, rgba):
+        self.voxels = voxels
+        self.shape = tuple(int(s) for s in shape)
+        self.rgba = rgba
+
+    def __len__(self):
+        return len(self.voxels)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise IndexError("SparseVoxels can only be sliced by record range")
+        return SparseVoxels(self.voxels[key], self.shape, self.rgba)
+
+    def to_dense(self):
+        colors = np.zeros(self.shape, dtype=np.uint8)
+        colors[self.voxels['x'], self.voxels['y'], self.voxels['z']] = self.voxels['c']
+        return DenseVoxels(colors, self.rgba)
+
+    def to_sparse(self, surface_only=True):
+        return self